@@ -0,0 +1,26 @@
+"""add composite (conv_id, id) index to convomessage
+
+Revision ID: b7c2e9f1a3d4
+Revises: a4b6c8d0e1f2
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "b7c2e9f1a3d4"
+down_revision: Union[str, Sequence[str], None] = "a4b6c8d0e1f2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_convomessage_conv_id_id", "convomessage", ["conv_id", "id"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_convomessage_conv_id_id", table_name="convomessage")
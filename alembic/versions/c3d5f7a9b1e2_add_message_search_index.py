@@ -0,0 +1,56 @@
+"""add full-text search index on convomessage.content
+
+Revision ID: c3d5f7a9b1e2
+Revises: b7c2e9f1a3d4
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "c3d5f7a9b1e2"
+down_revision: Union[str, Sequence[str], None] = "b7c2e9f1a3d4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == "sqlite":
+        op.execute(
+            "CREATE VIRTUAL TABLE convomessage_fts USING fts5("
+            "content, content='convomessage', content_rowid='id')"
+        )
+        op.execute(
+            "CREATE TRIGGER convomessage_fts_ai AFTER INSERT ON convomessage "
+            "BEGIN INSERT INTO convomessage_fts(rowid, content) "
+            "VALUES (new.id, new.content); END"
+        )
+        op.execute(
+            "CREATE TRIGGER convomessage_fts_ad AFTER DELETE ON convomessage "
+            "BEGIN INSERT INTO convomessage_fts(convomessage_fts, rowid, content) "
+            "VALUES ('delete', old.id, old.content); END"
+        )
+        op.execute(
+            "CREATE TRIGGER convomessage_fts_au AFTER UPDATE OF content ON convomessage "
+            "BEGIN INSERT INTO convomessage_fts(convomessage_fts, rowid, content) "
+            "VALUES ('delete', old.id, old.content); "
+            "INSERT INTO convomessage_fts(rowid, content) VALUES (new.id, new.content); END"
+        )
+        op.execute("INSERT INTO convomessage_fts(convomessage_fts) VALUES ('rebuild')")
+    else:
+        op.execute(
+            "CREATE INDEX ix_convomessage_content_tsv ON convomessage "
+            "USING gin (to_tsvector('simple'::regconfig, content))"
+        )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == "sqlite":
+        op.execute("DROP TRIGGER IF EXISTS convomessage_fts_au")
+        op.execute("DROP TRIGGER IF EXISTS convomessage_fts_ad")
+        op.execute("DROP TRIGGER IF EXISTS convomessage_fts_ai")
+        op.execute("DROP TABLE IF EXISTS convomessage_fts")
+    else:
+        op.execute("DROP INDEX IF EXISTS ix_convomessage_content_tsv")
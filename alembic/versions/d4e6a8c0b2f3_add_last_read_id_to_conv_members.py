@@ -0,0 +1,28 @@
+"""add last_read_id read cursor to conv_members
+
+Revision ID: d4e6a8c0b2f3
+Revises: c3d5f7a9b1e2
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "d4e6a8c0b2f3"
+down_revision: Union[str, Sequence[str], None] = "c3d5f7a9b1e2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "conv_members",
+        sa.Column("last_read_id", sa.Integer(), nullable=False, server_default=sa.text("0")),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("conv_members", "last_read_id")
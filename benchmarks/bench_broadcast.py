@@ -0,0 +1,63 @@
+"""Micro-benchmark for the in-memory socket registry.
+
+Measures the cost of one ``broadcast_message_to_conv`` call for a fixed
+conversation size while the total number of open sockets grows, including
+the time the per-socket writer tasks need to drain the frames. With the
+subscription index keyed by conversation, the cost should stay flat.
+
+Run from the repository root:
+
+    python benchmarks/bench_broadcast.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ppback.ppschema import MessageSchema  # noqa: E402
+from ppback.wsocket import InMemSockets  # noqa: E402
+
+MEMBERS = int(os.getenv("BENCH_MEMBERS", "50"))
+SOCKETS_PER_USER = int(os.getenv("BENCH_SOCKETS_PER_USER", "2"))
+ROUNDS = int(os.getenv("BENCH_ROUNDS", "200"))
+TOTALS = [1_000, 5_000, 20_000, 50_000]
+
+
+class NullSocket:
+    async def send_text(self, payload: str) -> None:
+        return None
+
+
+async def bench(total_sockets: int) -> float:
+    registry = InMemSockets(limit=SOCKETS_PER_USER)
+    socket = NullSocket()
+    for user_id in range(total_sockets // SOCKETS_PER_USER):
+        for _ in range(SOCKETS_PER_USER):
+            registry.add_user(user_id, socket)
+
+    # Let every writer task reach its idle queue.get() before timing.
+    await asyncio.sleep(0)
+
+    for user_id in range(MEMBERS):
+        registry.subscribe(user_id, [1])
+    start = time.perf_counter()
+    for msg_id in range(ROUNDS):
+        message = MessageSchema(id=msg_id, content="bench", sender=0, ts=0.0)
+        await registry.broadcast_message_to_conv(1, message)
+        await asyncio.sleep(0)
+    return (time.perf_counter() - start) / ROUNDS
+
+
+def main() -> None:
+    print(f"members={MEMBERS} sockets_per_user={SOCKETS_PER_USER} rounds={ROUNDS}")
+    print(f"{'total sockets':>14} {'us / broadcast':>16}")
+    for total in TOTALS:
+        per_call = asyncio.run(bench(total))
+        print(f"{total:>14} {per_call * 1e6:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Micro-benchmark for the history read path.
+
+Compares, per 1,000 rows, the CPU time of the former ORM read path
+(entities hydrated, copied into ``MessageSchema`` and validated again by
+the response model) with the Core path used by ``get_messages`` (plain
+tuples written straight to JSON bytes). Runs against an in-memory SQLite
+database, so the numbers are mostly Python overhead.
+
+Run from the repository root:
+
+    python benchmarks/bench_read_path.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic import TypeAdapter  # noqa: E402
+from sqlalchemy import insert, select  # noqa: E402
+from sqlalchemy.ext.asyncio import (  # noqa: E402
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from ppback.db.ppdb_schemas import Base, ConvoMessage  # noqa: E402
+from ppback.ppschema import MessageSchema  # noqa: E402
+
+ROWS = int(os.getenv("BENCH_ROWS", "1000"))
+ROUNDS = int(os.getenv("BENCH_ROUNDS", "50"))
+
+page_adapter = TypeAdapter(List[MessageSchema])
+
+
+async def orm_path(session) -> bytes:
+    results = (await session.execute(select(ConvoMessage))).scalars().all()
+    page = [
+        MessageSchema(
+            id=msg.id,
+            content=msg.content,
+            sender=msg.sender_id,
+            message_type=msg.message_type,
+            ts=msg.ts,
+        )
+        for msg in results
+    ]
+    return page_adapter.dump_json(page_adapter.validate_python(page))
+
+
+async def core_path(session) -> bytes:
+    rows = await session.execute(
+        select(
+            ConvoMessage.id,
+            ConvoMessage.content,
+            ConvoMessage.sender_id,
+            ConvoMessage.message_type,
+            ConvoMessage.ts,
+        )
+    )
+    return json.dumps(
+        [
+            {
+                "id": msg_id,
+                "content": content,
+                "sender": sender_id,
+                "message_type": message_type,
+                "ts": ts,
+            }
+            for msg_id, content, sender_id, message_type, ts in rows
+        ],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode()
+
+
+async def bench(path) -> float:
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, checkfirst=False)
+        await conn.execute(
+            insert(ConvoMessage.__table__),
+            [
+                {
+                    "conv_id": 1,
+                    "sender_id": 1,
+                    "ts": float(i),
+                    "message_type": "text",
+                    "content": f"message number {i}",
+                }
+                for i in range(ROWS)
+            ],
+        )
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessions() as session:
+        await path(session)
+        start = time.process_time()
+        for _ in range(ROUNDS):
+            await path(session)
+            session.expunge_all()
+        elapsed = time.process_time() - start
+    await engine.dispose()
+    return elapsed / ROUNDS * 1000 / ROWS
+
+
+def main() -> None:
+    print(f"rows={ROWS} rounds={ROUNDS}")
+    print(f"{'path':>6} {'CPU ms / 1000 rows':>20}")
+    for name, path in (("orm", orm_path), ("core", core_path)):
+        print(f"{name:>6} {asyncio.run(bench(path)) * 1e3:>20.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi_cache.types import Backend
+
+from ppback.config import (
+    CACHE_MAX_BYTES,
+    CACHE_MAX_ENTRIES,
+    CACHE_STALE_S,
+    CACHE_SWEEP_S,
+    CACHE_TTL_S,
+)
+from ppback.middleware.metrics import (
+    CACHE_BYTES,
+    CACHE_ENTRIES,
+    CACHE_EVICTIONS,
+    CACHE_HITS,
+    CACHE_L2_LOOKUPS,
+    CACHE_MISSES,
+    CACHE_STALE_SERVED,
+)
+
+logger = logging.getLogger("ppback.cachebackend")
+
+# Rough per-entry overhead of the key string, the entry and the dict slot.
+_ENTRY_OVERHEAD = 200
+# How long the request refreshing a stale entry holds its claim; if it
+# fails, the next request after that refreshes instead.
+_REFRESH_CLAIM_S = 5.0
+
+
+def namespace_of(key: str) -> str:
+    """Metrics label of a cache key: the cached function's name.
+
+    ``dbfuncs.key_builder`` builds ``prefix:namespace:function:args...``.
+    """
+    parts = key.split(":", 3)
+    return parts[2] if len(parts) > 2 and parts[2] else "default"
+
+
+class _Entry:
+    __slots__ = ("data", "expires_at", "size", "namespace", "refresh_claimed_until")
+
+    def __init__(self, data: bytes, expires_at: float, size: int, namespace: str):
+        self.data = data
+        self.expires_at = expires_at
+        self.size = size
+        self.namespace = namespace
+        self.refresh_claimed_until = 0.0
+
+
+class BoundedMemoryBackend(Backend):
+    """In-process fastapi-cache backend with an entry and byte budget.
+
+    Entries are kept in least recently used order; a ``set`` that goes
+    over ``max_entries`` or ``max_bytes`` evicts from the cold end.
+    Expired entries are dropped when read and by a sweep of the whole
+    store every ``sweep_interval`` seconds, run from ``set`` so no
+    background task is needed.
+
+    With ``stale_s``, an entry is kept that long past its expiry
+    (stale-while-revalidate): the first reader gets a miss, for which
+    ``single_flight`` serves ``get_stale`` and refreshes the entry in the
+    background, and everyone else is served the stale value meanwhile.
+    Tag invalidation still deletes entries outright, so only data no
+    write has touched is ever served stale.
+
+    Entries, bytes, hits, misses and evictions are exported per namespace
+    (the cached function) on ``/metrics``. Keys dropped by eviction or
+    by the sweep, or refused as too big, are passed to ``removal_listener``;
+    a write for which ``tags_for_write`` answers None is skipped.
+    A lock guards the store, as the test client runs requests on several
+    event loops.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES,
+        sweep_interval: float = CACHE_SWEEP_S,
+        stale_s: float = CACHE_STALE_S,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.stale_s = stale_s
+        self.nbytes = 0
+        self.entries: OrderedDict[str, _Entry] = OrderedDict()
+        self.sizes: Dict[str, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._removed: List[str] = []
+        self.removal_listener: Callable[[List[str]], Awaitable[Any]] | None = None
+        self.tags_for_write: Callable[[str], Tuple[str, ...] | None] | None = None
+
+    def _get(self, key: str, now: float) -> Optional[_Entry]:
+        entry = self.entries.get(key)
+        if entry is None:
+            CACHE_MISSES.labels(namespace=namespace_of(key)).inc()
+            return None
+        if entry.expires_at <= now:
+            if now >= entry.expires_at + self.stale_s:
+                # Not reported: the reader is about to refill the key.
+                self._remove(key, entry, "expired", report=False)
+                CACHE_MISSES.labels(namespace=entry.namespace).inc()
+                return None
+            if now >= entry.refresh_claimed_until:
+                entry.refresh_claimed_until = now + _REFRESH_CLAIM_S
+                CACHE_MISSES.labels(namespace=entry.namespace).inc()
+                return None
+            CACHE_STALE_SERVED.labels(namespace=entry.namespace).inc()
+        self.entries.move_to_end(key)
+        CACHE_HITS.labels(namespace=entry.namespace).inc()
+        return entry
+
+    async def get_with_ttl(self, key: str) -> Tuple[int, Optional[bytes]]:
+        with self._lock:
+            now = time.monotonic()
+            entry = self._get(key, now)
+            ttl = 0 if entry is None else max(0, int(entry.expires_at - now))
+        await self._report_removed()
+        return (0, None) if entry is None else (ttl, entry.data)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._get(key, time.monotonic())
+        await self._report_removed()
+        return None if entry is None else entry.data
+
+    async def get_stale(self, key: str) -> Optional[bytes]:
+        """The value of an expired entry still within ``stale_s``, if any."""
+        with self._lock:
+            entry = self.entries.get(key)
+            now = time.monotonic()
+            if entry is None or now < entry.expires_at:
+                return None
+            if now >= entry.expires_at + self.stale_s:
+                return None
+            return entry.data
+
+    async def set(self, key: str, value: bytes, expire: Optional[int] = None) -> None:
+        if self.tags_for_write is not None and self.tags_for_write(key) is None:
+            return
+        await self._set(key, value, expire)
+        await self._report_removed()
+
+    async def _set(self, key: str, value: bytes, expire: Optional[int]) -> None:
+        size = len(key) + len(value) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            logger.debug("not caching %s: %d bytes is over the budget", key, size)
+            with self._lock:
+                self._removed.append(key)
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep(now)
+            previous = self.entries.get(key)
+            if previous is not None:
+                self._remove(key, previous, None)
+            entry = _Entry(value, now + (expire or 0), size, namespace_of(key))
+            self.entries[key] = entry
+            self._account(entry.namespace, 1, size)
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                cold_key, cold = next(iter(self.entries.items()))
+                self._remove(cold_key, cold, "lru")
+
+    async def clear(
+        self, namespace: Optional[str] = None, key: Optional[str] = None
+    ) -> int:
+        with self._lock:
+            if namespace:
+                keys = [k for k in self.entries if k.startswith(namespace)]
+            elif key:
+                keys = [key] if key in self.entries else []
+            else:
+                return 0
+            for k in keys:
+                self._remove(k, self.entries[k], None)
+            return len(keys)
+
+    def _sweep(self, now: float) -> None:
+        expired = [
+            (k, e)
+            for k, e in self.entries.items()
+            if e.expires_at + self.stale_s <= now
+        ]
+        for k, entry in expired:
+            self._remove(k, entry, "expired")
+        self._next_sweep = now + self.sweep_interval
+        if expired:
+            logger.debug("swept %d expired cache entries", len(expired))
+
+    def _remove(
+        self, key: str, entry: _Entry, reason: str | None, report: bool = True
+    ) -> None:
+        del self.entries[key]
+        self._account(entry.namespace, -1, -entry.size)
+        if reason is not None:
+            CACHE_EVICTIONS.labels(namespace=entry.namespace, reason=reason).inc()
+            if report:
+                self._removed.append(key)
+
+    async def _report_removed(self) -> None:
+        if not self._removed:
+            return
+        with self._lock:
+            removed, self._removed = self._removed, []
+        if removed and self.removal_listener is not None:
+            await self.removal_listener(removed)
+
+    def _account(self, namespace: str, entries: int, nbytes: int) -> None:
+        count, size = self.sizes.get(namespace, (0, 0))
+        count, size = count + entries, size + nbytes
+        self.sizes[namespace] = (count, size)
+        self.nbytes += nbytes
+        CACHE_ENTRIES.labels(namespace=namespace).set(count)
+        CACHE_BYTES.labels(namespace=namespace).set(size)
+
+
+# SPOP with a count above the set's size pops the whole set.
+_SPOP_ALL = 2**31 - 1
+
+
+class RedisTagIndex:
+    """The keys stored under each cache tag, kept in the L2 Redis.
+
+    Every tag is a Redis set of its keys, so an invalidation finds each L2
+    copy, including those cached by workers that have restarted since and
+    lost their in-memory registry.
+    """
+
+    def __init__(self, redis: Any, prefix: str = "fastapi-cache-tag:"):
+        self.redis = redis
+        self.prefix = prefix
+
+    async def add(self, key: str, tags: Tuple[str, ...], expire: Optional[int]) -> None:
+        for tag in tags:
+            await self.redis.sadd(self.prefix + tag, key)
+            if expire:
+                # The keys of a tag share one TTL, so the newest covers all.
+                await self.redis.expire(self.prefix + tag, expire)
+
+    async def pop(self, tags: Iterable[str]) -> List[str]:
+        """Take the keys of ``tags`` out of the index, atomically per tag."""
+        keys: List[str] = []
+        for tag in tags:
+            popped = await self.redis.spop(self.prefix + tag, _SPOP_ALL)
+            keys.extend(
+                k.decode() if isinstance(k, bytes) else k for k in popped or ()
+            )
+        return keys
+
+
+class TwoTierBackend(Backend):
+    """A per-process L1 in front of an L2 shared by every worker.
+
+    Reads try the L1, then the L2, and copy an L2 hit into the L1 for the
+    rest of its TTL, so a key costs one database query for the whole
+    deployment rather than one per worker. Writes and deletes go to both
+    tiers. Invalidation reaches the other workers through the
+    ``invalidate`` bus events of ``ppback.cachetags``; each one drops the
+    keys it has registered from its L1.
+
+    The L2 keys of each tag are listed in ``index`` as they are written, so
+    ``clear_tags`` deletes every L2 copy of a tag, whichever worker cached
+    it, even one whose registry a restart has emptied.
+
+    An unreachable L2 is treated as a miss: the request falls back to the
+    database instead of failing, and a failed delete is logged so the
+    invalidation still reaches the L1 and the bus.
+    """
+
+    def __init__(
+        self,
+        l1: BoundedMemoryBackend,
+        l2: Backend,
+        index: RedisTagIndex | None = None,
+    ):
+        self.l1 = l1
+        self.l2 = l2
+        self.index = index
+        self.removal_listener: Callable[[List[str]], Awaitable[Any]] | None = None
+        self.tags_for_write: Callable[[str], Tuple[str, ...] | None] | None = None
+        l1.removal_listener = self._l1_removed
+
+    async def _l1_removed(self, keys: List[str]) -> None:
+        if self.removal_listener is not None:
+            await self.removal_listener(keys)
+
+    def _tags(self, key: str) -> Tuple[str, ...] | None:
+        return () if self.tags_for_write is None else self.tags_for_write(key)
+
+    async def get_with_ttl(self, key: str) -> Tuple[int, Optional[bytes]]:
+        ttl, data = await self.l1.get_with_ttl(key)
+        if data is not None:
+            return ttl, data
+        try:
+            ttl, data = await self.l2.get_with_ttl(key)
+        except Exception:
+            logger.warning("L2 cache read failed for %s", key, exc_info=True)
+            CACHE_L2_LOOKUPS.labels(namespace=namespace_of(key), result="error").inc()
+            return 0, None
+        result = "miss" if data is None else "hit"
+        CACHE_L2_LOOKUPS.labels(namespace=namespace_of(key), result=result).inc()
+        if data is None:
+            return 0, None
+        # Redis reports -1 for a key without expiry.
+        ttl = ttl if ttl > 0 else CACHE_TTL_S
+        # Not if the key was invalidated while the L2 was read.
+        if self._tags(key) is not None:
+            await self.l1.set(key, data, ttl)
+        return ttl, data
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return (await self.get_with_ttl(key))[1]
+
+    async def get_stale(self, key: str) -> Optional[bytes]:
+        return await self.l1.get_stale(key)
+
+    async def set(self, key: str, value: bytes, expire: Optional[int] = None) -> None:
+        tags = self._tags(key)
+        if tags is None:
+            return
+        # Indexed first, so no L2 entry escapes its tags' invalidation.
+        try:
+            if self.index is not None and tags:
+                await self.index.add(key, tags, expire)
+            await self.l2.set(key, value, expire)
+        except Exception:
+            logger.warning("L2 cache write failed for %s", key, exc_info=True)
+        await self.l1.set(key, value, expire)
+
+    async def clear(
+        self, namespace: Optional[str] = None, key: Optional[str] = None
+    ) -> int:
+        dropped = await self.l1.clear(namespace, key)
+        try:
+            return max(dropped, await self.l2.clear(namespace, key))
+        except Exception:
+            # The L2 copy outlives this delete until its TTL runs out.
+            logger.warning(
+                "L2 cache delete failed for %s", key or namespace, exc_info=True
+            )
+            return dropped
+
+    async def clear_tags(self, tags: Iterable[str]) -> int:
+        """Delete the entries of ``tags`` from both tiers, as indexed in the L2."""
+        if self.index is None:
+            return 0
+        try:
+            keys = await self.index.pop(tags)
+        except Exception:
+            logger.warning("L2 tag index read failed for %s", tags, exc_info=True)
+            return 0
+        dropped = 0
+        for key in keys:
+            dropped += await self.clear(key=key)
+        return dropped
+
+
+def create_cache_backend(
+    l2_url: str = "", bus_backend: str = "inprocess"
+) -> Backend:
+    """Build the query cache selected by ``PPBACK_CACHE_L2_URL``.
+
+    The L2 is shared, so invalidations must reach every worker's L1 through
+    the ``postgres`` bus; the ``inprocess`` bus would leave them stale.
+    """
+    if not l2_url:
+        return BoundedMemoryBackend()
+    if not l2_url.startswith(("redis://", "rediss://", "unix://")):
+        raise ValueError(f"unsupported L2 cache url {l2_url!r}")
+    if bus_backend != "postgres":
+        raise ValueError(
+            "the L2 cache needs the postgres websocket bus (PPBACK_WS_BUS)"
+        )
+    from fastapi_cache.backends.redis import RedisBackend
+    from redis.asyncio import from_url
+
+    redis = from_url(l2_url)
+    return TwoTierBackend(
+        BoundedMemoryBackend(), RedisBackend(redis), RedisTagIndex(redis)
+    )
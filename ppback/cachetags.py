@@ -0,0 +1,197 @@
+import inspect
+import logging
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi_cache import FastAPICache
+
+from ppback.singleflight import singleflight
+from ppback.wsocket import inmemsockets
+
+logger = logging.getLogger("ppback.cachetags")
+
+USERS_TAG = "users"
+
+# Invalidated tags remembered for misses still running; older ones are
+# folded into ``CacheTags.floor``.
+_INVALIDATIONS_KEPT = 10_000
+
+# The key built last in this task, with its tags, the invalidation
+# sequence at that time (None: never store it) and the cached function.
+_building: ContextVar[
+    Optional[Tuple[str, Tuple[str, ...], Optional[int], Callable]]
+] = ContextVar("cache_key_building", default=None)
+
+
+def user_tag(user_id: int) -> str:
+    """Entries read from the ``UserInfo`` row of ``user_id``."""
+    return f"user:{user_id}"
+
+
+def member_tag(user_id: int) -> str:
+    """Entries read from the conversation memberships of ``user_id``."""
+    return f"member:{user_id}"
+
+
+def conv_tag(conv_id: int) -> str:
+    """Entries read from the member rows and roles of ``conv_id``."""
+    return f"conv:{conv_id}"
+
+
+def cache_tags(*templates: str) -> Callable:
+    """Declare the tags of a ``@cache`` function's entries.
+
+    Templates are formatted with the call's arguments, e.g.
+    ``"conv:{convo_id}"``; ``key_builder`` registers each key it builds
+    under them. Goes below ``@cache`` so the tags sit on the function the
+    decorator hands to the key builder.
+    """
+
+    def decorate(func: Callable) -> Callable:
+        func.__cache_tags__ = (inspect.signature(func), templates)
+        return func
+
+    return decorate
+
+
+class CacheTags:
+    """Which fastapi-cache keys depend on which users and conversations.
+
+    Writes drop exactly the keys tagged with what they changed, so cached
+    memberships, roles and user rows are never served stale and the TTL
+    only bounds memory. Invalidations go out on the bus as well, so with
+    the ``postgres`` bus every worker drops its copy.
+
+    A key is registered the first time it is built, i.e. on its miss, and
+    forgotten when its tags are invalidated or when the backend evicts or
+    expires it (``track``), so the registry stays as bounded as the cache.
+
+    A miss that was already running when one of its tags was invalidated
+    may have read the rows before the write, so the backend does not store
+    its result (``tags_for_write``).
+    """
+
+    def __init__(self):
+        self.keys: Dict[str, Set[str]] = {}
+        self.tags_of: Dict[str, Tuple[str, ...]] = {}
+        self.seq = 0
+        self.invalidated: OrderedDict[str, int] = OrderedDict()
+        self.floor = 0
+        self.backend: Any = None
+
+    def clear(self) -> None:
+        self.keys.clear()
+        self.tags_of.clear()
+
+    def track(self, backend: Any) -> None:
+        """Start over with ``backend``, forgetting the keys it removes."""
+        self.clear()
+        self.backend = backend
+        backend.removal_listener = self.forget
+        backend.tags_for_write = self.tags_for_write
+
+    def register(self, key: str, func: Callable, args: Any, kwargs: Any) -> None:
+        tags = self.tags_of.get(key)
+        if tags is None:
+            spec = getattr(func, "__cache_tags__", None)
+            if spec is None:
+                return
+            signature, templates = spec
+            arguments = signature.bind(*args, **kwargs).arguments
+            tags = tuple(template.format(**arguments) for template in templates)
+            self.tags_of[key] = tags
+            for tag in tags:
+                self.keys.setdefault(tag, set()).add(key)
+        _building.set((key, tags, self.seq, func))
+
+    def building(self, func: Callable) -> Optional[str]:
+        """The key ``key_builder`` built last in this task for ``func``."""
+        building = _building.get()
+        if building is None or building[3] is not func:
+            return None
+        return building[0]
+
+    def skip_write(self, key: str) -> None:
+        """Keep this task's result for ``key`` out of the cache."""
+        building = _building.get()
+        if building is not None and building[0] == key:
+            _building.set((key, building[1], None, building[3]))
+
+    def tags_for_write(self, key: str) -> Optional[Tuple[str, ...]]:
+        """Tags to store ``key`` under, or None if its value is outdated.
+
+        That is the case when one of its tags was invalidated since this
+        task built the key, i.e. while its miss ran.
+        """
+        building = _building.get()
+        if building is None or building[0] != key:
+            return self.tags_of.get(key, ())
+        _key, tags, seq, _func = building
+        if (
+            seq is None
+            or self.floor > seq
+            or any(self.invalidated.get(tag, 0) > seq for tag in tags)
+        ):
+            logger.debug("not caching %s: invalidated during its miss", key)
+            return None
+        return tags
+
+    def _bump(self, tags: Iterable[str]) -> None:
+        self.seq += 1
+        for tag in tags:
+            self.invalidated[tag] = self.seq
+            self.invalidated.move_to_end(tag)
+        while len(self.invalidated) > _INVALIDATIONS_KEPT:
+            _tag, self.floor = self.invalidated.popitem(last=False)
+
+    async def forget(self, keys: Iterable[str]) -> None:
+        """Unregister ``keys``, which the backend no longer holds."""
+        for key in keys:
+            for tag in self.tags_of.pop(key, ()):
+                tagged = self.keys.get(tag)
+                if tagged is not None:
+                    tagged.discard(key)
+                    if not tagged:
+                        del self.keys[tag]
+
+    async def drop(self, tags: Iterable[str]) -> int:
+        """Delete the local entries tagged with any of ``tags``."""
+        tags = list(tags)
+        singleflight.invalidate()
+        self._bump(tags)
+        keys: Set[str] = set()
+        for tag in tags:
+            keys |= self.keys.get(tag, set())
+        if not keys:
+            return 0
+        await self.forget(keys)
+        backend = FastAPICache.get_backend()
+        dropped = 0
+        for key in keys:
+            try:
+                dropped += await backend.clear(key=key)
+            except KeyError:
+                pass  # already expired and evicted by the backend
+        logger.debug("dropped %d cache entries for %s", dropped, tags)
+        return dropped
+
+    async def drop_all(self) -> int:
+        """Drop every registered entry, e.g. after missed invalidations."""
+        # Any tag may have been invalidated, even one with no key yet.
+        self.seq += 1
+        self.floor = self.seq
+        return await self.drop(list(self.keys))
+
+    async def invalidate(self, tags: List[str]) -> None:
+        """Drop ``tags`` here and from a shared L2, then in every other worker."""
+        await self.drop(tags)
+        clear_tags = getattr(self.backend, "clear_tags", None)
+        if clear_tags is not None:
+            await clear_tags(tags)
+        await inmemsockets.cache_invalidated(tags)
+
+
+cachetags = CacheTags()
+inmemsockets.add_invalidation_listener(cachetags.drop)
+inmemsockets.add_reset_listener(cachetags.drop_all)
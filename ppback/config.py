@@ -20,6 +20,40 @@ AUTO_INIT_DB = os.getenv("PPBACK_AUTO_INIT_DB", "1").lower() not in {
     "false",
     "no",
 }
+WS_BUS_BACKEND = os.getenv("PPBACK_WS_BUS", "inprocess")
+WS_SEND_QUEUE_SIZE = int(os.getenv("PPBACK_WS_SEND_QUEUE", "64"))
+WS_SEND_TIMEOUT_S = float(os.getenv("PPBACK_WS_SEND_TIMEOUT_S", "1"))
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("PPBACK_WS_REPLAY_BUFFER", "256"))
+WS_REPLAY_BUFFER_CONVS = int(os.getenv("PPBACK_WS_REPLAY_CONVS", "2048"))
+WS_REPLAY_DB_LIMIT = int(os.getenv("PPBACK_WS_REPLAY_DB_LIMIT", "500"))
+# The hot tail and ETag validators are fed by bus events, so they are only
+# exact when the bus reaches every worker (or there is a single worker).
+BUS_FED_CACHES = os.getenv(
+    "PPBACK_BUS_FED_CACHES", "1" if WS_BUS_BACKEND == "postgres" else "0"
+).lower() in {"1", "true", "yes"}
+HOT_TAIL_SIZE = int(os.getenv("PPBACK_HOT_TAIL_SIZE", "256"))
+HOT_TAIL_BUDGET_BYTES = int(os.getenv("PPBACK_HOT_TAIL_BYTES", str(32 * 1024 * 1024)))
+HISTORY_PAGE_SIZE = int(os.getenv("PPBACK_HISTORY_PAGE_SIZE", "100"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("PPBACK_HISTORY_MAX_PAGE_SIZE", "1000"))
+LONGPOLL_MAX_WAIT_S = float(os.getenv("PPBACK_LONGPOLL_MAX_S", "30"))
+# Invalidations only reach other workers over the postgres bus; without it
+# the TTL is what bounds their stale entries.
+CACHE_TTL_S = int(
+    os.getenv("PPBACK_CACHE_TTL_S", "3600" if WS_BUS_BACKEND == "postgres" else "300")
+)
+CACHE_MAX_ENTRIES = int(os.getenv("PPBACK_CACHE_MAX_ENTRIES", "100000"))
+CACHE_MAX_BYTES = int(os.getenv("PPBACK_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_SWEEP_S = float(os.getenv("PPBACK_CACHE_SWEEP_S", "60"))
+CACHE_STALE_S = float(os.getenv("PPBACK_CACHE_STALE_S", "0"))
+CACHE_L2_URL = os.getenv("PPBACK_CACHE_L2_URL", "")
+RENDERED_CACHE_BYTES = int(os.getenv("PPBACK_RENDERED_CACHE_BYTES", str(16 * 1024 * 1024)))
+MESSAGE_BATCH_ENABLED = os.getenv("PPBACK_MESSAGE_BATCH", "0").lower() in {
+    "1",
+    "true",
+    "yes",
+}
+MESSAGE_BATCH_MAX_ROWS = int(os.getenv("PPBACK_MESSAGE_BATCH_ROWS", "64"))
+MESSAGE_BATCH_DELAY_MS = float(os.getenv("PPBACK_MESSAGE_BATCH_MS", "5"))
 
 
 ASYNC_DB_SESSION_STR = to_async_db_url(DB_SESSION_STR)
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from typing import Any, Dict, List
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from ppback.config import MESSAGE_BATCH_DELAY_MS, MESSAGE_BATCH_MAX_ROWS, SessionLocal
+from ppback.db.ppdb_schemas import ConvoMessage
+from ppback.middleware.metrics import MESSAGE_BATCH_ROWS
+
+logger = logging.getLogger("ppback.db.batcher")
+
+
+class _Batch:
+    __slots__ = ("rows", "futures", "full")
+
+    def __init__(self):
+        self.rows: List[Dict[str, Any]] = []
+        self.futures: List[asyncio.Future] = []
+        self.full = asyncio.Event()
+
+
+class MessageBatcher:
+    """Group commit for ``convomessage`` inserts.
+
+    The first row submitted opens a batch and schedules its flush; rows
+    submitted while it is open join it. A batch is written with a single
+    multi-row ``INSERT ... RETURNING id`` and one commit, either ``max_delay``
+    seconds after it opened or as soon as it holds ``max_rows`` rows, and
+    every submitter then gets its own message id back. If the write fails,
+    every submitter of the batch gets the exception.
+
+    Batches are kept per event loop, so the batcher needs no long-lived
+    background task.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession] = SessionLocal,
+        max_rows: int = MESSAGE_BATCH_MAX_ROWS,
+        max_delay: float = MESSAGE_BATCH_DELAY_MS / 1000,
+    ):
+        self.session_factory = session_factory
+        self.max_rows = max(1, max_rows)
+        self.max_delay = max_delay
+        self._open: Dict[asyncio.AbstractEventLoop, _Batch] = {}
+        self._flushes: set[asyncio.Task] = set()
+
+    async def insert(
+        self, conv_id: int, sender_id: int, content: str, ts: float,
+        message_type: str = "text",
+    ) -> int:
+        """Queue one message row and wait until it is committed; returns its id."""
+        loop = asyncio.get_running_loop()
+        batch = self._open.get(loop)
+        if batch is None:
+            batch = _Batch()
+            self._open[loop] = batch
+            task = loop.create_task(self._flush_later(loop, batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+        future = loop.create_future()
+        batch.rows.append(
+            {
+                "conv_id": conv_id,
+                "sender_id": sender_id,
+                "content": content,
+                "ts": ts,
+                "message_type": message_type,
+            }
+        )
+        batch.futures.append(future)
+        if len(batch.rows) >= self.max_rows:
+            self._close(loop, batch)
+            batch.full.set()
+        # The flush owns the write: a cancelled caller must not abort it.
+        return await asyncio.shield(future)
+
+    def _close(self, loop: asyncio.AbstractEventLoop, batch: _Batch) -> None:
+        if self._open.get(loop) is batch:
+            del self._open[loop]
+
+    async def _flush_later(self, loop: asyncio.AbstractEventLoop, batch: _Batch) -> None:
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.max_delay)
+        except asyncio.TimeoutError:
+            pass
+        self._close(loop, batch)
+        await self._flush(batch)
+
+    async def _flush(self, batch: _Batch) -> None:
+        MESSAGE_BATCH_ROWS.observe(len(batch.rows))
+        try:
+            async with self.session_factory() as session:
+                result = await session.execute(
+                    insert(ConvoMessage).returning(
+                        ConvoMessage.id, sort_by_parameter_order=True
+                    ),
+                    batch.rows,
+                )
+                ids = list(result.scalars())
+                await session.commit()
+        except Exception as exc:
+            logger.exception("failed to write a batch of %s messages", len(batch.rows))
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for future, message_id in zip(batch.futures, ids):
+            if not future.done():
+                future.set_result(message_id)
+
+
+messagebatcher = MessageBatcher()
@@ -1,17 +1,39 @@
 import time
 from logging import getLogger
-from typing import Any, Callable
+from typing import Any, AsyncIterator, Callable, Sequence
 
 from fastapi_cache import KeyBuilder
 from fastapi_cache.decorator import cache
 from opentelemetry import trace
-from ppback.ppschema import ConversationItem, ConversationList
-from sqlalchemy import func, or_, select
+from ppback.cachetags import (
+    USERS_TAG,
+    cache_tags,
+    cachetags,
+    conv_tag,
+    member_tag,
+    user_tag,
+)
+from ppback.config import CACHE_TTL_S
+from ppback.ppschema import ConversationList, MessageSchema
+from ppback.singleflight import single_flight
+from sqlalchemy import (
+    Row,
+    case,
+    func,
+    insert,
+    literal,
+    or_,
+    select,
+    union,
+    update,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
 from ppback.db.ppdb_schemas import (
     Conv,
     ConvMember,
+    ConvoMessage,
     FriendRequest,
     Friendship,
     InviteCode,
@@ -22,6 +44,8 @@ from ppback.secu.sec_utils import get_hashed_password
 tracer = trace.get_tracer(__name__)
 logger = getLogger("ppback.db.dbfuncs")
 
+WRITE_ROLES = ("owner", "admin", "member")
+
 
 def key_builder(
     func: Callable, namespace: str = "", *, request: Any, response: Any, args, kwargs
@@ -34,6 +58,7 @@ def key_builder(
         if k != "session":
             values.append(str(v))
     cache_key = ":".join(values)
+    cachetags.register(cache_key, func, args, kwargs)
     logger.debug(f"Cache key built: {cache_key}")
     return cache_key
 
@@ -50,6 +75,7 @@ async def add_users(
         await session.commit()
         await session.refresh(u)
         allu.append(u)
+    await cachetags.invalidate([USERS_TAG] + [user_tag(u.id) for u in allu])
     return allu
 
 
@@ -69,35 +95,38 @@ async def create_convo(
         cm = ConvMember(conv_id=c1.id, user_id=user.id, role=role)
         session.add(cm)
     await session.commit()
+    await cachetags.invalidate(
+        [conv_tag(c1.id)] + [member_tag(user.id) for user in users]
+    )
     return (int(c1.id), str(c1.label))
 
 
-@cache(300, key_builder=key_builder)
+@cache(CACHE_TTL_S, key_builder=key_builder)
+@cache_tags("member:{user_id}")
+@single_flight
 async def _get_conversation_list_for_user_cached(
     session: AsyncSession, user_id: int
 ) -> dict[str, Any]:
     logger.debug(f"Fetching conversations for user {user_id}")
     with tracer.start_as_current_span("get_conversation_list_for_user_db"):
-        convs = (
-            (
-                await session.execute(
-                    select(Conv.id, Conv.label)
-                    .join(ConvMember, Conv.id == ConvMember.conv_id)
-                    .where(ConvMember.user_id == user_id)
-                )
-            )
-            .all()
+        mine = aliased(ConvMember)
+        rows = await session.execute(
+            select(Conv.id, Conv.label, ConvMember.user_id)
+            .join(mine, (mine.conv_id == Conv.id) & (mine.user_id == user_id))
+            .join(ConvMember, ConvMember.conv_id == Conv.id)
+            .order_by(Conv.id, ConvMember.id)
         )
-        conversations = []
-        for c in convs:
-            members_query = await session.execute(
-                select(ConvMember.user_id).where(ConvMember.conv_id == c.id)
-            )
-            members = list(members_query.scalars().all())
-            conversations.append(
-                ConversationItem(id=c.id, label=c.label, members=members).model_dump()
-            )
-        return {"conversations": conversations}
+        conversations: dict[int, dict[str, Any]] = {}
+        for conv_id, label, member_id in rows:
+            conv = conversations.get(conv_id)
+            if conv is None:
+                conv = conversations[conv_id] = {
+                    "id": conv_id,
+                    "label": label,
+                    "members": [],
+                }
+            conv["members"].append(member_id)
+        return {"conversations": list(conversations.values())}
 
 
 async def get_conversation_list_for_user(
@@ -107,7 +136,154 @@ async def get_conversation_list_for_user(
     return ConversationList.model_validate(cached_value)
 
 
-@cache(300, key_builder=key_builder)
+async def get_conversation_list_payload(
+    session: AsyncSession, user_id: int
+) -> dict[str, Any]:
+    """The cached ``ConversationList`` as plain dicts, for direct JSON output."""
+    return await _get_conversation_list_for_user_cached(session, user_id)
+
+
+async def conv_ids_for_user(session: AsyncSession, user_id: int) -> list[int]:
+    with tracer.start_as_current_span("conv_ids_for_user_db"):
+        result = await session.execute(
+            select(ConvMember.conv_id).where(ConvMember.user_id == user_id)
+        )
+        return list(result.scalars().all())
+
+
+async def latest_message_id(session: AsyncSession, conv_id: int) -> int:
+    """Newest message id of ``conv_id``, ``0`` for an empty conversation."""
+    with tracer.start_as_current_span("latest_message_id_db"):
+        result = await session.execute(
+            select(func.max(ConvoMessage.id)).where(ConvoMessage.conv_id == conv_id)
+        )
+        return result.scalar_one() or 0
+
+
+async def latest_message_ids(
+    session: AsyncSession, conv_ids: list[int]
+) -> dict[int, int]:
+    """Newest message id of each of ``conv_ids``, ``0`` for empty ones."""
+    with tracer.start_as_current_span("latest_message_ids_db"):
+        result = await session.execute(
+            select(ConvoMessage.conv_id, func.max(ConvoMessage.id))
+            .where(ConvoMessage.conv_id.in_(conv_ids))
+            .group_by(ConvoMessage.conv_id)
+        )
+        heads = dict.fromkeys(conv_ids, 0)
+        heads.update(result.all())
+        return heads
+
+
+async def unread_counts(session: AsyncSession, user_id: int) -> dict[int, int]:
+    """Messages from others past the user's read cursor, per conversation.
+
+    One query; each conversation is a range scan of the ``(conv_id, id)``
+    index above ``last_read_id``, so the cost follows unread messages, not
+    history length. Conversations with nothing unread are left out.
+    """
+    with tracer.start_as_current_span("unread_counts_db"):
+        result = await session.execute(
+            select(ConvMember.conv_id, func.count(ConvoMessage.id))
+            .join(
+                ConvoMessage,
+                (ConvoMessage.conv_id == ConvMember.conv_id)
+                & (ConvoMessage.id > ConvMember.last_read_id)
+                & (ConvoMessage.sender_id != user_id),
+            )
+            .where(ConvMember.user_id == user_id)
+            .group_by(ConvMember.conv_id)
+        )
+        return dict(result.all())
+
+
+async def mark_read(
+    session: AsyncSession, user_id: int, conv_id: int, message_id: int
+) -> None:
+    """Move the user's read cursor forward to ``message_id``; never backwards."""
+    with tracer.start_as_current_span("mark_read_db"):
+        await session.execute(
+            update(ConvMember)
+            .where(
+                (ConvMember.user_id == user_id)
+                & (ConvMember.conv_id == conv_id)
+                & (ConvMember.last_read_id < message_id)
+            )
+            .values(last_read_id=message_id)
+        )
+        await session.commit()
+
+
+async def get_messages_after(
+    session: AsyncSession, conv_id: int, after: int, limit: int
+) -> list[MessageSchema]:
+    with tracer.start_as_current_span("get_messages_after_db"):
+        result = await session.execute(
+            select(ConvoMessage)
+            .where((ConvoMessage.conv_id == conv_id) & (ConvoMessage.id > after))
+            .order_by(ConvoMessage.id)
+            .limit(limit)
+        )
+        return [
+            MessageSchema(
+                id=msg.id,
+                content=msg.content,
+                sender=msg.sender_id,
+                message_type=msg.message_type,
+                ts=msg.ts,
+            )
+            for msg in result.scalars().all()
+        ]
+
+
+async def get_messages_by_ids(
+    session: AsyncSession, message_ids: Sequence[int]
+) -> dict[int, MessageSchema]:
+    with tracer.start_as_current_span("get_messages_by_ids_db"):
+        result = await session.execute(
+            select(ConvoMessage).where(ConvoMessage.id.in_(message_ids))
+        )
+        return {
+            msg.id: MessageSchema(
+                id=msg.id,
+                content=msg.content,
+                sender=msg.sender_id,
+                message_type=msg.message_type,
+                ts=msg.ts,
+            )
+            for msg in result.scalars().all()
+        }
+
+
+async def stream_messages(
+    session: AsyncSession, conv_id: int, chunk_rows: int
+) -> AsyncIterator[Sequence[Row]]:
+    """Yield every message of ``conv_id`` in id order, ``chunk_rows`` at a time.
+
+    Rows come through a server-side cursor as plain ``(id, content,
+    sender_id, message_type, ts)`` tuples, so memory stays bounded by one
+    chunk whatever the size of the conversation.
+    """
+    with tracer.start_as_current_span("stream_messages_db"):
+        result = await session.stream(
+            select(
+                ConvoMessage.id,
+                ConvoMessage.content,
+                ConvoMessage.sender_id,
+                ConvoMessage.message_type,
+                ConvoMessage.ts,
+            )
+            .where(ConvoMessage.conv_id == conv_id)
+            .order_by(ConvoMessage.id)
+            .execution_options(yield_per=chunk_rows)
+        )
+        async for rows in result.partitions():
+            yield rows
+
+
+@cache(CACHE_TTL_S, key_builder=key_builder)
+@cache_tags("conv:{convo_id}")
+@single_flight
 async def membersof(
     session: AsyncSession, convo_id: int
 ) -> list[dict[str, Any]]:
@@ -124,7 +300,9 @@ async def membersof(
     return [member.to_dict() for member in members]
 
 
-@cache(300, key_builder=key_builder)
+@cache(CACHE_TTL_S, key_builder=key_builder)
+@cache_tags("user:{uid}")
+@single_flight
 async def _hook_user_cached(
     session: AsyncSession, uid: int
 ) -> dict[str, Any] | None:
@@ -144,7 +322,9 @@ async def hook_user(session: AsyncSession, uid: int) -> UserInfo | None:
     return None if cached_value is None else UserInfo.from_dict(cached_value)
 
 
-@cache(300, key_builder=key_builder)
+@cache(CACHE_TTL_S, key_builder=key_builder)
+@cache_tags(USERS_TAG)
+@single_flight
 async def allusers(session: AsyncSession) -> list[dict[str, Any]]:
     logger.info("Fetching all users from the database")
     with tracer.start_as_current_span("allusers_db"):
@@ -154,7 +334,9 @@ async def allusers(session: AsyncSession) -> list[dict[str, Any]]:
         ]
 
 
-@cache(300, key_builder=key_builder)
+@cache(CACHE_TTL_S, key_builder=key_builder)
+@cache_tags("member:{uid}")
+@single_flight
 async def user_allowed_in_convo(
     session: AsyncSession, uid: int, convo_id: int
 ) -> bool:
@@ -187,7 +369,40 @@ async def user_can_write_in_convo(
         )
         if result is None:
             return False
-        return result in ("owner", "admin", "member")
+        return result in WRITE_ROLES
+
+
+async def insert_message_if_allowed(
+    session: AsyncSession, uid: int, convo_id: int, content: str, ts: float
+) -> int | None:
+    """Insert a text message only if ``uid`` may write in ``convo_id``.
+
+    The membership and role check is the ``SELECT`` feeding the
+    ``INSERT``, so posting is a single statement; returns the new id, or
+    ``None`` when no row was written.
+    """
+    with tracer.start_as_current_span("insert_message_if_allowed_db"):
+        guard = select(
+            literal(convo_id),
+            literal(uid),
+            literal(ts),
+            literal("text"),
+            literal(content),
+        ).where(
+            (ConvMember.user_id == uid)
+            & (ConvMember.conv_id == convo_id)
+            & ConvMember.role.in_(WRITE_ROLES)
+        )
+        stmt = (
+            insert(ConvoMessage)
+            .from_select(
+                ["conv_id", "sender_id", "ts", "message_type", "content"], guard
+            )
+            .returning(ConvoMessage.id)
+        )
+        message_id = (await session.execute(stmt)).scalar_one_or_none()
+        await session.commit()
+        return message_id
 
 
 async def create_invite_code(
@@ -318,124 +533,46 @@ async def get_friend_requests(
 async def get_friends(
     session: AsyncSession, user_id: int
 ) -> list[dict[str, Any]]:
-    fsa = (
-        (
-            await session.execute(
-                select(Friendship)
-                .where(
-                    (Friendship.user_a_id == user_id)
-                    | (Friendship.user_b_id == user_id)
-                )
-            )
-        )
-        .scalars()
-        .all()
+    friend_id = case(
+        (Friendship.user_a_id == user_id, Friendship.user_b_id),
+        else_=Friendship.user_a_id,
     )
-    friend_ids = [
-        fs.user_b_id if fs.user_a_id == user_id else fs.user_a_id
-        for fs in fsa
-    ]
-
-    if not friend_ids:
-        return []
-
-    users = (
-        (
-            await session.execute(
-                select(UserInfo).where(UserInfo.id.in_(friend_ids))
-            )
-        )
-        .scalars()
-        .all()
+    rows = await session.execute(
+        select(UserInfo.id, UserInfo.name, UserInfo.nickname, Friendship.created_at)
+        .join(UserInfo, UserInfo.id == friend_id)
+        .where((Friendship.user_a_id == user_id) | (Friendship.user_b_id == user_id))
+        .order_by(Friendship.id)
     )
-    user_map = {u.id: u for u in users}
-
-    results = []
-    for fs in fsa:
-        fid = fs.user_b_id if fs.user_a_id == user_id else fs.user_a_id
-        u = user_map.get(fid)
-        if u:
-            results.append(
-                {
-                    "user_id": u.id,
-                    "name": u.name,
-                    "nickname": u.nickname,
-                    "since": fs.created_at,
-                }
-            )
-    return results
+    return [
+        {"user_id": uid, "name": name, "nickname": nickname, "since": since}
+        for uid, name, nickname, since in rows
+    ]
 
 
 async def get_visible_users(
     session: AsyncSession, user_id: int
 ) -> list[dict[str, Any]]:
-    friend_ids = set()
-    fsa = (
-        (
-            await session.execute(
-                select(Friendship).where(
-                    (Friendship.user_a_id == user_id)
-                    | (Friendship.user_b_id == user_id)
-                )
+    """Friends, conversation peers, pending requesters and the user itself."""
+    my_convs = aliased(ConvMember)
+    visible_ids = union(
+        select(Friendship.user_b_id).where(Friendship.user_a_id == user_id),
+        select(Friendship.user_a_id).where(Friendship.user_b_id == user_id),
+        select(ConvMember.user_id).where(
+            ConvMember.conv_id.in_(
+                select(my_convs.conv_id).where(my_convs.user_id == user_id)
             )
-        )
-        .scalars()
-        .all()
+        ),
+        select(FriendRequest.from_user_id).where(
+            (FriendRequest.to_user_id == user_id)
+            & (FriendRequest.status == "pending")
+        ),
     )
-    for fs in fsa:
-        fid = fs.user_b_id if fs.user_a_id == user_id else fs.user_a_id
-        friend_ids.add(fid)
-
-    conv_peer_ids = set()
-    user_convs = (
-        (
-            await session.execute(
-                select(ConvMember.conv_id).where(ConvMember.user_id == user_id)
-            )
-        )
-        .scalars()
-        .all()
+    rows = await session.execute(
+        select(UserInfo.id, UserInfo.name, UserInfo.nickname)
+        .where((UserInfo.id == user_id) | UserInfo.id.in_(visible_ids))
+        .order_by(UserInfo.id)
     )
-    if user_convs:
-        peers = (
-            (
-                await session.execute(
-                    select(ConvMember.user_id).where(
-                        ConvMember.conv_id.in_(user_convs)
-                    )
-                )
-            )
-            .scalars()
-            .all()
-        )
-        conv_peer_ids.update(peers)
-
-    request_ids = set()
-    reqs = (
-        (
-            await session.execute(
-                select(FriendRequest.from_user_id).where(
-                    (FriendRequest.to_user_id == user_id)
-                    & (FriendRequest.status == "pending")
-                )
-            )
-        )
-        .scalars()
-        .all()
-    )
-    request_ids.update(reqs)
-
-    visible_ids = friend_ids | conv_peer_ids | request_ids | {user_id}
-    if not visible_ids:
-        return []
-
-    users = (
-        (
-            await session.execute(
-                select(UserInfo).where(UserInfo.id.in_(visible_ids))
-            )
-        )
-        .scalars()
-        .all()
-    )
-    return [{"id": u.id, "name": u.name, "nickname": u.nickname} for u in users]
+    return [
+        {"id": uid, "name": name, "nickname": nickname}
+        for uid, name, nickname in rows
+    ]
@@ -2,7 +2,17 @@ from __future__ import annotations
 
 import time
 
-from sqlalchemy import Boolean, Float, ForeignKey, Integer, String, UniqueConstraint
+from sqlalchemy import (
+    DDL,
+    Boolean,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    UniqueConstraint,
+    event,
+)
 from sqlalchemy.dialects.sqlite import JSON
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
@@ -13,6 +23,7 @@ class Base(DeclarativeBase):
 
 class ConvoMessage(Base):
     __tablename__ = "convomessage"
+    __table_args__ = (Index("ix_convomessage_conv_id_id", "conv_id", "id"),)
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     conv_id: Mapped[int] = mapped_column(ForeignKey("conversations.id"), index=True)
@@ -50,6 +61,7 @@ class ConvMember(Base):
     conv_id: Mapped[int] = mapped_column(ForeignKey("conversations.id"))
     user_id: Mapped[int] = mapped_column(ForeignKey("userinfo.id"))
     role: Mapped[str] = mapped_column(String, default="member")
+    last_read_id: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
 
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -108,3 +120,46 @@ class Friendship(Base):
     user_a_id: Mapped[int] = mapped_column(ForeignKey("userinfo.id"))
     user_b_id: Mapped[int] = mapped_column(ForeignKey("userinfo.id"))
     created_at: Mapped[float] = mapped_column(Float, default=time.time)
+
+
+# Full-text index on message content, maintained by the database itself so
+# every insert path (single post, batch post, group commit) keeps it current.
+# SQLite: an external-content FTS5 table fed by triggers. Postgres: a GIN
+# expression index. See ppback/db/search.py for the matching queries.
+MESSAGE_FTS_SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS convomessage_fts USING fts5("
+    "content, content='convomessage', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS convomessage_fts_ai AFTER INSERT ON convomessage "
+    "BEGIN INSERT INTO convomessage_fts(rowid, content) "
+    "VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS convomessage_fts_ad AFTER DELETE ON convomessage "
+    "BEGIN INSERT INTO convomessage_fts(convomessage_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS convomessage_fts_au "
+    "AFTER UPDATE OF content ON convomessage "
+    "BEGIN INSERT INTO convomessage_fts(convomessage_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    "INSERT INTO convomessage_fts(rowid, content) VALUES (new.id, new.content); END",
+)
+MESSAGE_FTS_POSTGRES_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_convomessage_content_tsv ON convomessage "
+    "USING gin (to_tsvector('simple'::regconfig, content))",
+)
+
+for _statement in MESSAGE_FTS_SQLITE_DDL:
+    event.listen(
+        ConvoMessage.__table__,
+        "after_create",
+        DDL(_statement).execute_if(dialect="sqlite"),
+    )
+for _statement in MESSAGE_FTS_POSTGRES_DDL:
+    event.listen(
+        ConvoMessage.__table__,
+        "after_create",
+        DDL(_statement).execute_if(dialect="postgresql"),
+    )
+event.listen(
+    ConvoMessage.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS convomessage_fts").execute_if(dialect="sqlite"),
+)
@@ -0,0 +1,106 @@
+"""Full-text search over message content.
+
+The index itself is created with the ``convomessage`` table (see
+``ppdb_schemas``) and maintained by the database on every write. Run this
+module to create it on an existing database and backfill it::
+
+    python -m ppback.db.search
+"""
+
+import asyncio
+import logging
+from typing import List, Tuple
+
+from opentelemetry import trace
+from sqlalchemy import column, func, literal_column, select, table, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from ppback.db.ppdb_schemas import (
+    MESSAGE_FTS_POSTGRES_DDL,
+    MESSAGE_FTS_SQLITE_DDL,
+    ConvMember,
+    ConvoMessage,
+)
+
+tracer = trace.get_tracer(__name__)
+logger = logging.getLogger("ppback.db.search")
+
+_fts = table("convomessage_fts", column("rowid"))
+_pg_config = literal_column("'simple'::regconfig")
+
+# (conversation_id, id, content, sender_id, message_type, ts)
+SearchRow = Tuple[int, int, str, int, str, float]
+
+
+def _fts5_query(query: str) -> str:
+    # Every word becomes a quoted phrase, so user input can never be parsed
+    # as FTS5 operators; the phrases are ANDed like plainto_tsquery does.
+    return " ".join('"%s"' % word.replace('"', '""') for word in query.split())
+
+
+async def search_messages(
+    session: AsyncSession,
+    user_id: int,
+    query: str,
+    limit: int,
+    conv_id: int | None = None,
+    before: int | None = None,
+) -> List[SearchRow]:
+    """Newest messages matching every word of ``query``, newest first.
+
+    Only conversations ``user_id`` is a member of are searched.
+    """
+    if not query.split():
+        return []
+    with tracer.start_as_current_span("search_messages_db"):
+        stmt = select(
+            ConvoMessage.conv_id,
+            ConvoMessage.id,
+            ConvoMessage.content,
+            ConvoMessage.sender_id,
+            ConvoMessage.message_type,
+            ConvoMessage.ts,
+        ).join(
+            ConvMember,
+            (ConvMember.conv_id == ConvoMessage.conv_id)
+            & (ConvMember.user_id == user_id),
+        )
+        if session.bind.dialect.name == "sqlite":
+            stmt = stmt.join(_fts, _fts.c.rowid == ConvoMessage.id).where(
+                literal_column("convomessage_fts").op("MATCH")(_fts5_query(query))
+            )
+        else:
+            stmt = stmt.where(
+                func.to_tsvector(_pg_config, ConvoMessage.content).op("@@")(
+                    func.plainto_tsquery(_pg_config, query)
+                )
+            )
+        if conv_id is not None:
+            stmt = stmt.where(ConvoMessage.conv_id == conv_id)
+        if before is not None:
+            stmt = stmt.where(ConvoMessage.id < before)
+        rows = await session.execute(stmt.order_by(ConvoMessage.id.desc()).limit(limit))
+        return [tuple(row) for row in rows]
+
+
+async def backfill_search_index(engine: AsyncEngine) -> None:
+    """Create the search index if missing and index every existing message."""
+    async with engine.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            for statement in MESSAGE_FTS_SQLITE_DDL:
+                await conn.execute(text(statement))
+            await conn.execute(
+                text("INSERT INTO convomessage_fts(convomessage_fts) VALUES ('rebuild')")
+            )
+        else:
+            # Building the expression index reads every existing row.
+            for statement in MESSAGE_FTS_POSTGRES_DDL:
+                await conn.execute(text(statement))
+    logger.info("message search index is up to date")
+
+
+if __name__ == "__main__":
+    from ppback.config import DB_SESSION_STR, dbengine
+
+    print("Backfilling the message search index at " + DB_SESSION_STR)
+    asyncio.run(backfill_search_index(dbengine))
@@ -1,8 +1,9 @@
+import json
 import logging
 from typing import Annotated, AsyncGenerator, Any
 
 import jwt
-from fastapi import Depends
+from fastapi import Depends, Response
 from fastapi.security import OAuth2PasswordBearer
 from opentelemetry import trace
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -19,6 +20,24 @@ tracer = trace.get_tracer(__name__)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
+def render_json(payload: Any) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def json_response(payload: Any, headers: dict[str, str] | None = None) -> Response:
+    """Write plain dicts and lists straight to JSON bytes.
+
+    Returning a ``Response`` makes FastAPI skip ``response_model``
+    validation, so hot read paths avoid building a model per row.
+    """
+    return json_bytes_response(render_json(payload), headers)
+
+
+def json_bytes_response(body: bytes, headers: dict[str, str] | None = None) -> Response:
+    """Send an already encoded JSON body as is."""
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 async def get_db() -> AsyncGenerator[AsyncSession, Any]:
     with tracer.start_as_current_span("get_session"):
         logger.debug("Getting a database session from the pool")
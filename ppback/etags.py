@@ -0,0 +1,90 @@
+import uuid
+from typing import Dict, List
+
+from ppback.config import BUS_FED_CACHES
+from ppback.ppschema import MessageSchema
+from ppback.wsocket import inmemsockets
+
+
+class Validators:
+    """Strong ``ETag`` validators for the polled read endpoints.
+
+    History pages are versioned by the newest message id of their
+    conversation, which every delivered message advances. Conversation
+    and user lists are versioned by a per-user counter bumped whenever
+    the user's memberships, friendships, pending requests or read cursors
+    change; the conversation list also folds in the heads of its
+    conversations, since it carries unread counts. Both are fed from bus
+    events, so they only hold when the bus reaches every worker: without
+    ``PPBACK_BUS_FED_CACHES`` they are disabled, ``head`` knows nothing
+    and the routes answer without an ``ETag``.
+
+    The counters restart at zero with the process and on ``clear``, so
+    their tags carry an ``epoch`` and a tag from before never matches.
+    ``clear`` runs when bus events may have been lost.
+    """
+
+    def __init__(self, enabled: bool = BUS_FED_CACHES):
+        self.enabled = enabled
+        self.epoch = uuid.uuid4().hex[:8]
+        self.heads: Dict[int, int] = {}
+        self.versions: Dict[int, int] = {}
+
+    def clear(self) -> None:
+        self.epoch = uuid.uuid4().hex[:8]
+        self.heads.clear()
+        self.versions.clear()
+
+    def head(self, conv_id: int) -> int | None:
+        """Newest message id of ``conv_id``, or ``None`` if not known yet."""
+        return self.heads.get(conv_id) if self.enabled else None
+
+    def seed_head(self, conv_id: int, message_id: int) -> None:
+        if self.enabled:
+            self.heads[conv_id] = max(self.heads.get(conv_id, 0), message_id)
+
+    def missing_heads(self, conv_ids: List[int]) -> List[int]:
+        return [c for c in conv_ids if c not in self.heads]
+
+    def on_message(self, conv_id: int, message: MessageSchema) -> None:
+        self.seed_head(conv_id, message.id)
+
+    def on_users_changed(self, user_ids: List[int]) -> None:
+        if not self.enabled:
+            return
+        for user_id in user_ids:
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+    def history_etag(
+        self,
+        conv_id: int,
+        head: int,
+        limit: int,
+        after: int | None,
+        before: int | None,
+    ) -> str:
+        return f'"h{conv_id}.{head}.{limit}.{after}.{before}"'
+
+    def user_etag(self, kind: str, user_id: int) -> str:
+        return f'"{kind}{user_id}.{self.epoch}.{self.versions.get(user_id, 0)}"'
+
+    def conv_list_etag(self, user_id: int, conv_ids: List[int]) -> str:
+        # Heads only grow, so their sum changes with any new message.
+        heads = sum(self.heads.get(c, 0) for c in conv_ids)
+        return self.user_etag("c", user_id)[:-1] + f'.{heads}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Whether an ``If-None-Match`` header value matches ``etag``."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+
+validators = Validators()
+inmemsockets.add_message_listener(validators.on_message)
+inmemsockets.add_user_change_listener(validators.on_users_changed)
+inmemsockets.add_reset_listener(validators.clear)
@@ -0,0 +1,63 @@
+import asyncio
+from typing import Dict, Set
+
+from ppback.config import LONGPOLL_MAX_WAIT_S
+from ppback.middleware.metrics import LONGPOLL_WAITING
+from ppback.ppschema import MessageSchema
+from ppback.wsocket import inmemsockets
+
+
+class MessageWaiters:
+    """Requests parked until their conversation gets a new message.
+
+    Woken by the same delivered-message hook that feeds the sockets, so a
+    long-poll returns as soon as the message is committed and broadcast,
+    in every worker with the ``postgres`` bus.
+    """
+
+    def __init__(self, max_wait: float = LONGPOLL_MAX_WAIT_S):
+        self.max_wait = max_wait
+        self.waiting: Dict[int, Set[asyncio.Future]] = {}
+
+    def register(self, conv_id: int) -> asyncio.Future:
+        """Park a future for ``conv_id``; call before reading the current head."""
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(conv_id, set()).add(waiter)
+        LONGPOLL_WAITING.inc()
+        return waiter
+
+    def release(self, conv_id: int, waiter: asyncio.Future) -> None:
+        waiters = self.waiting.get(conv_id)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.discard(waiter)
+        if not waiters:
+            del self.waiting[conv_id]
+        LONGPOLL_WAITING.dec()
+
+    async def wait(self, conv_id: int, waiter: asyncio.Future, timeout: float) -> bool:
+        """Wait at most ``timeout`` seconds; ``True`` if a message arrived."""
+        try:
+            await asyncio.wait_for(waiter, min(timeout, self.max_wait))
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.release(conv_id, waiter)
+
+    def on_message(self, conv_id: int, message: MessageSchema) -> None:
+        for waiter in self.waiting.get(conv_id, ()):
+            loop = waiter.get_loop()
+            if loop is asyncio.get_running_loop():
+                _wake(waiter)
+            else:
+                loop.call_soon_threadsafe(_wake, waiter)
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+messagewaiters = MessageWaiters()
+inmemsockets.add_message_listener(messagewaiters.on_message)
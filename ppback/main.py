@@ -8,20 +8,32 @@ from fastapi import Depends, FastAPI
 from fastapi.concurrency import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend
 from opentelemetry import trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from sqlalchemy import select
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 
-from ppback.config import AUTO_INIT_DB, CORS_ORIGIN_STR, TRACING_ENDPOINT, SessionLocal, dbengine
+from ppback.cachebackend import create_cache_backend
+from ppback.cachetags import cachetags
+from ppback.config import (
+    AUTO_INIT_DB,
+    CACHE_L2_URL,
+    CORS_ORIGIN_STR,
+    DB_SESSION_STR,
+    TRACING_ENDPOINT,
+    WS_BUS_BACKEND,
+    SessionLocal,
+    dbengine,
+)
 from ppback.db.ppdb_schemas import Base, UserInfo
 from ppback.deps import decode_token  # noqa: F401
 from ppback.init_tracing import global_tracing_setup
 from ppback.middleware.metrics import metrics_router, MetricsMiddleware
-from ppback.routers import admin, health, messaging, users, ws
+from ppback.routers import admin, events, health, messaging, users, ws
 from ppback.routers.health import set_startup_time
+from ppback.wsbus import InProcessBus, create_bus
+from ppback.wsocket import inmemsockets
 
 logger = logging.getLogger("ppback")
 
@@ -77,9 +89,15 @@ async def lifespan(app: FastAPI):
         global_tracing_setup(TRACING_ENDPOINT)
         FastAPIInstrumentor.instrument_app(app)
     await initialize_database_if_needed()
-    cache_backend = InMemoryBackend()
+    cache_backend = create_cache_backend(CACHE_L2_URL, WS_BUS_BACKEND)
     FastAPICache.init(cache_backend, prefix="fastapi-cache")
+    cachetags.track(cache_backend)
+    await inmemsockets.use_bus(
+        create_bus(WS_BUS_BACKEND, inmemsockets.deliver_local, DB_SESSION_STR)
+    )
+    logger.info("websocket broadcast bus: %s", WS_BUS_BACKEND)
     yield
+    await inmemsockets.use_bus(InProcessBus(inmemsockets.deliver_local))
 
 
 app = FastAPI(lifespan=lifespan)
@@ -93,6 +111,7 @@ if CORS_ORIGIN_STR != "":
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["ETag", "X-Next-Cursor"],
     )
 
 app.add_middleware(RequestIDMiddleware)
@@ -104,3 +123,4 @@ app.include_router(health.router)
 app.include_router(users.router)
 app.include_router(messaging.router)
 app.include_router(ws.router)
+app.include_router(events.router)
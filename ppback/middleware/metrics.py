@@ -25,6 +25,105 @@ IN_FLIGHT = Gauge(
     "pp_http_in_flight_requests",
     "In-flight requests",
 )
+WS_SLOW_CONSUMER_DROPS = Counter(
+    "pp_ws_slow_consumer_drops_total",
+    "WebSocket connections dropped because their send queue overflowed",
+)
+WS_CONNECTED_SOCKETS = Gauge(
+    "pp_ws_connected_sockets",
+    "Registered WebSocket connections",
+)
+WS_CONNECTED_USERS = Gauge(
+    "pp_ws_connected_users",
+    "Users with at least one registered WebSocket",
+)
+WS_USERS_BY_SOCKET_COUNT = Gauge(
+    "pp_ws_users_by_socket_count",
+    "Connected users, by how many sockets each one holds",
+    ["sockets"],
+)
+WS_BROADCAST_FANOUT = Histogram(
+    "pp_ws_broadcast_fanout",
+    "Local sockets targeted by one broadcast event",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000),
+)
+WS_SEND_DURATION = Histogram(
+    "pp_ws_send_duration_seconds",
+    "Time to write one frame to a WebSocket",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+WS_SEND_FAILURES = Counter(
+    "pp_ws_send_failures_total",
+    "WebSocket frame writes that failed",
+    ["reason"],
+)
+WS_AUTH_DURATION = Histogram(
+    "pp_ws_auth_duration_seconds",
+    "Time from WebSocket accept to the socket being registered",
+)
+WS_REJECTED = Counter(
+    "pp_ws_rejected_connections_total",
+    "WebSocket connections closed before registration",
+    ["reason"],
+)
+WS_SESSIONS = Counter(
+    "pp_ws_sessions_total",
+    "WebSocket sessions handled",
+)
+WS_SESSION_DURATION = Histogram(
+    "pp_ws_session_duration_seconds",
+    "WebSocket session lifetime",
+    buckets=(1, 10, 60, 300, 900, 1800, 3600, 14400, 86400),
+)
+MESSAGE_BATCH_ROWS = Histogram(
+    "pp_message_batch_rows",
+    "Messages written by one group-commit batch",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+LONGPOLL_WAITING = Gauge(
+    "pp_longpoll_waiting_requests",
+    "History requests parked waiting for a new message",
+)
+CACHE_ENTRIES = Gauge(
+    "pp_cache_entries",
+    "Entries held by the query cache",
+    ["namespace"],
+)
+CACHE_BYTES = Gauge(
+    "pp_cache_bytes",
+    "Approximate bytes held by the query cache",
+    ["namespace"],
+)
+CACHE_HITS = Counter(
+    "pp_cache_hits_total",
+    "Query cache lookups answered from memory",
+    ["namespace"],
+)
+CACHE_MISSES = Counter(
+    "pp_cache_misses_total",
+    "Query cache lookups that found no live entry",
+    ["namespace"],
+)
+CACHE_COALESCED = Counter(
+    "pp_cache_coalesced_total",
+    "Cache misses that waited for an identical in-flight query",
+    ["namespace"],
+)
+CACHE_STALE_SERVED = Counter(
+    "pp_cache_stale_served_total",
+    "Expired cache entries served while one request refreshes them",
+    ["namespace"],
+)
+CACHE_L2_LOOKUPS = Counter(
+    "pp_cache_l2_lookups_total",
+    "Shared L2 cache lookups after an L1 miss",
+    ["namespace", "result"],
+)
+CACHE_EVICTIONS = Counter(
+    "pp_cache_evictions_total",
+    "Query cache entries dropped before being invalidated",
+    ["namespace", "reason"],
+)
 
 # Patterns to normalize dynamic path segments
 _PATH_NORMALIZE_PATTERNS = [
@@ -46,6 +145,15 @@ class MetricsMiddleware:
         self.app = app
 
     async def __call__(self, scope, receive, send):
+        if scope["type"] == "websocket":
+            WS_SESSIONS.inc()
+            start_time = time.monotonic()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                WS_SESSION_DURATION.observe(time.monotonic() - start_time)
+            return
+
         if scope["type"] != "http":
             await self.app(scope, receive, send)
             return
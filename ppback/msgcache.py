@@ -0,0 +1,161 @@
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Set
+
+from ppback.config import BUS_FED_CACHES, HOT_TAIL_BUDGET_BYTES, HOT_TAIL_SIZE
+from ppback.ppschema import MessageSchema
+from ppback.wsocket import inmemsockets
+
+logger = logging.getLogger("ppback.msgcache")
+
+# Rough per-row overhead of a cached MessageSchema on top of its content.
+_ROW_OVERHEAD = 200
+
+
+class _Tail:
+    __slots__ = ("messages", "floor", "nbytes")
+
+    def __init__(self, messages: List[MessageSchema], floor: int):
+        self.messages = messages
+        self.floor = floor
+        self.nbytes = sum(_row_size(m) for m in messages)
+
+
+def _row_size(message: MessageSchema) -> int:
+    return len(message.content) + _ROW_OVERHEAD
+
+
+class HotTail:
+    """Newest messages of recently read conversations, kept in memory.
+
+    Each conversation holds up to ``size`` messages in id order, and every
+    message with an id above ``floor`` is guaranteed to be present. The
+    whole cache is bounded by ``budget_bytes``; cold conversations are
+    evicted first.
+
+    A conversation enters the cache when a newest-tail read misses and is
+    seeded from the database; from then on every delivered message is
+    appended. Appends that arrive while a seed query is in flight are
+    kept aside and merged, so a seeded tail never misses a message. If
+    bus events may have been lost, the whole cache is dropped.
+
+    Messages posted through other workers only arrive over the ``postgres``
+    bus, so without it (and ``PPBACK_BUS_FED_CACHES``) the cache is
+    disabled and every read goes to the database.
+    """
+
+    def __init__(
+        self,
+        size=HOT_TAIL_SIZE,
+        budget_bytes=HOT_TAIL_BUDGET_BYTES,
+        enabled=BUS_FED_CACHES,
+    ):
+        self.size = size
+        self.enabled = enabled
+        self.budget_bytes = budget_bytes
+        self.nbytes = 0
+        self.tails: OrderedDict[int, _Tail] = OrderedDict()
+        self.loading: Dict[int, List[MessageSchema]] = {}
+
+    def clear(self) -> None:
+        self.tails.clear()
+        self.loading.clear()
+        self.nbytes = 0
+
+    def read(
+        self,
+        conv_id: int,
+        limit: int,
+        after: int | None = None,
+        before: int | None = None,
+    ) -> List[MessageSchema] | None:
+        """Answer a history page from memory, or ``None`` if it cannot.
+
+        With ``after`` the oldest ``limit`` messages above it are returned,
+        otherwise the newest ``limit`` messages below ``before`` (or of the
+        whole conversation).
+        """
+        tail = self.tails.get(conv_id)
+        if tail is None or limit <= 0 or not self.enabled:
+            return None
+        messages = tail.messages
+        if before is not None:
+            messages = [m for m in messages if m.id < before]
+        if after is None:
+            if limit > len(messages) and tail.floor > 0:
+                return None
+            self.tails.move_to_end(conv_id)
+            return messages[-limit:]
+        if after < tail.floor:
+            return None
+        self.tails.move_to_end(conv_id)
+        return [m for m in messages if m.id > after][:limit]
+
+    def begin_seed(self, conv_id: int) -> bool:
+        """Claim the right to seed ``conv_id``; call before querying the DB."""
+        if not self.enabled or conv_id in self.tails or conv_id in self.loading:
+            return False
+        self.loading[conv_id] = []
+        return True
+
+    def finish_seed(
+        self, conv_id: int, newest: List[MessageSchema], complete: bool
+    ) -> None:
+        """Install a seed read with ``ORDER BY id DESC LIMIT n``, oldest first.
+
+        ``complete`` means the query returned the whole conversation.
+        """
+        pending = self.loading.pop(conv_id, None)
+        if pending is None:
+            return
+        seen: Set[int] = {m.id for m in newest}
+        messages = sorted(
+            newest + [m for m in pending if m.id not in seen], key=lambda m: m.id
+        )
+        floor = 0 if complete or not newest else newest[0].id - 1
+        tail = _Tail(messages, floor)
+        self.tails[conv_id] = tail
+        self.nbytes += tail.nbytes
+        self._trim(tail)
+        self._enforce_budget()
+
+    def abort_seed(self, conv_id: int) -> None:
+        self.loading.pop(conv_id, None)
+
+    def append(self, conv_id: int, message: MessageSchema) -> None:
+        pending = self.loading.get(conv_id)
+        if pending is not None:
+            pending.append(message)
+            return
+        tail = self.tails.get(conv_id)
+        if tail is None:
+            return
+        if tail.messages and message.id <= tail.messages[-1].id:
+            if any(m.id == message.id for m in tail.messages):
+                return
+            tail.messages.append(message)
+            tail.messages.sort(key=lambda m: m.id)
+        else:
+            tail.messages.append(message)
+        tail.nbytes += _row_size(message)
+        self.nbytes += _row_size(message)
+        self._trim(tail)
+        self._enforce_budget()
+
+    def _trim(self, tail: _Tail) -> None:
+        while len(tail.messages) > self.size:
+            dropped = tail.messages.pop(0)
+            tail.floor = dropped.id
+            tail.nbytes -= _row_size(dropped)
+            self.nbytes -= _row_size(dropped)
+
+    def _enforce_budget(self) -> None:
+        while self.nbytes > self.budget_bytes and self.tails:
+            conv_id, tail = self.tails.popitem(last=False)
+            self.nbytes -= tail.nbytes
+            logger.debug("evicted hot tail of conversation %s", conv_id)
+
+
+hottail = HotTail()
+inmemsockets.add_message_listener(hottail.append)
+inmemsockets.add_reset_listener(hottail.clear)
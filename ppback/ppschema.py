@@ -13,6 +13,19 @@ class MsgOutputSchema(BaseModel):
     messageid: int | None = Field(None, description="The stored message id.")
 
 
+class MsgBatchInputSchema(BaseModel):
+    messages: list[MsgInputSchema] = Field(
+        ..., min_length=1, max_length=500, description="Messages to post, in order"
+    )
+
+
+class MsgBatchOutputSchema(BaseModel):
+    status: str = Field(..., description="Status of the batch post. Usually 'ok'")
+    messageids: list[int] = Field(
+        ..., description="Stored message ids, in the order they were sent."
+    )
+
+
 class MessageSchema(BaseModel):
     id: int = Field(..., description="Monotonic message id, usable as cursor.")
     content: str = Field(..., description="The content of the message.")
@@ -35,6 +48,10 @@ class MessageSchema(BaseModel):
     )
 
 
+class MessageSearchHit(MessageSchema):
+    conversation_id: int = Field(..., description="Conversation the message belongs to.")
+
+
 class MessageWS(BaseModel):
     type: Literal["message.created"] = "message.created"
     conversation_id: int
@@ -43,16 +60,55 @@ class MessageWS(BaseModel):
     ts: float
 
 
+class MessageWSInline(MessageWS):
+    """``message.created`` event that also carries the stored message."""
+
+    message: MessageSchema
+
+
+class ReadyWS(BaseModel):
+    """Sent once the socket is subscribed and any replay frame is queued."""
+
+    type: Literal["ready"] = "ready"
+
+
+class MessageCreateWS(BaseModel):
+    """Client frame posting a message over an authenticated socket."""
+
+    type: Literal["message.create"] = "message.create"
+    conversation_id: int
+    content: str
+    ref: str | None = Field(None, description="Client reference echoed in the reply.")
+
+
+class MessageAckWS(BaseModel):
+    type: Literal["message.ack"] = "message.ack"
+    ref: str | None = None
+    message_id: int
+    ts: float
+
+
+class MessageErrorWS(BaseModel):
+    type: Literal["message.error"] = "message.error"
+    ref: str | None = None
+    detail: str
+
+
 class ConversationItem(BaseModel):
     id: int
     label: str
     members: list[int]
+    unread: int = Field(0, description="Messages from others past the read cursor.")
 
 
 class ConversationList(BaseModel):
     conversations: list[ConversationItem]
 
 
+class ReadCursorIn(BaseModel):
+    message_id: int = Field(..., description="Newest message id the user has read.")
+
+
 class ConversationCreate(BaseModel):
     label: str
     members: list[int]
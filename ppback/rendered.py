@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from typing import List, Sequence, Tuple
+
+from ppback.config import RENDERED_CACHE_BYTES
+from ppback.middleware.metrics import (
+    CACHE_BYTES,
+    CACHE_ENTRIES,
+    CACHE_EVICTIONS,
+    CACHE_HITS,
+    CACHE_MISSES,
+)
+
+# Rough per-entry overhead of the key, the ETag string and the dict slot.
+_ENTRY_OVERHEAD = 200
+
+
+class _Rendered:
+    __slots__ = ("etag", "body", "conv_ids", "nbytes")
+
+    def __init__(self, etag: str, body: bytes, conv_ids: List[int]):
+        self.etag = etag
+        self.body = body
+        self.conv_ids = conv_ids
+        self.nbytes = len(etag) + len(body) + 8 * len(conv_ids) + _ENTRY_OVERHEAD
+
+
+class RenderedResponses:
+    """Encoded JSON bodies of the per-user list endpoints.
+
+    One body is kept per endpoint and user, stored with the ``ETag`` it
+    was rendered for. That tag changes whenever the response could
+    (see ``ppback.etags``), so a request whose current tag matches is
+    answered with the stored bytes: no query, no dict building, no JSON
+    encoding. The conversation list also keeps the ids it covers, which
+    are all its tag needs; they stay valid as long as the tag matches,
+    since a membership change bumps the user's version.
+
+    Bounded by ``budget_bytes``; least recently read bodies go first.
+    """
+
+    def __init__(self, budget_bytes: int = RENDERED_CACHE_BYTES):
+        self.budget_bytes = budget_bytes
+        self.nbytes = 0
+        self.bodies: OrderedDict[Tuple[str, int], _Rendered] = OrderedDict()
+
+    def clear(self) -> None:
+        self.bodies.clear()
+        self.nbytes = 0
+        self._export()
+
+    def conv_ids(self, endpoint: str, user_id: int) -> List[int] | None:
+        """Conversation ids of the stored body, to compute its current tag."""
+        stored = self.bodies.get((endpoint, user_id))
+        return None if stored is None else stored.conv_ids
+
+    def get(self, endpoint: str, user_id: int, etag: str) -> bytes | None:
+        """The body rendered for ``etag``, or ``None`` if it is not current."""
+        stored = self.bodies.get((endpoint, user_id))
+        if stored is None or stored.etag != etag:
+            CACHE_MISSES.labels(namespace=f"rendered_{endpoint}").inc()
+            return None
+        self.bodies.move_to_end((endpoint, user_id))
+        CACHE_HITS.labels(namespace=f"rendered_{endpoint}").inc()
+        return stored.body
+
+    def put(
+        self,
+        endpoint: str,
+        user_id: int,
+        etag: str,
+        body: bytes,
+        conv_ids: Sequence[int] = (),
+    ) -> None:
+        key = (endpoint, user_id)
+        previous = self.bodies.pop(key, None)
+        if previous is not None:
+            self.nbytes -= previous.nbytes
+        stored = _Rendered(etag, body, list(conv_ids))
+        if stored.nbytes <= self.budget_bytes:
+            self.bodies[key] = stored
+            self.nbytes += stored.nbytes
+        while self.nbytes > self.budget_bytes:
+            (cold, _), evicted = self.bodies.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            CACHE_EVICTIONS.labels(namespace=f"rendered_{cold}", reason="lru").inc()
+        self._export()
+
+    def _export(self) -> None:
+        CACHE_ENTRIES.labels(namespace="rendered").set(len(self.bodies))
+        CACHE_BYTES.labels(namespace="rendered").set(self.nbytes)
+
+
+rendered = RenderedResponses()
@@ -6,6 +6,7 @@ from opentelemetry import trace
 from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from ppback.cachetags import cachetags, conv_tag, user_tag
 from ppback.db.ppdb_schemas import Conv, ConvMember, UserInfo
 from ppback.deps import get_db, require_admin
 from ppback.ppschema import (
@@ -49,6 +50,7 @@ async def admin_set_user_role(
         raise HTTPException(status_code=404, detail="User not found")
     user.is_admin = body.is_admin
     await session.commit()
+    await cachetags.invalidate([user_tag(user_id)])
     return {"status": "ok", "user_id": user_id, "is_admin": user.is_admin}
 
 
@@ -106,4 +108,5 @@ async def admin_set_conv_member_role(
         raise HTTPException(status_code=404, detail="User is not a member of this conversation")
     member.role = body.role
     await session.commit()
+    await cachetags.invalidate([conv_tag(conv_id)])
     return {"status": "ok", "conv_id": conv_id, "user_id": user_id, "role": member.role}
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from typing import Annotated, AsyncIterator
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from opentelemetry import trace
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ppback.db.dbfuncs import conv_ids_for_user
+from ppback.deps import decode_token, get_db
+from ppback.wsocket import InMemSockets, inmemsockets
+
+logger = logging.getLogger("ppback")
+tracer = trace.get_tracer(__name__)
+
+router = APIRouter()
+
+# Seconds of silence after which a comment line keeps proxies from timing out.
+SSE_KEEPALIVE_S = 15.0
+
+
+class EventStreamSink:
+    """Socket-shaped target that lets an SSE response join ``InMemSockets``.
+
+    The registry's writer task hands frames over one at a time, so a client
+    that stops reading backs up into the connection's bounded send queue
+    and is evicted like a slow WebSocket.
+    """
+
+    def __init__(self):
+        self.frames: asyncio.Queue[str | None] = asyncio.Queue(1)
+
+    async def send_text(self, payload: str) -> None:
+        await self.frames.put(payload)
+
+    async def close(self, code: int = 1000) -> None:
+        while not self.frames.empty():
+            self.frames.get_nowait()
+        self.frames.put_nowait(None)
+
+
+async def stream_events(
+    registry: InMemSockets,
+    user_id: int,
+    idx: int,
+    sink: EventStreamSink,
+    keepalive: float = SSE_KEEPALIVE_S,
+) -> AsyncIterator[str]:
+    """Write the frames queued for one registry connection as SSE events."""
+    try:
+        yield ": connected\n\n"
+        while True:
+            try:
+                frame = await asyncio.wait_for(sink.frames.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if frame is None:
+                return
+            yield f"data: {frame}\n\n"
+    finally:
+        registry.drop_user(user_id, idx)
+
+
+@router.get("/events")
+async def events(
+    current_user_id: Annotated[int, Depends(decode_token)],
+    session: Annotated[AsyncSession, Depends(get_db)],
+    inline_messages: bool = False,
+) -> StreamingResponse:
+    """Server-Sent Events carrying the same frames as ``/ws``, read-only."""
+    if not inmemsockets.can_add_user(current_user_id):
+        raise HTTPException(status_code=429, detail="too many open event streams")
+    # Registered before the first await, so concurrent opens see the count.
+    sink = EventStreamSink()
+    idx = inmemsockets.add_user(current_user_id, sink, inline=inline_messages)
+    try:
+        conv_ids = await conv_ids_for_user(session, current_user_id)
+        await session.commit()
+    except BaseException:
+        inmemsockets.drop_user(current_user_id, idx)
+        raise
+
+    inmemsockets.subscribe(current_user_id, conv_ids)
+    logger.info("opened event stream %s for user %s", idx, current_user_id)
+    return StreamingResponse(
+        stream_events(inmemsockets, current_user_id, idx, sink),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,30 +1,60 @@
+import json
 import logging
 import time
-from typing import Annotated, List
+from typing import Annotated, Any, AsyncIterator, List, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from opentelemetry import trace
-from sqlalchemy import select
+from sqlalchemy import insert, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from ppback.config import (
+    HISTORY_MAX_PAGE_SIZE,
+    HISTORY_PAGE_SIZE,
+    MESSAGE_BATCH_ENABLED,
+    SessionLocal,
+)
+from ppback.db.batcher import messagebatcher
 from ppback.db.dbfuncs import (
     create_convo,
-    get_conversation_list_for_user,
+    get_conversation_list_payload,
+    get_messages_by_ids,
     hook_user,
-    membersof,
+    insert_message_if_allowed,
+    latest_message_id,
+    latest_message_ids,
+    mark_read,
+    stream_messages,
+    unread_counts,
     user_allowed_in_convo,
     user_can_write_in_convo,
 )
 from ppback.db.ppdb_schemas import ConvoMessage
-from ppback.deps import decode_token, get_db
+from ppback.db.search import SearchRow, search_messages
+from ppback.deps import (
+    decode_token,
+    get_db,
+    json_bytes_response,
+    json_response,
+    render_json,
+)
+from ppback.etags import etag_matches, validators
+from ppback.longpoll import messagewaiters
 from ppback.ppschema import (
     ConversationCreate,
     ConversationItem,
     ConversationList,
     MessageSchema,
+    MessageSearchHit,
+    MsgBatchInputSchema,
+    MsgBatchOutputSchema,
     MsgInputSchema,
     MsgOutputSchema,
+    ReadCursorIn,
 )
+from ppback.msgcache import hottail
+from ppback.rendered import rendered
 from ppback.wsocket import inmemsockets
 
 logger = logging.getLogger("ppback")
@@ -32,6 +62,20 @@ tracer = trace.get_tracer(__name__)
 
 router = APIRouter()
 
+# Rows fetched from the server-side cursor and written per NDJSON chunk.
+EXPORT_CHUNK_ROWS = 1000
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 200
+
+
+async def load_messages(message_ids: List[int]) -> dict[int, MessageSchema]:
+    """Bodies of bus events that were too big to carry them."""
+    async with SessionLocal() as session:
+        return await get_messages_by_ids(session, message_ids)
+
+
+inmemsockets.set_message_loader(load_messages)
+
 
 @router.post("/conv")
 async def create_conv(
@@ -56,17 +100,84 @@ async def create_conv(
     new_id, lab = await create_convo(
         session, new_conv_data.label, users, creator_id=current_user_id
     )
+    await inmemsockets.join_conversation(new_id, new_conv_data.members)
     return ConversationItem(id=new_id, label=lab, members=new_conv_data.members)
 
 
-@router.get("/conv")
+@router.get("/conv", response_model=ConversationList)
 async def list_conv(
     current_user_id: Annotated[int, Depends(decode_token)],
     session: Annotated[AsyncSession, Depends(get_db)],
-) -> ConversationList:
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    # A stored body still covers the same conversations if its tag holds.
+    known_ids = rendered.conv_ids("conv", current_user_id)
+    if (
+        validators.enabled
+        and known_ids is not None
+        and not validators.missing_heads(known_ids)
+    ):
+        etag = validators.conv_list_etag(current_user_id, known_ids)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        body = rendered.get("conv", current_user_id, etag)
+        if body is not None:
+            return json_bytes_response(body, {"ETag": etag})
+
+    convlist = await get_conversation_list_payload(session, current_user_id)
+    conv_ids = [conv["id"] for conv in convlist["conversations"]]
+    etag = None
+    if validators.enabled:
+        missing = validators.missing_heads(conv_ids)
+        if missing:
+            heads = await latest_message_ids(session, missing)
+            for conv_id, head in heads.items():
+                validators.seed_head(conv_id, head)
+        etag = validators.conv_list_etag(current_user_id, conv_ids)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
     logger.info("Fetching conversations for user %s", current_user_id)
-    convlist = await get_conversation_list_for_user(session, current_user_id)
-    return convlist
+    unread = await unread_counts(session, current_user_id)
+    conversations = [
+        {**conv, "unread": unread.get(conv["id"], 0)}
+        for conv in convlist["conversations"]
+    ]
+    body = render_json({"conversations": conversations})
+    if etag is None:
+        return json_bytes_response(body)
+    rendered.put("conv", current_user_id, etag, body, conv_ids)
+    return json_bytes_response(body, {"ETag": etag})
+
+
+@router.post("/conv/{conversation_id}/read")
+async def mark_conv_read(
+    conversation_id: int,
+    cursor: ReadCursorIn,
+    current_user_id: Annotated[int, Depends(decode_token)],
+    session: Annotated[AsyncSession, Depends(get_db)],
+):
+    """Advance the user's read cursor; unread counts drop to match."""
+    if not await user_allowed_in_convo(session, current_user_id, conversation_id):
+        raise HTTPException(status_code=400, detail="error updating read cursor")
+    await mark_read(session, current_user_id, conversation_id, cursor.message_id)
+    await inmemsockets.users_changed([current_user_id])
+    return {"status": "ok"}
+
+
+# Column order of the plain message tuples used on the read paths.
+MessageRow = Tuple[int, str, int, str, float]
+
+
+def _message_dict(row: MessageRow) -> dict[str, Any]:
+    msg_id, content, sender_id, message_type, ts = row
+    return {
+        "id": msg_id,
+        "content": content,
+        "sender": sender_id,
+        "message_type": message_type,
+        "ts": ts,
+    }
 
 
 @router.get("/conv/{conversation_id}/messages", response_model=List[MessageSchema])
@@ -74,44 +185,79 @@ async def get_messages(
     conversation_id: int,
     current_user_id: Annotated[int, Depends(decode_token)],
     session: Annotated[AsyncSession, Depends(get_db)],
-    limit: int = 1000,
+    limit: int = HISTORY_PAGE_SIZE,
     after: int | None = None,
-) -> List[MessageSchema]:
+    before: int | None = None,
+    wait: float = 0,
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    """One page of history, keyset-paginated on ``(conv_id, id)``.
+
+    Without ``after`` the page holds the newest messages below ``before``
+    and ``X-Next-Cursor`` is the ``before`` of the next older page. With
+    ``after`` it holds the oldest messages above it and ``X-Next-Cursor``
+    is the ``after`` of the next newer page. The header is absent on the
+    last page.
+
+    The ``ETag`` is derived from the conversation's newest message id, so
+    a matching ``If-None-Match`` gets a ``304`` without reading any rows.
+    It is only sent while the bus-fed validators are enabled.
+
+    With ``after`` and ``wait`` (seconds), a request with nothing newer
+    than ``after`` is parked until a message arrives or ``wait`` expires.
+    """
     with tracer.start_as_current_span("privacy_check"):
         privacycheck = await user_allowed_in_convo(
             session, current_user_id, conversation_id
         )
 
     if privacycheck:
-        with tracer.start_as_current_span("read_messages_db"):
-            query = select(ConvoMessage).where(
-                ConvoMessage.conv_id == conversation_id
-            )
-            if after is not None:
-                query = query.where(ConvoMessage.id > after)
-
-            results = (
-                (
-                    await session.execute(
-                        query.order_by(ConvoMessage.ts.desc()).limit(limit)
-                    )
-                )
-                .scalars()
-                .all()
+        limit = min(max(limit, 1), HISTORY_MAX_PAGE_SIZE)
+        head = None
+        if after is not None and wait > 0:
+            head = await _current_head(session, conversation_id)
+        if head is not None and head <= after:
+            # Read the head again once parked, so no message can slip by.
+            waiter = messagewaiters.register(conversation_id)
+            head = await _current_head(session, conversation_id)
+            if head > after:
+                messagewaiters.release(conversation_id, waiter)
+            else:
+                # Hand the connection back to the pool while parked.
+                await session.commit()
+                with tracer.start_as_current_span("long_poll_wait"):
+                    await messagewaiters.wait(conversation_id, waiter, wait)
+                head = None
+        headers = {}
+        if validators.enabled:
+            if head is None:
+                head = await _current_head(session, conversation_id)
+            etag = validators.history_etag(
+                conversation_id, head, limit, after, before
             )
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+            headers["ETag"] = etag
 
-        all_results: list[MessageSchema] = []
-        for msg in reversed(results):
-            ms = MessageSchema(
-                id=msg.id,
-                content=msg.content,
-                sender=msg.sender_id,
-                message_type=msg.message_type,
-                ts=msg.ts,
+        # One extra row tells whether another page follows.
+        cached = hottail.read(conversation_id, limit + 1, after, before)
+        if cached is not None:
+            page = [
+                (m.id, m.content, m.sender, m.message_type, m.ts) for m in cached
+            ]
+        else:
+            page = await _read_history_page(
+                session, conversation_id, limit + 1, after, before
             )
-            all_results.append(ms)
 
-        return all_results
+        if len(page) > limit:
+            if after is None:
+                page = page[1:]
+                headers["X-Next-Cursor"] = str(page[0][0])
+            else:
+                page = page[:limit]
+                headers["X-Next-Cursor"] = str(page[-1][0])
+        return json_response([_message_dict(row) for row in page], headers)
 
     logger.warning(
         "User %s is not allowed to access conversation %s",
@@ -121,48 +267,247 @@ async def get_messages(
     raise HTTPException(status_code=500, detail="error fetching conversation.")
 
 
-@router.post("/usermsg", response_model=MsgOutputSchema)
-async def new_msg(
-    msg: MsgInputSchema,
+async def _current_head(session: AsyncSession, conversation_id: int) -> int:
+    """Newest message id, from the validators or else from the database."""
+    head = validators.head(conversation_id)
+    if head is None:
+        head = await latest_message_id(session, conversation_id)
+        validators.seed_head(conversation_id, head)
+    return head
+
+
+async def _read_history_page(
+    session: AsyncSession,
+    conversation_id: int,
+    limit: int,
+    after: int | None,
+    before: int | None,
+) -> List[MessageRow]:
+    seeding = (
+        after is None and before is None and hottail.begin_seed(conversation_id)
+    )
+    fetch = max(limit, hottail.size) if seeding else limit
+    try:
+        with tracer.start_as_current_span("read_messages_db"):
+            query = select(
+                ConvoMessage.id,
+                ConvoMessage.content,
+                ConvoMessage.sender_id,
+                ConvoMessage.message_type,
+                ConvoMessage.ts,
+            ).where(ConvoMessage.conv_id == conversation_id)
+            if before is not None:
+                query = query.where(ConvoMessage.id < before)
+            if after is not None:
+                query = query.where(ConvoMessage.id > after).order_by(
+                    ConvoMessage.id
+                )
+            else:
+                query = query.order_by(ConvoMessage.id.desc())
+
+            results = [
+                tuple(row) for row in (await session.execute(query.limit(fetch)))
+            ]
+    except Exception:
+        if seeding:
+            hottail.abort_seed(conversation_id)
+        raise
+
+    if after is None:
+        results.reverse()
+    if seeding:
+        # Only the seed read builds models, since the hot tail keeps them.
+        hottail.finish_seed(
+            conversation_id,
+            [MessageSchema(**_message_dict(row)) for row in results],
+            complete=len(results) < fetch,
+        )
+        return results[max(len(results) - limit, 0):]
+    return results
+
+
+async def _export_chunks(conversation_id: int) -> AsyncIterator[bytes]:
+    # The request session is closed once the handler returns, so the
+    # stream reads through a session of its own.
+    async with SessionLocal() as session:
+        async for rows in stream_messages(
+            session, conversation_id, EXPORT_CHUNK_ROWS
+        ):
+            yield "".join(
+                json.dumps(_message_dict(row), separators=(",", ":")) + "\n"
+                for row in rows
+            ).encode()
+
+
+@router.get("/conv/{conversation_id}/messages/export")
+async def export_messages(
+    conversation_id: int,
     current_user_id: Annotated[int, Depends(decode_token)],
     session: Annotated[AsyncSession, Depends(get_db)],
-):
-    with tracer.start_as_current_span("privacy_and_rbac_check"):
+) -> StreamingResponse:
+    """Stream the whole conversation as NDJSON, one ``MessageSchema`` per line."""
+    with tracer.start_as_current_span("privacy_check"):
         privacycheck = await user_allowed_in_convo(
-            session, current_user_id, msg.conversation_id
+            session, current_user_id, conversation_id
         )
-        canwrite = await user_can_write_in_convo(
-            session, current_user_id, msg.conversation_id
+    if not privacycheck:
+        logger.warning(
+            "User %s is not allowed to export conversation %s",
+            current_user_id,
+            conversation_id,
         )
+        raise HTTPException(status_code=500, detail="error fetching conversation.")
+
+    return StreamingResponse(
+        _export_chunks(conversation_id), media_type="application/x-ndjson"
+    )
+
+
+@router.get("/messages/search", response_model=List[MessageSearchHit])
+async def search(
+    q: str,
+    current_user_id: Annotated[int, Depends(decode_token)],
+    session: Annotated[AsyncSession, Depends(get_db)],
+    conversation_id: int | None = None,
+    before: int | None = None,
+    limit: int = SEARCH_PAGE_SIZE,
+) -> Response:
+    """Messages matching every word of ``q`` in the user's conversations.
+
+    Newest first; pass the last hit's id as ``before`` for the next page.
+    """
+    limit = min(max(limit, 1), SEARCH_MAX_PAGE_SIZE)
+    rows = await search_messages(
+        session, current_user_id, q, limit, conv_id=conversation_id, before=before
+    )
+    return json_response([_search_hit(row) for row in rows])
 
-    if privacycheck and canwrite:
-        convo_id = msg.conversation_id
+
+def _search_hit(row: SearchRow) -> dict[str, Any]:
+    conv_id, *message = row
+    return {"conversation_id": conv_id, **_message_dict(tuple(message))}
+
+
+async def post_message(
+    session: AsyncSession, user_id: int, convo_id: int, content: str
+) -> MessageSchema | None:
+    """Store a message and broadcast it; ``None`` when the user may not post.
+
+    Shared by ``POST /usermsg`` and the ``message.create`` WebSocket frame.
+    By default the permission check is folded into the insert statement.
+    """
+    msg_time = time.time()
+    if MESSAGE_BATCH_ENABLED:
+        with tracer.start_as_current_span("privacy_and_rbac_check"):
+            privacycheck = await user_allowed_in_convo(session, user_id, convo_id)
+            canwrite = await user_can_write_in_convo(session, user_id, convo_id)
+        if not (privacycheck and canwrite):
+            return None
         with tracer.start_as_current_span("store_message"):
-            msg_time = time.time()
-            cm = ConvoMessage(
-                content=msg.content,
-                sender_id=current_user_id,
-                conv_id=convo_id,
-                ts=msg_time,
-                message_type="text",
-            )
-            session.add(cm)
-            await session.flush()
-            await session.refresh(cm)
-            message_id = cm.id
+            # End the read transaction first: on SQLite it would block the
+            # batch commit this call is about to wait for.
             await session.commit()
+            message_id = await messagebatcher.insert(
+                convo_id, user_id, content, msg_time
+            )
+    else:
+        with tracer.start_as_current_span("store_message"):
+            message_id = await insert_message_if_allowed(
+                session, user_id, convo_id, content, msg_time
+            )
+        if message_id is None:
+            return None
+
+    message = MessageSchema(
+        id=message_id,
+        content=content,
+        sender=user_id,
+        message_type="text",
+        ts=msg_time,
+    )
+    await inmemsockets.broadcast_message_to_conv(convo_id, message)
+    return message
 
-        with tracer.start_as_current_span("find_members_of_convo"):
-            members = await membersof(session, convo_id)
-            usersto_send = [u["user_id"] for u in members]
 
-        await inmemsockets.broadcast_message_to_users(
-            current_user_id,
-            convo_id,
-            usersto_send,
-            message_id,
-            msg_time,
+@router.post("/usermsg", response_model=MsgOutputSchema)
+async def new_msg(
+    msg: MsgInputSchema,
+    current_user_id: Annotated[int, Depends(decode_token)],
+    session: Annotated[AsyncSession, Depends(get_db)],
+):
+    message = await post_message(
+        session, current_user_id, msg.conversation_id, msg.content
+    )
+    if message is None:
+        raise HTTPException(400, detail="error posting message")
+    return {"status": "ok", "messageid": message.id}
+
+
+async def post_messages(
+    session: AsyncSession, user_id: int, messages: List[MsgInputSchema]
+) -> List[MessageSchema] | None:
+    """Store many messages at once; ``None`` when any target is not writable.
+
+    Permissions are checked once per conversation, every row goes into one
+    ``INSERT`` and one commit, and subscribers get one coalesced frame.
+    """
+    with tracer.start_as_current_span("privacy_and_rbac_check"):
+        for convo_id in {m.conversation_id for m in messages}:
+            privacycheck = await user_allowed_in_convo(session, user_id, convo_id)
+            canwrite = await user_can_write_in_convo(session, user_id, convo_id)
+            if not (privacycheck and canwrite):
+                logger.warning(
+                    "User %s cannot post a batch into conversation %s",
+                    user_id,
+                    convo_id,
+                )
+                return None
+
+    with tracer.start_as_current_span("store_message_batch"):
+        msg_time = time.time()
+        rows = [
+            {
+                "conv_id": m.conversation_id,
+                "sender_id": user_id,
+                "content": m.content,
+                "ts": msg_time,
+                "message_type": "text",
+            }
+            for m in messages
+        ]
+        result = await session.execute(
+            insert(ConvoMessage).returning(
+                ConvoMessage.id, sort_by_parameter_order=True
+            ),
+            rows,
         )
-        return {"status": "ok", "messageid": message_id}
+        message_ids = list(result.scalars())
+        await session.commit()
 
-    raise HTTPException(400, detail="error posting message")
+    stored = [
+        (
+            m.conversation_id,
+            MessageSchema(
+                id=message_id,
+                content=m.content,
+                sender=user_id,
+                message_type="text",
+                ts=msg_time,
+            ),
+        )
+        for m, message_id in zip(messages, message_ids)
+    ]
+    await inmemsockets.broadcast_messages_to_convs(stored)
+    return [message for _, message in stored]
+
+
+@router.post("/usermsg/batch", response_model=MsgBatchOutputSchema)
+async def new_msg_batch(
+    batch: MsgBatchInputSchema,
+    current_user_id: Annotated[int, Depends(decode_token)],
+    session: Annotated[AsyncSession, Depends(get_db)],
+):
+    messages = await post_messages(session, current_user_id, batch.messages)
+    if messages is None:
+        raise HTTPException(400, detail="error posting messages")
+    return {"status": "ok", "messageids": [m.id for m in messages]}
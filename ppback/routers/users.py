@@ -2,7 +2,7 @@ import logging
 from typing import Annotated
 
 import jwt
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
 from fastapi.security import OAuth2PasswordRequestForm
 from opentelemetry import trace
 from sqlalchemy import select
@@ -19,14 +19,23 @@ from ppback.db.dbfuncs import (
     submit_invite_code,
 )
 from ppback.db.ppdb_schemas import UserInfo
-from ppback.deps import decode_token, get_db
+from ppback.deps import (
+    decode_token,
+    get_db,
+    json_bytes_response,
+    json_response,
+    render_json,
+)
+from ppback.etags import etag_matches, validators
 from ppback.ppschema import (
     FriendRequestOut,
     FriendRequestSubmit,
     FriendshipOut,
     InviteCodeOut,
 )
+from ppback.rendered import rendered
 from ppback.secu.sec_utils import check_password
+from ppback.wsocket import inmemsockets
 
 logger = logging.getLogger("ppback")
 tracer = trace.get_tracer(__name__)
@@ -73,10 +82,24 @@ async def login(
 async def list_users(
     current_user_id: Annotated[int, Depends(decode_token)],
     session: Annotated[AsyncSession, Depends(get_db)],
-):
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    etag = None
+    if validators.enabled:
+        etag = validators.user_etag("u", current_user_id)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        body = rendered.get("users", current_user_id, etag)
+        if body is not None:
+            return json_bytes_response(body, {"ETag": etag})
     logger.info("Fetching visible users for user %s", current_user_id)
     with tracer.start_as_current_span("visible_users_db"):
-        return await get_visible_users(session, current_user_id)
+        users = await get_visible_users(session, current_user_id)
+    body = render_json(users)
+    if etag is None:
+        return json_bytes_response(body)
+    rendered.put("users", current_user_id, etag, body)
+    return json_bytes_response(body, {"ETag": etag})
 
 
 @router.post("/invite-codes", response_model=InviteCodeOut)
@@ -98,6 +121,7 @@ async def submit_invite(
         fr = await submit_invite_code(session, body.invite_code, current_user_id)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    await inmemsockets.users_changed([fr.from_user_id, fr.to_user_id])
     return {
         "id": fr.id,
         "from_user_id": fr.from_user_id,
@@ -124,6 +148,7 @@ async def accept_request(
         fs = await accept_friend_request(session, request_id, current_user_id)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    await inmemsockets.users_changed([fs.user_a_id, fs.user_b_id])
 
     from ppback.db.dbfuncs import hook_user
 
@@ -149,6 +174,7 @@ async def reject_request(
         await reject_friend_request(session, request_id, current_user_id)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    await inmemsockets.users_changed([current_user_id])
     return {"status": "rejected"}
 
 
@@ -156,5 +182,5 @@ async def reject_request(
 async def list_friends(
     current_user_id: Annotated[int, Depends(decode_token)],
     session: Annotated[AsyncSession, Depends(get_db)],
-):
-    return await get_friends(session, current_user_id)
+) -> Response:
+    return json_response(await get_friends(session, current_user_id))
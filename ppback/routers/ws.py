@@ -1,14 +1,20 @@
 import asyncio
 import json
 import logging
+import time
 
 import fastapi
+import jwt
 from fastapi import APIRouter
 from opentelemetry import trace
+from pydantic import ValidationError
 
-from ppback.config import SessionLocal
-from ppback.db.dbfuncs import hook_user
+from ppback.config import WS_REPLAY_DB_LIMIT, SessionLocal
+from ppback.db.dbfuncs import conv_ids_for_user, get_messages_after, hook_user
 from ppback.deps import decode_token
+from ppback.middleware.metrics import WS_AUTH_DURATION, WS_REJECTED
+from ppback.ppschema import MessageAckWS, MessageCreateWS, MessageErrorWS, ReadyWS
+from ppback.routers.messaging import post_message
 from ppback.wsocket import inmemsockets
 
 logger = logging.getLogger("ppback")
@@ -17,10 +23,50 @@ tracer = trace.get_tracer(__name__)
 router = APIRouter()
 
 
+async def handle_client_frame(user_id: int, idx: int, frame: str) -> None:
+    """Handle one client frame; anything but ``message.create`` is ignored."""
+    try:
+        data = json.loads(frame)
+    except ValueError:
+        return
+    if not isinstance(data, dict) or data.get("type") != "message.create":
+        return
+
+    try:
+        create = MessageCreateWS.model_validate(data)
+    except ValidationError:
+        ref = data.get("ref") if isinstance(data.get("ref"), str) else None
+        reply = MessageErrorWS(ref=ref, detail="invalid message.create frame")
+        inmemsockets.send_to(user_id, idx, reply.model_dump_json())
+        return
+
+    try:
+        with tracer.start_as_current_span("ws_message_create"):
+            async with SessionLocal() as session:
+                message = await post_message(
+                    session, user_id, create.conversation_id, create.content
+                )
+    except Exception:
+        # Reply instead of letting the error close the socket.
+        logger.exception("posting message from websocket user %s failed", user_id)
+        message = None
+
+    if message is None:
+        reply = MessageErrorWS(ref=create.ref, detail="error posting message")
+    else:
+        reply = MessageAckWS(ref=create.ref, message_id=message.id, ts=message.ts)
+    inmemsockets.send_to(user_id, idx, reply.model_dump_json())
+
+
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: fastapi.WebSocket):
     await websocket.accept()
     logger.info("accepting websocket connection from %s", websocket.client)
+    start_time = time.monotonic()
+
+    async def reject(reason: str) -> None:
+        WS_REJECTED.labels(reason=reason).inc()
+        await websocket.close()
 
     try:
         try:
@@ -30,38 +76,77 @@ async def websocket_endpoint(websocket: fastapi.WebSocket):
                 "no data received in time, closing websocket connection from %s",
                 websocket.client,
             )
-            await websocket.close()
+            await reject("timeout")
             return
 
         logger.info("got websocket auth packet from %s", websocket.client)
-        pld = json.loads(data["text"])["token"]
-        token = pld
+        try:
+            auth_packet = json.loads(data["text"])
+            token = auth_packet["token"]
+            inline_messages = bool(auth_packet.get("inline_messages", False))
+            resume = {
+                int(conv_id): int(last_seen)
+                for conv_id, last_seen in (auth_packet.get("resume") or {}).items()
+            }
+        except (KeyError, TypeError, ValueError, AttributeError):
+            logger.warning("malformed websocket auth packet from %s", websocket.client)
+            await reject("bad_packet")
+            return
 
         logger.info("got websocket auth token from %s", websocket.client)
-        user_id = await decode_token(token)
+        try:
+            user_id = await decode_token(token)
+        except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+            logger.warning("invalid websocket token from %s", websocket.client)
+            await reject("bad_token")
+            return
         async with SessionLocal() as session:
             user = await hook_user(session, user_id)
         if user is None:
-            raise ValueError("websocket token references an unknown user")
+            logger.warning("websocket token references unknown user %s", user_id)
+            await reject("unknown_user")
+            return
         user_name = user.name
         logger.info("websocket authenticated user %s", user_name)
         if not inmemsockets.can_add_user(user_id):
-            await websocket.close()
+            await reject("limit")
             return
 
-        idx = inmemsockets.add_user(user_id, websocket)
-
-        keep_user_connected = True
-        while keep_user_connected:
-            try:
-                await websocket.receive_text()
-            except fastapi.WebSocketDisconnect:
-                logger.warning("dropping user %s ", user_id)
-            except RuntimeError as rerr:
-                logger.warning("dropping user %s due to runtime error %s ", user_id, rerr)
-            finally:
-                inmemsockets.drop_user(user_id, idx)
-            return
+        idx = inmemsockets.add_user(user_id, websocket, inline=inline_messages)
+        try:
+            fetched: dict[int, list] = {}
+            truncated: list[int] = []
+            async with SessionLocal() as session:
+                conv_ids = await conv_ids_for_user(session, user_id)
+                resume = {c: last for c, last in resume.items() if c in conv_ids}
+                for conv_id in inmemsockets.uncovered(resume):
+                    messages = await get_messages_after(
+                        session, conv_id, resume[conv_id], WS_REPLAY_DB_LIMIT + 1
+                    )
+                    if len(messages) > WS_REPLAY_DB_LIMIT:
+                        truncated.append(conv_id)
+                    else:
+                        fetched[conv_id] = messages
+            inmemsockets.subscribe(user_id, conv_ids)
+            inmemsockets.replay_missed(user_id, idx, resume, fetched, truncated)
+            # Events for the user's conversations reach the socket from here on.
+            inmemsockets.send_to(user_id, idx, ReadyWS().model_dump_json())
+        except Exception:
+            inmemsockets.drop_user(user_id, idx)
+            raise
+        WS_AUTH_DURATION.observe(time.monotonic() - start_time)
+
+        try:
+            while True:
+                frame = await websocket.receive_text()
+                await handle_client_frame(user_id, idx, frame)
+        except fastapi.WebSocketDisconnect:
+            logger.warning("dropping user %s ", user_id)
+        except RuntimeError as rerr:
+            logger.warning("dropping user %s due to runtime error %s ", user_id, rerr)
+        finally:
+            inmemsockets.drop_user(user_id, idx)
+        return
 
     except Exception:
         await websocket.close()
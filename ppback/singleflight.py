@@ -0,0 +1,165 @@
+import asyncio
+import functools
+import inspect
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Set, Tuple
+
+from fastapi.dependencies.utils import get_typed_return_annotation
+from fastapi_cache import FastAPICache
+
+from ppback.config import CACHE_TTL_S, SessionLocal
+from ppback.middleware.metrics import CACHE_COALESCED
+
+logger = logging.getLogger("ppback.singleflight")
+
+
+class SingleFlight:
+    """Share one in-flight computation between concurrent identical calls.
+
+    The first caller for a key runs the computation; callers arriving
+    while it runs wait for its result instead of running their own. A
+    failure is raised in every waiter. If the first caller is cancelled,
+    one of the waiters takes over.
+
+    Calls are kept per event loop, as a future cannot be awaited from
+    another loop.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.flights: Dict[
+            Tuple[asyncio.AbstractEventLoop, int, Hashable], asyncio.Future
+        ] = {}
+        # Background refreshes of stale entries; the loop only keeps weak
+        # references to tasks.
+        self.refreshes: Set[asyncio.Task] = set()
+
+    def invalidate(self) -> None:
+        """Start fresh computations for calls arriving from now on.
+
+        Called on cache invalidation, so no request joins a query that may
+        have read the rows before the write. Such a query's own result is
+        not cached either (``CacheTags.tags_for_write``).
+        """
+        self.generation += 1
+
+    async def do(
+        self, key: Hashable, compute: Callable[[], Awaitable[Any]], label: str = ""
+    ) -> Any:
+        flight_key = (asyncio.get_running_loop(), self.generation, key)
+        while True:
+            pending = self.flights.get(flight_key)
+            if pending is None:
+                break
+            CACHE_COALESCED.labels(namespace=label).inc()
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # The leader was cancelled, not us: run it ourselves.
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume)
+        self.flights[flight_key] = future
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.flights[flight_key]
+
+
+def _consume(future: asyncio.Future) -> None:
+    # Mark a failure as retrieved even when no waiter joined the flight.
+    if not future.cancelled():
+        future.exception()
+
+
+singleflight = SingleFlight()
+
+
+def single_flight(func: Callable) -> Callable:
+    """Coalesce concurrent calls of ``func`` with equal arguments.
+
+    Meant to sit below ``@cache``, so it only guards misses. Arguments are
+    compared the way ``dbfuncs.key_builder`` builds keys: the session and
+    other non-scalar positional arguments are left out, so concurrent
+    requests share the result computed on the first caller's session.
+
+    A miss on an entry still within ``PPBACK_CACHE_STALE_S`` of its expiry
+    is answered with the stale value, and the query is refreshed in the
+    background on a session of its own, so no caller waits on it.
+    """
+    signature = inspect.signature(func)
+    return_type = get_typed_return_annotation(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = (
+            func.__name__,
+            tuple(a for a in args if isinstance(a, (str, int, float))),
+            tuple((k, v) for k, v in kwargs.items() if k != "session"),
+        )
+        stale = await _stale_value(wrapper)
+        if stale is not None:
+            cache_key, data = stale
+            bound = signature.bind(*args, **kwargs)
+            _refresh(key, cache_key, func, bound)
+            # Only the refresh may store a value, not this stale one.
+            _cachetags().skip_write(cache_key)
+            return FastAPICache.get_coder().decode_as_type(data, type_=return_type)
+        return await singleflight.do(
+            key, lambda: func(*args, **kwargs), label=func.__name__
+        )
+
+    return wrapper
+
+
+def _cachetags():
+    # Imported late: ppback.cachetags depends on this module.
+    from ppback.cachetags import cachetags
+
+    return cachetags
+
+
+async def _stale_value(func: Callable) -> Tuple[str, bytes] | None:
+    if not FastAPICache.get_enable():
+        return None
+    cache_key = _cachetags().building(func)
+    if cache_key is None:
+        return None
+    get_stale = getattr(FastAPICache.get_backend(), "get_stale", None)
+    data = None if get_stale is None else await get_stale(cache_key)
+    return None if data is None else (cache_key, data)
+
+
+def _refresh(
+    key: Hashable, cache_key: str, func: Callable, bound: inspect.BoundArguments
+) -> None:
+    async def refresh() -> None:
+        try:
+            async with SessionLocal() as session:
+                bound.arguments["session"] = session
+                result = await singleflight.do(
+                    key, lambda: func(*bound.args, **bound.kwargs), label=func.__name__
+                )
+            # The backend skips the write if the key was invalidated since.
+            backend = FastAPICache.get_backend()
+            coder = FastAPICache.get_coder()
+            await backend.set(cache_key, coder.encode(result), CACHE_TTL_S)
+        except Exception:
+            logger.exception("refreshing stale cache entry %s failed", cache_key)
+
+    # The task copies this context, so the write is checked against the
+    # invalidations since this task built the key.
+    task = asyncio.get_running_loop().create_task(refresh())
+    singleflight.refreshes.add(task)
+    task.add_done_callback(singleflight.refreshes.discard)
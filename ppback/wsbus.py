@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, Set
+
+logger = logging.getLogger("ppback.wsbus")
+
+BusHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more.
+NOTIFY_MAX_BYTES = 7999
+
+
+def encode_event(event: Dict[str, Any]) -> str:
+    # Non-ASCII text stays as UTF-8 rather than six-byte \uXXXX escapes.
+    return json.dumps(event, ensure_ascii=False)
+
+
+def event_bytes(event: Any) -> int:
+    """Encoded size of an event, or of a part of one."""
+    return len(encode_event(event).encode())
+
+
+class InProcessBus:
+    """Hands every event straight to the sockets of the current process.
+
+    Events are passed as they are, so there is no size limit.
+    """
+
+    def __init__(self, handler: BusHandler):
+        self.handler = handler
+
+    async def start(self) -> None:
+        return None
+
+    async def stop(self) -> None:
+        return None
+
+    max_event_bytes: int | None = None
+
+    async def publish(self, event: Dict[str, Any]) -> None:
+        await self.handler(event)
+
+
+class PostgresBus:
+    """Fans events out to every worker through Postgres LISTEN/NOTIFY.
+
+    The publishing worker does not deliver locally: it receives its own
+    notification like every other listener, so each socket, which lives in
+    exactly one process, gets the event exactly once. Notifications sent
+    while the listener is reconnecting are lost, so after a reconnect the
+    handler gets a local ``reset`` event. A notification must stay under
+    8000 bytes (``max_event_bytes``, as measured by ``event_bytes``), so
+    publishers split or trim message events to fit.
+    """
+
+    max_event_bytes: int | None = NOTIFY_MAX_BYTES
+
+    def __init__(self, dsn: str, handler: BusHandler, channel: str = "pp_ws_events"):
+        self.dsn = dsn
+        self.handler = handler
+        self.channel = channel
+        self._listen_conn = None
+        self._publish_conn = None
+        self._publish_lock = asyncio.Lock()
+        self._watch_task: asyncio.Task | None = None
+        # The loop only keeps weak references to tasks.
+        self._deliveries: Set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        await self._connect_listener()
+        self._watch_task = asyncio.create_task(self._watch_listener())
+
+    async def stop(self) -> None:
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+        for conn in (self._listen_conn, self._publish_conn):
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        self._listen_conn = None
+        self._publish_conn = None
+
+    async def publish(self, event: Dict[str, Any]) -> None:
+        import asyncpg
+
+        async with self._publish_lock:
+            if self._publish_conn is None or self._publish_conn.is_closed():
+                self._publish_conn = await asyncpg.connect(self.dsn)
+            await self._publish_conn.execute(
+                "SELECT pg_notify($1, $2)", self.channel, encode_event(event)
+            )
+
+    async def _connect_listener(self) -> None:
+        import asyncpg
+
+        self._listen_conn = await asyncpg.connect(self.dsn)
+        await self._listen_conn.add_listener(self.channel, self._on_notify)
+        logger.info("listening for websocket events on channel %s", self.channel)
+
+    async def _watch_listener(self) -> None:
+        while True:
+            await asyncio.sleep(1)
+            if self._listen_conn is not None and not self._listen_conn.is_closed():
+                continue
+            logger.warning("websocket bus listener lost, reconnecting")
+            try:
+                await self._connect_listener()
+            except Exception:
+                logger.exception("websocket bus reconnect failed")
+                continue
+            # Notifications sent while disconnected are gone for good.
+            await self._deliver_reset()
+
+    async def _deliver_reset(self) -> None:
+        try:
+            await self.handler({"kind": "reset"})
+        except Exception:
+            logger.exception("websocket bus reset failed")
+
+    def _on_notify(self, _conn, _pid, _channel, payload: str) -> None:
+        task = asyncio.get_running_loop().create_task(self._deliver(payload))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, payload: str) -> None:
+        try:
+            await self.handler(json.loads(payload))
+        except Exception:
+            logger.exception("websocket bus delivery failed")
+
+
+def create_bus(backend: str, handler: BusHandler, dsn: str = ""):
+    """Build the broadcast bus selected by ``PPBACK_WS_BUS``."""
+    if backend == "inprocess":
+        return InProcessBus(handler)
+    if backend == "postgres":
+        if not dsn.startswith(("postgresql://", "postgres://", "postgresql+asyncpg://")):
+            raise ValueError("the postgres websocket bus needs a Postgres DB_SESSION_STR")
+        return PostgresBus(dsn.replace("postgresql+asyncpg://", "postgresql://", 1), handler)
+    raise ValueError(f"unknown websocket bus backend {backend!r}")
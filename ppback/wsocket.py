@@ -1,23 +1,137 @@
 import asyncio
+import inspect
+import json
 import logging
-from typing import List, Tuple
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Set, Tuple
 
 import fastapi
 from opentelemetry import trace
 
-from ppback.ppschema import MessageWS
+from ppback.config import (
+    WS_REPLAY_BUFFER_CONVS,
+    WS_REPLAY_BUFFER_SIZE,
+    WS_SEND_QUEUE_SIZE,
+    WS_SEND_TIMEOUT_S,
+)
+from ppback.middleware.metrics import (
+    WS_BROADCAST_FANOUT,
+    WS_CONNECTED_SOCKETS,
+    WS_CONNECTED_USERS,
+    WS_SEND_DURATION,
+    WS_SEND_FAILURES,
+    WS_SLOW_CONSUMER_DROPS,
+    WS_USERS_BY_SOCKET_COUNT,
+)
+from ppback.ppschema import MessageSchema, MessageWS, MessageWSInline
+from ppback.wsbus import InProcessBus, event_bytes
 
 tracer = trace.get_tracer(__name__)
 logger = logging.getLogger("ppback.wsocket")
 
 
+class SocketConnection:
+    """A registered socket with its own bounded outbound queue.
+
+    A dedicated writer task drains the queue, so a slow client only ever
+    delays its own frames and never the broadcaster.
+    """
+
+    def __init__(
+        self, user_id: int, idx: int, websocket, queue_size: int, inline: bool = False
+    ):
+        self.user_id = user_id
+        self.idx = idx
+        self.websocket = websocket
+        self.inline = inline
+        self.queue: asyncio.Queue[str] = asyncio.Queue(queue_size)
+        self.loop = asyncio.get_running_loop()
+        self.writer: asyncio.Task | None = None
+        self.conv_ids: Set[int] = set()
+
+
+def message_event_payloads(convo_id: int, message: MessageSchema) -> Tuple[str, str]:
+    """Serialize the id-only and the inline ``message.created`` event."""
+    event = MessageWS(
+        conversation_id=convo_id,
+        message_id=message.id,
+        sender_id=message.sender,
+        ts=message.ts,
+    )
+    inline_event = MessageWSInline(**event.model_dump(), message=message)
+    return event.model_dump_json(), inline_event.model_dump_json()
+
+
+class ReplayBuffer:
+    """Recent message events per conversation, for reconnect replay.
+
+    Each conversation keeps its last ``size`` events; only the ``max_convs``
+    most recently active conversations are kept. ``floor`` records, per
+    conversation, the id above which every event is still buffered.
+    """
+
+    def __init__(self, size=WS_REPLAY_BUFFER_SIZE, max_convs=WS_REPLAY_BUFFER_CONVS):
+        self.size = size
+        self.max_convs = max_convs
+        self.events: OrderedDict[int, Deque[Tuple[int, str, str]]] = OrderedDict()
+        self.floor: Dict[int, int] = {}
+
+    def record(self, conv_id: int, message_id: int, payload: str, inline_payload: str):
+        events = self.events.get(conv_id)
+        if events is None:
+            events = self.events[conv_id] = deque()
+            self.floor[conv_id] = message_id - 1
+            if len(self.events) > self.max_convs:
+                evicted, _ = self.events.popitem(last=False)
+                del self.floor[evicted]
+        else:
+            self.events.move_to_end(conv_id)
+        if len(events) >= self.size:
+            self.floor[conv_id] = events.popleft()[0]
+        events.append((message_id, payload, inline_payload))
+
+    def clear(self) -> None:
+        self.events.clear()
+        self.floor.clear()
+
+    def covers(self, conv_id: int, last_seen: int) -> bool:
+        return conv_id in self.floor and last_seen >= self.floor[conv_id]
+
+    def since(self, conv_id: int, last_seen: int) -> List[Tuple[int, str, str]]:
+        return [e for e in self.events.get(conv_id, ()) if e[0] > last_seen]
+
+
 class InMemSockets:
-    """Keeping sockets open, in a global memory object."""
+    """Keeping sockets open, in a global memory object.
+
+    Sockets are indexed by user id, then by connection index, so adding,
+    dropping and looking up the sockets of a user never scans the other
+    connections. A second index maps each conversation to the connections
+    subscribed to it, so a message broadcast only touches sockets that are
+    online for that conversation.
+    """
 
-    def __init__(self, limit=5):
-        self.items: List[Tuple[int, fastapi.WebSocket, int]] = []
+    def __init__(
+        self, limit=5, queue_size=WS_SEND_QUEUE_SIZE, send_timeout=WS_SEND_TIMEOUT_S
+    ):
+        self.users: Dict[int, Dict[int, SocketConnection]] = {}
+        self.convs: Dict[int, Set[SocketConnection]] = {}
         self.limit = limit
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
         self.idx = 0
+        self.total = 0
+        self.users_by_count: Dict[int, int] = {}
+        self.bus = InProcessBus(self.deliver_local)
+        self.replay = ReplayBuffer()
+        self.message_listeners: List[Callable[[int, MessageSchema], None]] = []
+        self.user_change_listeners: List[Callable[[List[int]], None]] = []
+        self.invalidation_listeners: List[Callable[[List[str]], Awaitable[Any]]] = []
+        self.reset_listeners: List[Callable[[], Any]] = []
+        self.message_loader: (
+            Callable[[List[int]], Awaitable[Dict[int, MessageSchema]]] | None
+        ) = None
 
     def gen_idx(self):
         self.idx += 1
@@ -26,57 +140,374 @@ class InMemSockets:
     def can_add_user(self, user_id):
         return self.count_for_user(user_id) < self.limit
 
-    def add_user(self, user_id, socket) -> int:
+    def add_user(self, user_id, socket, inline=False) -> int:
         idx = self.gen_idx()
-        self.items.append((user_id, socket, idx))
+        conn = SocketConnection(user_id, idx, socket, self.queue_size, inline)
+        conn.writer = conn.loop.create_task(self._writer(conn))
+        sockets = self.users.setdefault(user_id, {})
+        sockets[idx] = conn
+        self.total += 1
+        self._count_changed(len(sockets) - 1, len(sockets))
         return idx
 
     def count_for_user(self, user_id):
-        return len(self.get_sockets_for(user_id))
+        return len(self.users.get(user_id, ()))
 
     def drop_user(self, user_id, idx):
-        self.items = [
-            _ for _ in self.items if not ((_[0] == user_id) and (_[2] == idx))
-        ]
+        sockets = self.users.get(user_id)
+        if sockets is None:
+            return
+        conn = sockets.pop(idx, None)
+        if conn is not None:
+            self.total -= 1
+            self._count_changed(len(sockets) + 1, len(sockets))
+            for conv_id in conn.conv_ids:
+                subscribers = self.convs.get(conv_id)
+                if subscribers is not None:
+                    subscribers.discard(conn)
+                    if not subscribers:
+                        del self.convs[conv_id]
+            if conn.writer is not None and conn.writer is not asyncio.current_task():
+                conn.writer.cancel()
+        if not sockets:
+            del self.users[user_id]
 
-    def get_sockets_for(self, user_id):
-        return [_[1] for _ in self.items if _[0] == user_id]
+    def _count_changed(self, before: int, after: int) -> None:
+        if before:
+            self.users_by_count[before] -= 1
+        if after:
+            self.users_by_count[after] = self.users_by_count.get(after, 0) + 1
 
-    def get_sockets_for_many(self, user_ids) -> List[fastapi.WebSocket]:
-        res = []
-        for u in user_ids:
-            res += self.get_sockets_for(u)
-        return res
+    def subscribe(self, user_id, conv_ids) -> None:
+        """Subscribe every socket of ``user_id`` held here to ``conv_ids``."""
+        for conn in self.users.get(user_id, {}).values():
+            for conv_id in conv_ids:
+                conn.conv_ids.add(conv_id)
+                self.convs.setdefault(conv_id, set()).add(conn)
 
-    async def broadcast_message_to_users(
-        self,
-        from_user_id: int,
-        convo_id,
-        user_ids: List[int],
-        msg_id: int,
-        ts: float,
+    def send_to(self, user_id, idx, payload: str) -> None:
+        """Queue a frame for one socket, behind any pending broadcasts."""
+        conn = self.users.get(user_id, {}).get(idx)
+        if conn is not None:
+            self._enqueue(conn, payload)
+
+    def get_connections_for_conv(self, conv_id) -> List[SocketConnection]:
+        return list(self.convs.get(conv_id, ()))
+
+    def get_sockets_for(self, user_id) -> List[fastapi.WebSocket]:
+        return [conn.websocket for conn in self.users.get(user_id, {}).values()]
+
+    def add_message_listener(self, listener: Callable[[int, MessageSchema], None]):
+        """Call ``listener(conv_id, message)`` for every delivered message."""
+        self.message_listeners.append(listener)
+
+    def add_user_change_listener(self, listener: Callable[[List[int]], None]):
+        """Call ``listener(user_ids)`` when memberships or friendships change."""
+        self.user_change_listeners.append(listener)
+
+    def add_invalidation_listener(
+        self, listener: Callable[[List[str]], Awaitable[Any]]
     ):
-        async def _safe_send(websocket: fastapi.WebSocket, payload: str) -> None:
-            try:
-                await asyncio.wait_for(websocket.send_text(payload), timeout=1)
-            except Exception:
-                logger.debug("websocket broadcast send failed", exc_info=True)
+        """Await ``listener(tags)`` when cached entries must be dropped."""
+        self.invalidation_listeners.append(listener)
+
+    def add_reset_listener(self, listener: Callable[[], Any]):
+        """Call ``listener()`` when this process may have missed bus events.
+
+        Anything kept up to date from bus events must forget it then. A
+        listener returning an awaitable is awaited.
+        """
+        self.reset_listeners.append(listener)
+
+    async def reset_local(self) -> None:
+        """Drop state fed by bus events after some of them were lost."""
+        logger.warning("bus events may have been lost, resetting local state")
+        self.replay.clear()
+        for listener in self.reset_listeners:
+            result = listener()
+            if inspect.isawaitable(result):
+                await result
+
+    async def _publish(self, event: Dict[str, Any]) -> None:
+        # Callers have already committed; failing them would not undo it.
+        try:
+            await self.bus.publish(event)
+        except Exception:
+            logger.exception("publishing %s event failed", event["kind"])
+            await self.reset_local()
 
-        with tracer.start_as_current_span("broadcast_message_to_users"):
-            coros = []
+    async def use_bus(self, bus) -> None:
+        """Swap the broadcast bus, starting the new one and stopping the old one."""
+        await bus.start()
+        previous, self.bus = self.bus, bus
+        await previous.stop()
+
+    async def broadcast_message_to_conv(self, convo_id: int, message: MessageSchema):
+        """Send a message event to the sockets subscribed to ``convo_id``.
+
+        Recipients come from the subscription index, not from the database.
+        The bus event carries the stored message once; each worker builds
+        the id-only and inline events from it. A message too big for the
+        bus goes by id, and receivers read it back from the database.
+        """
+        with tracer.start_as_current_span("broadcast_message_to_conv"):
+            await self._publish(
+                {"kind": "conv", **self._message_item(convo_id, message)}
+            )
+
+    async def broadcast_messages_to_convs(
+        self, messages: List[Tuple[int, MessageSchema]]
+    ) -> None:
+        """Send many ``(conv_id, message)`` events as one frame per socket.
+
+        Each subscribed socket gets a ``message.batch`` frame with the
+        events of its conversations, in the given order. Events are
+        serialized by the receiving worker, which keeps the bus event small.
+        A batch too big for one bus event is split into several, each
+        delivered as its own frame.
+        """
+        if not messages:
+            return
+        with tracer.start_as_current_span("broadcast_messages_to_convs"):
+            items = [self._message_item(c, m) for c, m in messages]
+            for chunk in self._chunks(items):
+                await self._publish({"kind": "batch", "messages": chunk})
+
+    def _chunks(self, items: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        limit = self.bus.max_event_bytes
+        if limit is None:
+            return [items]
+        chunks: List[List[Dict[str, Any]]] = [[]]
+        size = empty = event_bytes({"kind": "batch", "messages": []})
+        for item in items:
+            item_size = event_bytes(item) + 2  # ", " separator
+            if chunks[-1] and size + item_size > limit:
+                chunks.append([])
+                size = empty
+            chunks[-1].append(item)
+            size += item_size
+        return chunks
+
+    def set_message_loader(
+        self, loader: Callable[[List[int]], Awaitable[Dict[int, MessageSchema]]]
+    ) -> None:
+        """Read messages by id for bus events that only carry their id."""
+        self.message_loader = loader
+
+    def _message_item(self, conv_id: int, message: MessageSchema) -> Dict[str, Any]:
+        """Bus form of a message: with its body if that fits, else by id."""
+        item = {"conv_id": conv_id, "message": message.model_dump()}
+        limit = self.bus.max_event_bytes
+        # A one-message batch is the larger of the two event kinds.
+        if limit is None or event_bytes({"kind": "batch", "messages": [item]}) <= limit:
+            return item
+        return {"conv_id": conv_id, "message_id": message.id}
+
+    async def _load_messages(
+        self, items: List[Dict[str, Any]]
+    ) -> List[Tuple[int, MessageSchema]]:
+        """``(conv_id, message)`` of bus items, reading id-only ones from the DB."""
+        missing = [item["message_id"] for item in items if "message" not in item]
+        loaded: Dict[int, MessageSchema] = {}
+        if missing:
+            if self.message_loader is None:
+                raise RuntimeError("no message loader for id-only bus events")
+            loaded = await self.message_loader(missing)
+        messages = []
+        for item in items:
+            if "message" in item:
+                message = MessageSchema.model_construct(**item["message"])
+            else:
+                message = loaded[item["message_id"]]
+            messages.append((item["conv_id"], message))
+        return messages
+
+    def uncovered(self, resume: Dict[int, int]) -> List[int]:
+        """Conversations whose gap since the client's cursor is not buffered."""
+        return [c for c, last in resume.items() if not self.replay.covers(c, last)]
+
+    def replay_missed(
+        self,
+        user_id: int,
+        idx: int,
+        resume: Dict[int, int],
+        fetched: Dict[int, List[MessageSchema]],
+        truncated: List[int],
+    ) -> None:
+        """Queue one ``replay`` frame with the events a reconnecting socket missed.
+
+        ``fetched`` holds messages read from the database for conversations
+        the buffer did not cover; buffered events newer than those follow.
+        Conversations listed in ``truncated`` are not replayed at all.
+        """
+        conn = self.users.get(user_id, {}).get(idx)
+        if conn is None:
+            return
+        parts = []
+        for conv_id, last_seen in resume.items():
+            if conv_id in truncated:
+                continue
+            for message in fetched.get(conv_id, ()):
+                payload, inline_payload = message_event_payloads(conv_id, message)
+                parts.append(inline_payload if conn.inline else payload)
+                last_seen = message.id
+            for _, payload, inline_payload in self.replay.since(conv_id, last_seen):
+                parts.append(inline_payload if conn.inline else payload)
+        if parts or truncated:
+            frame = '{"type":"replay","events":[%s],"truncated":%s}' % (
+                ",".join(parts),
+                json.dumps(truncated),
+            )
+            self._enqueue(conn, frame)
+
+    async def join_conversation(self, convo_id: int, user_ids: List[int]) -> None:
+        """Subscribe the online sockets of ``user_ids``, in every worker."""
+        await self._publish(
+            {"kind": "join", "conv_id": convo_id, "user_ids": list(user_ids)}
+        )
+
+    async def users_changed(self, user_ids: List[int]) -> None:
+        """Announce to every worker that ``user_ids`` gained or lost peers."""
+        await self._publish({"kind": "users_changed", "user_ids": list(user_ids)})
+
+    async def cache_invalidated(self, tags: List[str]) -> None:
+        """Announce to every worker that cache entries tagged ``tags`` are stale."""
+        await self._publish({"kind": "invalidate", "tags": list(tags)})
+
+    async def deliver_local(self, event: Dict[str, Any]) -> None:
+        """Apply a bus event to the sockets held by this process.
+
+        Message events are only enqueued; this never waits on a client.
+        """
+        kind = event["kind"]
+        if kind == "reset":
+            await self.reset_local()
+            return
+        if kind == "join":
+            for user_id in event["user_ids"]:
+                self.subscribe(user_id, [event["conv_id"]])
+            for listener in self.user_change_listeners:
+                listener(event["user_ids"])
+            return
+        if kind == "users_changed":
+            for listener in self.user_change_listeners:
+                listener(event["user_ids"])
+            return
+        if kind == "invalidate":
+            for listener in self.invalidation_listeners:
+                await listener(event["tags"])
+            return
+        if kind == "batch":
+            await self._deliver_batch(event["messages"])
+            return
+        try:
+            ((conv_id, message),) = await self._load_messages([event])
+        except Exception:
+            logger.exception("loading message %s failed", event.get("message_id"))
+            await self.reset_local()
+            return
+        plain_payload, inline_payload = message_event_payloads(conv_id, message)
+        self.replay.record(conv_id, message.id, plain_payload, inline_payload)
+        for listener in self.message_listeners:
+            listener(conv_id, message)
+        conns = self.get_connections_for_conv(conv_id)
+
+        WS_BROADCAST_FANOUT.observe(len(conns))
+        for conn in conns:
+            self._enqueue_from_any_loop(
+                conn, inline_payload if conn.inline else plain_payload
+            )
+
+    async def _deliver_batch(self, items: List[Dict[str, Any]]) -> None:
+        try:
+            messages = await self._load_messages(items)
+        except Exception:
+            logger.exception("loading batched messages failed")
+            await self.reset_local()
+            return
+        parts: Dict[SocketConnection, List[str]] = {}
+        for conv_id, message in messages:
+            payload, inline_payload = message_event_payloads(conv_id, message)
+            self.replay.record(conv_id, message.id, payload, inline_payload)
+            for listener in self.message_listeners:
+                listener(conv_id, message)
+            for conn in self.get_connections_for_conv(conv_id):
+                parts.setdefault(conn, []).append(
+                    inline_payload if conn.inline else payload
+                )
+
+        WS_BROADCAST_FANOUT.observe(len(parts))
+        for conn, events in parts.items():
+            frame = '{"type":"message.batch","events":[%s]}' % ",".join(events)
+            self._enqueue_from_any_loop(conn, frame)
+
+    def _enqueue_from_any_loop(self, conn: SocketConnection, payload: str) -> None:
+        if conn.loop is asyncio.get_running_loop():
+            self._enqueue(conn, payload)
+        else:
+            conn.loop.call_soon_threadsafe(self._enqueue, conn, payload)
+
+    def _enqueue(self, conn: SocketConnection, payload: str) -> None:
+        try:
+            conn.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self._evict(conn)
+
+    def _evict(self, conn: SocketConnection) -> None:
+        if self.users.get(conn.user_id, {}).get(conn.idx) is not conn:
+            return
+        logger.warning(
+            "dropping slow websocket consumer user=%s idx=%s", conn.user_id, conn.idx
+        )
+        WS_SLOW_CONSUMER_DROPS.inc()
+        self._disconnect(conn)
+
+    def _disconnect(self, conn: SocketConnection) -> None:
+        self.drop_user(conn.user_id, conn.idx)
+        conn.loop.create_task(self._close(conn.websocket))
+
+    async def _close(self, websocket) -> None:
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            logger.debug("closing evicted websocket failed", exc_info=True)
+
+    async def _writer(self, conn: SocketConnection) -> None:
+        while True:
+            payload = await conn.queue.get()
+            start_time = time.monotonic()
+            try:
+                async with asyncio.timeout(self.send_timeout):
+                    await conn.websocket.send_text(payload)
+            except asyncio.TimeoutError:
+                # A peer stalled at the TCP level never fills a quiet queue.
+                WS_SEND_FAILURES.labels(reason="timeout").inc()
+                logger.warning(
+                    "websocket send timed out user=%s idx=%s", conn.user_id, conn.idx
+                )
+                self._disconnect(conn)
+                return
+            except Exception as exc:
+                reason = (
+                    "disconnected"
+                    if isinstance(exc, (fastapi.WebSocketDisconnect, RuntimeError))
+                    else "error"
+                )
+                WS_SEND_FAILURES.labels(reason=reason).inc()
+                logger.debug("websocket send failed, dropping socket", exc_info=True)
+                self.drop_user(conn.user_id, conn.idx)
+                return
+            WS_SEND_DURATION.observe(time.monotonic() - start_time)
 
-            message_json_payload = MessageWS(
-                conversation_id=convo_id,
-                message_id=msg_id,
-                sender_id=from_user_id,
-                ts=ts,
-            ).model_dump_json()
-            for websocket in self.get_sockets_for_many(user_ids):
-                coros.append(_safe_send(websocket, message_json_payload))
 
-            if coros:
-                with tracer.start_as_current_span("bcast_gather"):
-                    await asyncio.gather(*coros, return_exceptions=True)
+def _export_gauges(sockets: InMemSockets) -> None:
+    WS_CONNECTED_SOCKETS.set_function(lambda: sockets.total)
+    WS_CONNECTED_USERS.set_function(lambda: len(sockets.users))
+    for count in range(1, sockets.limit + 1):
+        WS_USERS_BY_SOCKET_COUNT.labels(sockets=str(count)).set_function(
+            lambda count=count: sockets.users_by_count.get(count, 0)
+        )
 
 
 inmemsockets = InMemSockets()
+_export_gauges(inmemsockets)
@@ -3,13 +3,16 @@ import os
 
 os.environ["DB_SESSION_STR"] = "sqlite:////tmp/pp-test.sqlite"
 os.environ["PPBACK_AUTO_INIT_DB"] = "0"
+# The test client is a single worker, so the bus reaches all of it.
+os.environ["PPBACK_BUS_FED_CACHES"] = "1"
 
 import pytest
 from fastapi.testclient import TestClient
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend
 from sqlalchemy import select
 
+from ppback.cachebackend import BoundedMemoryBackend
+from ppback.cachetags import cachetags
 from ppback.config import SessionLocal, dbengine
 from ppback.db.dbfuncs import (
     accept_friend_request,
@@ -19,7 +22,17 @@ from ppback.db.dbfuncs import (
     submit_invite_code,
 )
 from ppback.db.ppdb_schemas import Base, FriendRequest, UserInfo
+from ppback.etags import validators
 from ppback.main import app
+from ppback.msgcache import hottail
+from ppback.rendered import rendered
+from ppback.wsocket import inmemsockets
+
+
+@pytest.fixture(scope="session", autouse=True)
+def dispose_engine():
+    yield
+    asyncio.run(dbengine.dispose())
 
 
 @pytest.fixture()
@@ -66,10 +79,15 @@ def client():
             await conn.run_sync(Base.metadata.drop_all)
 
     asyncio.run(setup_db())
+    inmemsockets.replay.clear()
+    hottail.clear()
+    validators.clear()
+    rendered.clear()
 
-    cache_backend = InMemoryBackend()
+    cache_backend = BoundedMemoryBackend()
     FastAPICache.reset()
     FastAPICache.init(cache_backend, prefix="fastapi-cache")
+    cachetags.track(cache_backend)
 
     client = TestClient(app)
     try:
@@ -117,5 +135,5 @@ def client():
     finally:
         client.close()
         FastAPICache.reset()
-        cache_backend._store.clear()
+        cachetags.clear()
         asyncio.run(teardown_db())
@@ -1,5 +1,7 @@
 import pytest
 
+from ppback.rendered import rendered
+
 
 @pytest.mark.asyncio
 async def test_get_conversations(client):
@@ -32,3 +34,102 @@ async def test_create_conversation_keeps_creator_in_members(client):
     data = response.json()
     assert data["label"] == "cache_type_conv"
     assert sorted(data["members"]) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_groups_members_per_conversation(client):
+    client, (_alice_token, _bob_token, charlie_token, _diana_token) = client
+    response = client.get("/conv", headers={"Authorization": f"Bearer {charlie_token}"})
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "conversations": [
+            {"id": 1, "label": "general", "members": [1, 2, 3], "unread": 0}
+        ]
+    }
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_etag_changes_with_membership(client):
+    client, (alice_token, _bob_token, charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {charlie_token}"}
+
+    etag = client.get("/conv", headers=headers).headers["ETag"]
+    cached = client.get("/conv", headers={**headers, "If-None-Match": etag})
+    assert cached.status_code == 304
+
+    client.post(
+        "/conv",
+        headers={"Authorization": f"Bearer {alice_token}"},
+        json={"label": "with_charlie", "members": [3]},
+    )
+    changed = client.get("/conv", headers={**headers, "If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    labels = [conv["label"] for conv in changed.json()["conversations"]]
+    assert labels == ["general", "with_charlie"]
+
+
+@pytest.mark.asyncio
+async def test_new_member_can_read_right_away(client):
+    client, (alice_token, _bob_token, charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {charlie_token}"}
+
+    # conv 3 does not exist yet: the denial is cached
+    assert client.get("/conv/3/messages", headers=headers).status_code != 200
+
+    client.post(
+        "/conv",
+        headers={"Authorization": f"Bearer {alice_token}"},
+        json={"label": "with_charlie", "members": [3]},
+    )
+    assert client.get("/conv/3/messages", headers=headers).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_unread_counts_follow_the_read_cursor(client):
+    client, (alice_token, bob_token, _charlie_token, _diana_token) = client
+    alice = {"Authorization": f"Bearer {alice_token}"}
+    bob = {"Authorization": f"Bearer {bob_token}"}
+    ids = [
+        client.post(
+            "/usermsg", json={"content": f"m{i}", "conversation_id": 1}, headers=alice
+        ).json()["messageid"]
+        for i in range(3)
+    ]
+
+    def unread(headers):
+        convs = client.get("/conv", headers=headers).json()["conversations"]
+        return {c["id"]: c["unread"] for c in convs}
+
+    assert unread(bob) == {1: 3, 2: 0}
+    assert unread(alice) == {1: 0, 2: 0}
+
+    response = client.post("/conv/1/read", json={"message_id": ids[1]}, headers=bob)
+    assert response.status_code == 200
+    assert unread(bob) == {1: 1, 2: 0}
+
+    client.post("/conv/1/read", json={"message_id": ids[0]}, headers=bob)
+    assert unread(bob) == {1: 1, 2: 0}
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_is_served_from_its_rendered_body(client):
+    client, (alice_token, bob_token, _charlie_token, _diana_token) = client
+    bob = {"Authorization": f"Bearer {bob_token}"}
+
+    first = client.get("/conv", headers=bob)
+    cached = client.get("/conv", headers=bob)
+    assert cached.content == first.content
+    assert cached.headers["ETag"] == first.headers["ETag"]
+    assert rendered.bodies[("conv", 2)].body == first.content
+
+    # A new message changes the tag, so the stored body is not served.
+    client.post(
+        "/usermsg",
+        json={"content": "fresh", "conversation_id": 1},
+        headers={"Authorization": f"Bearer {alice_token}"},
+    )
+    fresh = client.get("/conv", headers=bob)
+    assert fresh.headers["ETag"] != first.headers["ETag"]
+    assert fresh.json()["conversations"][0]["unread"] == 1
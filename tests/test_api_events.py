@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from ppback.main import app
+from ppback.ppschema import MessageSchema
+from ppback.routers import events
+from ppback.routers.events import EventStreamSink, stream_events
+from ppback.wsocket import InMemSockets, inmemsockets
+
+
+def test_event_stream_requires_a_token(client):
+    client, _tokens = client
+
+    response = client.get("/events")
+
+    assert response.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_event_stream_forwards_registry_fan_out():
+    registry = InMemSockets()
+    sink = EventStreamSink()
+    idx = registry.add_user(1, sink)
+    registry.subscribe(1, [5])
+    stream = stream_events(registry, 1, idx, sink, keepalive=0.01)
+
+    assert await anext(stream) == ": connected\n\n"
+    await registry.broadcast_message_to_conv(
+        5, MessageSchema(id=3, content="hi", sender=2, ts=1.5)
+    )
+    frame = await anext(stream)
+    assert frame.startswith("data: ") and frame.endswith("\n\n")
+    assert json.loads(frame[len("data: "):]) == {
+        "type": "message.created",
+        "conversation_id": 5,
+        "message_id": 3,
+        "sender_id": 2,
+        "ts": 1.5,
+    }
+    assert await anext(stream) == ": keep-alive\n\n"
+
+    await stream.aclose()
+    assert registry.count_for_user(1) == 0
+
+
+@pytest.mark.asyncio
+async def test_event_stream_route_delivers_posted_messages(client):
+    _client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {alice_token}"}
+    sent = asyncio.Queue()
+    disconnect = asyncio.Event()
+
+    async def receive():
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    # The test client buffers whole bodies, so the stream is read from ASGI.
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/events",
+        "raw_path": b"/events",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"authorization", headers["Authorization"].encode())],
+        "client": ("testclient", 50000),
+        "server": ("testserver", 80),
+    }
+    stream = asyncio.create_task(app(scope, receive, sent.put))
+
+    start = await asyncio.wait_for(sent.get(), 5)
+    assert start["status"] == 200
+    assert (await sent.get())["body"] == b": connected\n\n"
+    assert inmemsockets.count_for_user(1) == 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        posted = await http.post(
+            "/usermsg",
+            json={"content": "hello over sse", "conversation_id": 1},
+            headers=headers,
+        )
+    frame = (await asyncio.wait_for(sent.get(), 5))["body"].decode()
+
+    assert frame.startswith("data: ") and frame.endswith("\n\n")
+    event = json.loads(frame[len("data: "):])
+    assert event["type"] == "message.created"
+    assert event["conversation_id"] == 1
+    assert event["message_id"] == posted.json()["messageid"]
+
+    disconnect.set()
+    await asyncio.wait_for(stream, 5)
+    assert inmemsockets.count_for_user(1) == 0
+
+
+def test_event_stream_is_unregistered_when_its_query_fails(client, monkeypatch):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+
+    async def broken(session, user_id):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(events, "conv_ids_for_user", broken)
+
+    with pytest.raises(RuntimeError):
+        client.get("/events", headers={"Authorization": f"Bearer {alice_token}"})
+    assert inmemsockets.count_for_user(1) == 0
@@ -1,8 +1,32 @@
+import asyncio
+import json
+import time
+
+import pytest
+from sqlalchemy import event
+from starlette.websockets import WebSocketDisconnect
+
+from ppback.config import SessionLocal, dbengine
+from ppback.db.ppdb_schemas import ConvoMessage
+from ppback.etags import validators
+from ppback.msgcache import hottail
+from ppback.wsocket import inmemsockets
+
+
+def _authenticate(websocket, token, **packet):
+    """Send the auth packet; return the frames queued before ``ready``."""
+    websocket.send_json({"token": token, **packet})
+    frames = []
+    while (frame := websocket.receive_json())["type"] != "ready":
+        frames.append(frame)
+    return frames
+
+
 def test_post_message_emits_resync_websocket_event(client):
-    client, (alice_token, _bob_token, _charlie_token) = client
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
 
     with client.websocket_connect("/ws") as websocket:
-        websocket.send_json({"token": alice_token})
+        assert _authenticate(websocket, alice_token) == []
 
         response = client.post(
             "/usermsg",
@@ -26,7 +50,7 @@ def test_post_message_emits_resync_websocket_event(client):
 
 
 def test_conversation_messages_after_uses_exclusive_cursor(client):
-    client, (alice_token, _bob_token, _charlie_token) = client
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
     headers = {"Authorization": f"Bearer {alice_token}"}
 
     first_response = client.post(
@@ -53,3 +77,449 @@ def test_conversation_messages_after_uses_exclusive_cursor(client):
     messages = response.json()
     assert [message["content"] for message in messages] == ["second"]
     assert messages[0]["id"] == second_response.json()["messageid"]
+
+
+def test_new_conversation_members_receive_events_on_open_socket(client):
+    client, (alice_token, bob_token, _charlie_token, _diana_token) = client
+
+    with client.websocket_connect("/ws") as websocket:
+        assert _authenticate(websocket, bob_token) == []
+
+        conv = client.post(
+            "/conv",
+            json={"label": "late_join", "members": [2]},
+            headers={"Authorization": f"Bearer {alice_token}"},
+        ).json()
+        posted = client.post(
+            "/usermsg",
+            json={"content": "welcome", "conversation_id": conv["id"]},
+            headers={"Authorization": f"Bearer {alice_token}"},
+        ).json()
+
+        event = websocket.receive_json()
+
+    assert event["conversation_id"] == conv["id"]
+    assert event["message_id"] == posted["messageid"]
+
+
+def test_inline_socket_receives_message_body(client):
+    client, (alice_token, bob_token, _charlie_token, _diana_token) = client
+
+    with client.websocket_connect("/ws") as websocket:
+        assert _authenticate(websocket, bob_token, inline_messages=True) == []
+
+        posted = client.post(
+            "/usermsg",
+            json={"content": "inline hello", "conversation_id": 1},
+            headers={"Authorization": f"Bearer {alice_token}"},
+        ).json()
+
+        event = websocket.receive_json()
+
+    assert event["type"] == "message.created"
+    assert event["message_id"] == posted["messageid"]
+    assert event["message"] == {
+        "id": posted["messageid"],
+        "content": "inline hello",
+        "sender": 1,
+        "message_type": "text",
+        "ts": event["ts"],
+    }
+
+
+def test_post_message_over_websocket_is_acked_and_broadcast(client):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {alice_token}"}
+
+    with client.websocket_connect("/ws") as websocket:
+        assert _authenticate(websocket, alice_token) == []
+        websocket.send_json(
+            {
+                "type": "message.create",
+                "conversation_id": 1,
+                "content": "sent over ws",
+                "ref": "c-1",
+            }
+        )
+        frames = [websocket.receive_json(), websocket.receive_json()]
+
+    by_type = {frame["type"]: frame for frame in frames}
+    ack = by_type["message.ack"]
+    assert ack["ref"] == "c-1"
+    assert by_type["message.created"]["message_id"] == ack["message_id"]
+
+    messages = client.get("/conv/1/messages", headers=headers).json()
+    assert messages[-1]["id"] == ack["message_id"]
+    assert messages[-1]["content"] == "sent over ws"
+
+
+def test_post_message_over_websocket_rejected_outside_conversation(client):
+    client, (_alice_token, _bob_token, charlie_token, _diana_token) = client
+
+    with client.websocket_connect("/ws") as websocket:
+        assert _authenticate(websocket, charlie_token) == []
+        websocket.send_json(
+            {
+                "type": "message.create",
+                "conversation_id": 2,
+                "content": "not a member",
+                "ref": "c-2",
+            }
+        )
+        reply = websocket.receive_json()
+
+    assert reply == {
+        "type": "message.error",
+        "ref": "c-2",
+        "detail": "error posting message",
+    }
+
+
+def test_bad_message_create_frames_get_an_error_reply(client, monkeypatch):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+
+    async def failing_post(*args):
+        raise RuntimeError("database went away")
+
+    with client.websocket_connect("/ws") as websocket:
+        assert _authenticate(websocket, alice_token) == []
+        websocket.send_json({"type": "message.create", "ref": 5})
+        invalid = websocket.receive_json()
+
+        monkeypatch.setattr("ppback.routers.ws.post_message", failing_post)
+        websocket.send_json(
+            {"type": "message.create", "conversation_id": 1, "content": "x", "ref": "c-3"}
+        )
+        failed = websocket.receive_json()
+
+    assert invalid == {
+        "type": "message.error",
+        "ref": None,
+        "detail": "invalid message.create frame",
+    }
+    assert failed == {
+        "type": "message.error",
+        "ref": "c-3",
+        "detail": "error posting message",
+    }
+
+
+def _post(client, token, content, conversation_id=1):
+    return client.post(
+        "/usermsg",
+        json={"content": content, "conversation_id": conversation_id},
+        headers={"Authorization": f"Bearer {token}"},
+    ).json()["messageid"]
+
+
+def _post_from_another_worker(content, conversation_id=1):
+    """Insert a message without any bus event reaching this process."""
+
+    async def insert():
+        async with SessionLocal() as db:
+            message = ConvoMessage(
+                conv_id=conversation_id, sender_id=1, ts=time.time(), content=content
+            )
+            db.add(message)
+            await db.commit()
+            return message.id
+
+    return asyncio.run(insert())
+
+
+def test_reconnect_replays_missed_events_from_buffer(client):
+    client, (alice_token, bob_token, _charlie_token, _diana_token) = client
+    first = _post(client, alice_token, "seen")
+    second = _post(client, alice_token, "missed")
+
+    with client.websocket_connect("/ws") as websocket:
+        (replay,) = _authenticate(websocket, bob_token, resume={"1": first, "2": 0})
+
+    assert replay["type"] == "replay"
+    assert replay["truncated"] == []
+    assert [e["message_id"] for e in replay["events"]] == [second]
+
+
+def test_reconnect_replay_falls_back_to_database(client):
+    client, (alice_token, bob_token, _charlie_token, _diana_token) = client
+    first = _post(client, alice_token, "seen")
+    second = _post(client, alice_token, "missed")
+    inmemsockets.replay.clear()
+
+    with client.websocket_connect("/ws") as websocket:
+        (replay,) = _authenticate(
+            websocket, bob_token, inline_messages=True, resume={"1": first}
+        )
+
+    assert [e["message_id"] for e in replay["events"]] == [second]
+    assert replay["events"][0]["message"]["content"] == "missed"
+
+
+def test_conversation_history_pages_with_keyset_cursors(client):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {alice_token}"}
+    ids = [_post(client, alice_token, f"m{i}") for i in range(5)]
+
+    newest = client.get("/conv/1/messages?limit=2", headers=headers)
+    assert [m["id"] for m in newest.json()] == ids[3:]
+    cursor = newest.headers["X-Next-Cursor"]
+    assert cursor == str(ids[3])
+
+    older = client.get(f"/conv/1/messages?limit=2&before={cursor}", headers=headers)
+    assert [m["id"] for m in older.json()] == ids[1:3]
+    oldest = client.get(
+        f"/conv/1/messages?limit=2&before={older.headers['X-Next-Cursor']}",
+        headers=headers,
+    )
+    assert [m["id"] for m in oldest.json()] == ids[:1]
+    assert "X-Next-Cursor" not in oldest.headers
+
+    forward = client.get(f"/conv/1/messages?limit=2&after={ids[0]}", headers=headers)
+    assert [m["id"] for m in forward.json()] == ids[1:3]
+    assert forward.headers["X-Next-Cursor"] == str(ids[2])
+
+
+def test_conversation_export_streams_ndjson(client, monkeypatch):
+    client, (alice_token, _bob_token, charlie_token, _diana_token) = client
+    monkeypatch.setattr("ppback.routers.messaging.EXPORT_CHUNK_ROWS", 2)
+    ids = [_post(client, alice_token, f"m{i}") for i in range(5)]
+    _post(client, alice_token, "elsewhere", conversation_id=2)
+
+    response = client.get(
+        "/conv/1/messages/export",
+        headers={"Authorization": f"Bearer {alice_token}"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [m["id"] for m in lines] == ids
+    assert lines[0] == {
+        "id": ids[0],
+        "content": "m0",
+        "sender": 1,
+        "message_type": "text",
+        "ts": lines[0]["ts"],
+    }
+
+    denied = client.get(
+        "/conv/2/messages/export",
+        headers={"Authorization": f"Bearer {charlie_token}"},
+    )
+    assert denied.status_code == 500
+
+
+def test_history_answers_not_modified_until_a_new_message(client):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {alice_token}"}
+    _post(client, alice_token, "one")
+
+    first = client.get("/conv/1/messages", headers=headers)
+    etag = first.headers["ETag"]
+    unchanged = client.get(
+        "/conv/1/messages", headers={**headers, "If-None-Match": etag}
+    )
+    assert unchanged.status_code == 304
+    assert unchanged.headers["ETag"] == etag
+
+    _post(client, alice_token, "two")
+    changed = client.get("/conv/1/messages", headers={**headers, "If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert [m["content"] for m in changed.json()] == ["one", "two"]
+
+
+def test_long_poll_returns_newer_messages_or_times_out(client):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {alice_token}"}
+    first = _post(client, alice_token, "one")
+    second = _post(client, alice_token, "two")
+
+    ready = client.get(f"/conv/1/messages?after={first}&wait=5", headers=headers)
+    assert [m["id"] for m in ready.json()] == [second]
+
+    idle = client.get(f"/conv/1/messages?after={second}&wait=0.05", headers=headers)
+    assert idle.status_code == 200
+    assert idle.json() == []
+
+
+def test_message_search_is_scoped_to_members(client):
+    client, (alice_token, bob_token, charlie_token, _diana_token) = client
+    general = _post(client, alice_token, "the quarterly report is ready")
+    private = _post(client, alice_token, "draft report for bob", conversation_id=2)
+    _post(client, bob_token, "lunch anyone?")
+
+    def search(token, query):
+        response = client.get(
+            "/messages/search",
+            params={"q": query},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        assert response.status_code == 200
+        return response.json()
+
+    hits = search(bob_token, "report")
+    assert [(h["conversation_id"], h["id"]) for h in hits] == [
+        (2, private),
+        (1, general),
+    ]
+    assert hits[1]["content"] == "the quarterly report is ready"
+    assert [h["id"] for h in search(charlie_token, "report")] == [general]
+    assert [h["id"] for h in search(bob_token, 'quarterly "report')] == [general]
+    assert search(bob_token, "   ") == []
+
+
+def test_history_reads_stay_fresh_when_served_from_hot_tail(client):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {alice_token}"}
+    first = _post(client, alice_token, "one")
+
+    seeded = client.get("/conv/1/messages", headers=headers).json()
+    assert [m["id"] for m in seeded] == [first]
+    assert hottail.read(1, 10) is not None
+
+    second = _post(client, alice_token, "two")
+    newest = client.get("/conv/1/messages?limit=1", headers=headers).json()
+    after = client.get(f"/conv/1/messages?after={first}", headers=headers).json()
+
+    assert [m["content"] for m in newest] == ["two"]
+    assert [m["id"] for m in after] == [second]
+
+
+def test_websocket_metrics_are_exposed(client):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_json({"token": "not-a-jwt"})
+        with pytest.raises(WebSocketDisconnect):
+            websocket.receive_json()
+
+    with client.websocket_connect("/ws") as websocket:
+        assert _authenticate(websocket, alice_token) == []
+        _post(client, alice_token, "counted")
+        websocket.receive_json()
+        body = client.get("/metrics").text
+
+    assert 'pp_ws_rejected_connections_total{reason="bad_token"}' in body
+    assert "pp_ws_connected_sockets 1.0" in body
+    assert 'pp_ws_users_by_socket_count{sockets="1"} 1.0' in body
+    assert "pp_ws_broadcast_fanout_count" in body
+    assert "pp_ws_send_duration_seconds_count" in body
+    assert "pp_ws_auth_duration_seconds_count" in body
+
+
+def test_batch_post_sends_one_frame_per_socket(client):
+    client, (alice_token, bob_token, charlie_token, _diana_token) = client
+
+    with client.websocket_connect("/ws") as bob_ws, client.websocket_connect(
+        "/ws"
+    ) as charlie_ws:
+        assert _authenticate(bob_ws, bob_token) == []
+        assert _authenticate(charlie_ws, charlie_token) == []
+
+        response = client.post(
+            "/usermsg/batch",
+            json={
+                "messages": [
+                    {"conversation_id": 1, "content": "one"},
+                    {"conversation_id": 2, "content": "two"},
+                    {"conversation_id": 1, "content": "three"},
+                ]
+            },
+            headers={"Authorization": f"Bearer {alice_token}"},
+        )
+        assert response.status_code == 200
+        ids = response.json()["messageids"]
+
+        bob_frame = bob_ws.receive_json()
+        charlie_frame = charlie_ws.receive_json()
+
+    assert len(ids) == 3
+    assert bob_frame["type"] == "message.batch"
+    assert [e["message_id"] for e in bob_frame["events"]] == ids
+    assert [e["message_id"] for e in charlie_frame["events"]] == [ids[0], ids[2]]
+
+    history = client.get(
+        "/conv/1/messages", headers={"Authorization": f"Bearer {charlie_token}"}
+    ).json()
+    assert [m["content"] for m in history[-2:]] == ["one", "three"]
+
+
+def test_batch_post_is_rejected_as_a_whole(client):
+    client, (_alice_token, _bob_token, charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {charlie_token}"}
+
+    response = client.post(
+        "/usermsg/batch",
+        json={
+            "messages": [
+                {"conversation_id": 1, "content": "allowed"},
+                {"conversation_id": 2, "content": "not a member"},
+            ]
+        },
+        headers=headers,
+    )
+
+    assert response.status_code == 400
+    history = client.get("/conv/1/messages", headers=headers).json()
+    assert "allowed" not in [m["content"] for m in history]
+
+
+def test_post_message_checks_permissions_inside_the_insert(client):
+    client, (alice_token, _bob_token, charlie_token, _diana_token) = client
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(dbengine.sync_engine, "before_cursor_execute", record)
+    try:
+        allowed = _post(client, alice_token, "one round trip", conversation_id=2)
+        denied = client.post(
+            "/usermsg",
+            json={"content": "not a member", "conversation_id": 2},
+            headers={"Authorization": f"Bearer {charlie_token}"},
+        )
+    finally:
+        event.remove(dbengine.sync_engine, "before_cursor_execute", record)
+
+    assert isinstance(allowed, int)
+    assert denied.status_code == 400
+    writes = [s for s in statements if "convomessage" in s]
+    assert len(writes) == 2 and all(s.startswith("INSERT") for s in writes)
+    assert not [
+        s for s in statements if s.startswith("SELECT") and "conv_members" in s
+    ]
+
+
+def test_history_skips_the_hot_tail_when_the_bus_is_local(client, monkeypatch):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {alice_token}"}
+    monkeypatch.setattr(hottail, "enabled", False)
+    _post(client, alice_token, "one")
+
+    first = client.get("/conv/1/messages", headers=headers).json()
+    assert [m["content"] for m in first] == ["one"]
+    assert not hottail.tails
+    _post_from_another_worker("two")
+
+    newest = client.get("/conv/1/messages", headers=headers).json()
+    assert [m["content"] for m in newest] == ["one", "two"]
+
+
+def test_no_etags_when_the_bus_is_local(client, monkeypatch):
+    client, (alice_token, _bob_token, _charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {alice_token}"}
+    _post(client, alice_token, "one")
+    etag = client.get("/conv/1/messages", headers=headers).headers["ETag"]
+
+    monkeypatch.setattr(validators, "enabled", False)
+    monkeypatch.setattr(hottail, "enabled", False)
+    _post_from_another_worker("two")
+    fresh = client.get("/conv/1/messages", headers={**headers, "If-None-Match": etag})
+
+    assert fresh.status_code == 200
+    assert "ETag" not in fresh.headers
+    assert [m["content"] for m in fresh.json()] == ["one", "two"]
+    for path in ("/conv", "/users"):
+        listed = client.get(path, headers={**headers, "If-None-Match": "*"})
+        assert listed.status_code == 200 and "ETag" not in listed.headers
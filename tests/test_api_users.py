@@ -48,3 +48,22 @@ async def test_friend_request_flow(client):
     assert friends_resp.status_code == 200
     friend_ids = {f["user_id"] for f in friends_resp.json()}
     assert 3 in friend_ids
+
+
+@pytest.mark.asyncio
+async def test_visible_users_etag_changes_with_friend_requests(client):
+    client, (alice_token, _bob_token, charlie_token, _diana_token) = client
+    headers = {"Authorization": f"Bearer {charlie_token}"}
+
+    etag = client.get("/users", headers=headers).headers["ETag"]
+    assert client.get("/users", headers={**headers, "If-None-Match": etag}).status_code == 304
+
+    code = client.post("/invite-codes", headers=headers).json()["code"]
+    client.post(
+        "/friend-requests",
+        json={"invite_code": code},
+        headers={"Authorization": f"Bearer {alice_token}"},
+    )
+    changed = client.get("/users", headers={**headers, "If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
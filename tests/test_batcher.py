@@ -0,0 +1,57 @@
+import asyncio
+
+from sqlalchemy import select
+
+from ppback.config import SessionLocal
+from ppback.db.batcher import MessageBatcher
+from ppback.db.ppdb_schemas import ConvoMessage
+from ppback.routers import messaging
+
+
+def test_batcher_commits_concurrent_inserts_together(client):
+    flushed = []
+
+    class CountingBatcher(MessageBatcher):
+        async def _flush(self, batch):
+            flushed.append(len(batch.rows))
+            await super()._flush(batch)
+
+    async def run():
+        batcher = CountingBatcher(SessionLocal, max_rows=4, max_delay=0.05)
+        ids = await asyncio.gather(
+            *(batcher.insert(1, 1, f"burst {i}", 1.0 + i) for i in range(10))
+        )
+        async with SessionLocal() as session:
+            rows = (
+                await session.execute(
+                    select(ConvoMessage.id, ConvoMessage.content).where(
+                        ConvoMessage.id.in_(ids)
+                    )
+                )
+            ).all()
+        return ids, dict(rows)
+
+    ids, contents = asyncio.run(run())
+
+    assert flushed == [4, 4, 2]
+    assert len(set(ids)) == 10
+    assert [contents[i] for i in ids] == [f"burst {i}" for i in range(10)]
+
+
+def test_post_message_through_the_batcher(client, monkeypatch):
+    client, (alice_token, bob_token, _charlie_token, _diana_token) = client
+    monkeypatch.setattr(messaging, "MESSAGE_BATCH_ENABLED", True)
+
+    response = client.post(
+        "/usermsg",
+        json={"conversation_id": 2, "content": "batched"},
+        headers={"Authorization": f"Bearer {alice_token}"},
+    )
+    assert response.status_code == 200
+    message_id = response.json()["messageid"]
+
+    messages = client.get(
+        "/conv/2/messages", headers={"Authorization": f"Bearer {bob_token}"}
+    ).json()
+    assert messages[-1]["id"] == message_id
+    assert messages[-1]["content"] == "batched"
@@ -1,9 +1,25 @@
+import asyncio
+import inspect
+import time
+
 import pytest
+from fastapi_cache import FastAPICache
+from fastapi_cache.decorator import cache
+from sqlalchemy import update
 
-from ppback.db.dbfuncs import get_conversation_list_for_user, hook_user
-from ppback.db.ppdb_schemas import UserInfo
+from ppback.cachebackend import BoundedMemoryBackend, RedisTagIndex, TwoTierBackend
+from ppback.cachetags import cache_tags, cachetags, conv_tag, member_tag
+from ppback.db.dbfuncs import (
+    get_conversation_list_for_user,
+    hook_user,
+    key_builder,
+    membersof,
+)
+from ppback.db.ppdb_schemas import ConvMember, UserInfo
 from ppback.config import SessionLocal
 from ppback.ppschema import ConversationList
+from ppback.singleflight import single_flight, singleflight
+from ppback.wsocket import inmemsockets
 
 
 @pytest.mark.asyncio
@@ -30,3 +46,189 @@ async def test_get_conversation_list_returns_typed_model_with_warm_cache(client)
     assert isinstance(first, ConversationList)
     assert isinstance(second, ConversationList)
     assert len(second.conversations) >= 1
+
+
+@pytest.mark.asyncio
+async def test_invalidating_a_tag_drops_only_its_entries(client):
+    _client, _tokens = client
+    backend = FastAPICache.get_backend()
+
+    async with SessionLocal() as db:
+        await membersof(db, 1)
+        await membersof(db, 2)
+    keys = {
+        tag: set(cachetags.keys[tag]) for tag in (conv_tag(1), conv_tag(2))
+    }
+    assert all([await backend.get(key) for key in keys[conv_tag(1)]])
+
+    await cachetags.invalidate([conv_tag(1)])
+
+    assert conv_tag(1) not in cachetags.keys
+    assert not any([await backend.get(key) for key in keys[conv_tag(1)]])
+    assert all([await backend.get(key) for key in keys[conv_tag(2)]])
+
+
+@pytest.mark.asyncio
+async def test_registry_forgets_keys_the_backend_evicts(client, monkeypatch):
+    _client, _tokens = client
+    backend = FastAPICache.get_backend()
+    monkeypatch.setattr(backend, "max_entries", 1)
+
+    async with SessionLocal() as db:
+        await membersof(db, 1)
+        (key,) = cachetags.keys[conv_tag(1)]
+        await membersof(db, 2)
+
+    assert conv_tag(1) not in cachetags.keys
+    assert key not in cachetags.tags_of
+    assert set(cachetags.keys[conv_tag(2)]) == set(backend.entries)
+
+
+@pytest.mark.asyncio
+async def test_cache_hits_skip_tag_registration(client, monkeypatch):
+    _client, _tokens = client
+
+    async with SessionLocal() as db:
+        await membersof(db, 1)
+        tags_of = dict(cachetags.tags_of)
+        monkeypatch.setattr(inspect.Signature, "bind", None)
+        await membersof(db, 1)
+
+    assert cachetags.tags_of == tags_of
+
+
+@pytest.mark.asyncio
+async def test_invalidation_is_published_when_the_l2_is_down(client, monkeypatch):
+    _client, _tokens = client
+
+    class DownOnDelete(BoundedMemoryBackend):
+        async def clear(self, namespace=None, key=None):
+            raise ConnectionError("L2 unreachable")
+
+    backend = TwoTierBackend(BoundedMemoryBackend(), DownOnDelete())
+    monkeypatch.setattr(FastAPICache, "_backend", backend)
+    cachetags.track(backend)
+    published = []
+
+    async def record(tags):
+        published.append(tags)
+
+    monkeypatch.setattr(inmemsockets, "cache_invalidated", record)
+
+    async with SessionLocal() as db:
+        await membersof(db, 1)
+    await cachetags.invalidate([conv_tag(1)])
+
+    assert published == [[conv_tag(1)]]
+    assert not backend.l1.entries
+
+
+@pytest.mark.asyncio
+async def test_miss_running_across_an_invalidation_is_not_cached(client):
+    _client, _tokens = client
+    started, release = asyncio.Event(), asyncio.Event()
+    rows = {"allowed": False}
+
+    @cache(60, key_builder=key_builder)
+    @cache_tags("member:{uid}")
+    @single_flight
+    async def slow_allowed(session, uid: int) -> bool:
+        allowed = rows["allowed"]
+        started.set()
+        await release.wait()
+        return allowed
+
+    miss = asyncio.create_task(slow_allowed(None, 1))
+    await started.wait()
+    rows["allowed"] = True
+    await cachetags.invalidate([member_tag(1)])
+    release.set()
+
+    assert await miss is False
+    assert await slow_allowed(None, 1) is True
+    assert await slow_allowed(None, 1) is True
+
+
+class FakeRedis:
+    """The set commands of the L2 tag index."""
+
+    def __init__(self):
+        self.sets = {}
+
+    async def sadd(self, name, *values):
+        self.sets.setdefault(name, set()).update(v.encode() for v in values)
+
+    async def expire(self, name, seconds):
+        return name in self.sets
+
+    async def spop(self, name, count=None):
+        return list(self.sets.pop(name, ()))
+
+
+@pytest.mark.asyncio
+async def test_invalidation_reaches_l2_entries_cached_before_a_restart(
+    client, monkeypatch
+):
+    _client, _tokens = client
+    l2, redis = BoundedMemoryBackend(), FakeRedis()
+
+    def start_worker():
+        backend = TwoTierBackend(BoundedMemoryBackend(), l2, RedisTagIndex(redis))
+        monkeypatch.setattr(FastAPICache, "_backend", backend)
+        cachetags.track(backend)
+
+    start_worker()
+    async with SessionLocal() as db:
+        assert {m["role"] for m in await membersof(db, 1)} != {"viewer"}
+
+    # A deploy empties the registry while the L2 keeps its entries.
+    start_worker()
+    async with SessionLocal() as db:
+        await db.execute(
+            update(ConvMember).where(ConvMember.conv_id == 1).values(role="viewer")
+        )
+        await db.commit()
+        await cachetags.invalidate([conv_tag(1)])
+
+        assert {m["role"] for m in await membersof(db, 1)} == {"viewer"}
+
+
+@pytest.mark.asyncio
+async def test_stale_entry_is_served_while_refreshed_in_background(
+    client, monkeypatch
+):
+    _client, _tokens = client
+    backend = BoundedMemoryBackend(stale_s=60)
+    monkeypatch.setattr(FastAPICache, "_backend", backend)
+    cachetags.track(backend)
+    release = asyncio.Event()
+    release.set()
+    rows = {"label": "old"}
+    queries = []
+
+    @cache(60, key_builder=key_builder)
+    @cache_tags("conv:{convo_id}")
+    @single_flight
+    async def slow_label(session, convo_id: int) -> str:
+        queries.append(session)
+        await release.wait()
+        return rows["label"]
+
+    assert await slow_label(None, 1) == "old"
+    (entry,) = backend.entries.values()
+    entry.expires_at = time.monotonic() - 1
+    rows["label"] = "new"
+    release.clear()
+
+    # The query is blocked, yet nobody waits for it.
+    served = await asyncio.wait_for(
+        asyncio.gather(*(slow_label(None, 1) for _ in range(5))), timeout=1
+    )
+    assert served == ["old"] * 5
+    await asyncio.sleep(0)
+    assert len(queries) == 2 and queries[1] is not None
+
+    release.set()
+    await asyncio.gather(*singleflight.refreshes)
+    assert await slow_label(None, 1) == "new"
+    assert len(queries) == 2
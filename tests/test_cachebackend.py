@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+from fastapi_cache.types import Backend
+
+from ppback.cachebackend import (
+    BoundedMemoryBackend,
+    TwoTierBackend,
+    create_cache_backend,
+)
+from ppback.middleware.metrics import CACHE_EVICTIONS, CACHE_HITS
+
+
+def key(func, arg):
+    return f"fastapi-cache::{func}:{arg}"
+
+
+def test_backend_evicts_least_recently_used_over_entry_budget():
+    async def run():
+        backend = BoundedMemoryBackend(max_entries=2, max_bytes=10_000)
+        await backend.set(key("membersof", 1), b"one", 60)
+        await backend.set(key("membersof", 2), b"two", 60)
+        assert await backend.get(key("membersof", 1)) == b"one"
+        await backend.set(key("membersof", 3), b"three", 60)
+        return backend
+
+    before = CACHE_EVICTIONS.labels(namespace="membersof", reason="lru")._value.get()
+    backend = asyncio.run(run())
+
+    assert list(backend.entries) == [key("membersof", 1), key("membersof", 3)]
+    assert backend.sizes["membersof"][0] == 2
+    after = CACHE_EVICTIONS.labels(namespace="membersof", reason="lru")._value.get()
+    assert after == before + 1
+
+
+def test_backend_keeps_within_byte_budget():
+    async def run():
+        backend = BoundedMemoryBackend(max_entries=100, max_bytes=700)
+        for i in range(5):
+            await backend.set(key("allusers", i), b"x" * 100, 60)
+        await backend.set(key("allusers", "huge"), b"x" * 1000, 60)
+        return backend
+
+    backend = asyncio.run(run())
+
+    assert backend.nbytes <= 700
+    assert key("allusers", 4) in backend.entries
+    assert key("allusers", 0) not in backend.entries
+    assert key("allusers", "huge") not in backend.entries
+    assert backend.nbytes == sum(e.size for e in backend.entries.values())
+
+
+def test_backend_expires_and_sweeps_entries():
+    async def run():
+        backend = BoundedMemoryBackend(sweep_interval=0)
+        await backend.set(key("hook_user", 1), b"gone", 0)
+        await backend.set(key("hook_user", 2), b"gone too", 0)
+        hits = CACHE_HITS.labels(namespace="hook_user")._value.get()
+        assert await backend.get_with_ttl(key("hook_user", 1)) == (0, None)
+        assert CACHE_HITS.labels(namespace="hook_user")._value.get() == hits
+        # The next set sweeps the other expired entry.
+        await backend.set(key("hook_user", 3), b"kept", 60)
+        ttl, data = await backend.get_with_ttl(key("hook_user", 3))
+        assert data == b"kept" and 59 <= ttl <= 60
+        assert await backend.clear(key=key("hook_user", 9)) == 0
+        return backend
+
+    backend = asyncio.run(run())
+
+    assert list(backend.entries) == [key("hook_user", 3)]
+    assert backend.sizes["hook_user"][0] == 1
+
+
+def test_two_tier_workers_share_the_l2():
+    async def run():
+        shared = BoundedMemoryBackend()
+        worker_a = TwoTierBackend(BoundedMemoryBackend(), shared)
+        worker_b = TwoTierBackend(BoundedMemoryBackend(), shared)
+
+        await worker_a.set(key("membersof", 1), b"members", 60)
+        ttl, data = await worker_b.get_with_ttl(key("membersof", 1))
+        assert data == b"members" and ttl > 0
+        assert key("membersof", 1) in worker_b.l1.entries
+
+        # Invalidation: each worker drops the key from its L1 and the L2.
+        assert await worker_a.clear(key=key("membersof", 1)) == 1
+        assert await shared.get(key("membersof", 1)) is None
+        assert await worker_b.get(key("membersof", 1)) == b"members"
+        await worker_b.clear(key=key("membersof", 1))
+        assert await worker_b.get(key("membersof", 1)) is None
+
+    asyncio.run(run())
+
+
+def test_two_tier_falls_back_to_l1_when_l2_is_down():
+    class Down(Backend):
+        async def get_with_ttl(self, key):
+            raise ConnectionError("L2 unreachable")
+
+        async def get(self, key):
+            raise ConnectionError("L2 unreachable")
+
+        async def set(self, key, value, expire=None):
+            raise ConnectionError("L2 unreachable")
+
+        async def clear(self, namespace=None, key=None):
+            raise ConnectionError("L2 unreachable")
+
+    async def run():
+        backend = TwoTierBackend(BoundedMemoryBackend(), Down())
+        assert await backend.get_with_ttl(key("allusers", "")) == (0, None)
+        await backend.set(key("allusers", ""), b"users", 60)
+        assert await backend.get(key("allusers", "")) == b"users"
+        assert await backend.clear(key=key("allusers", "")) == 1
+        assert await backend.get(key("allusers", "")) is None
+
+    asyncio.run(run())
+
+
+def test_stale_entry_is_refreshed_by_one_reader_and_served_to_others():
+    async def run():
+        backend = BoundedMemoryBackend(stale_s=60)
+        await backend.set(key("membersof", 1), b"old", 0)
+
+        # The first reader refreshes; the others get the stale value meanwhile.
+        assert await backend.get_with_ttl(key("membersof", 1)) == (0, None)
+        assert await backend.get_with_ttl(key("membersof", 1)) == (0, b"old")
+        assert await backend.get(key("membersof", 1)) == b"old"
+
+        await backend.set(key("membersof", 1), b"new", 60)
+        assert await backend.get(key("membersof", 1)) == b"new"
+
+        # Invalidation never leaves a stale copy behind.
+        await backend.clear(key=key("membersof", 1))
+        assert await backend.get(key("membersof", 1)) is None
+
+    asyncio.run(run())
+
+
+def test_l2_cache_is_refused_without_the_postgres_bus():
+    with pytest.raises(ValueError):
+        create_cache_backend("redis://localhost:6379/0", "inprocess")
+    assert isinstance(create_cache_backend("", "inprocess"), BoundedMemoryBackend)
@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+from ppback.longpoll import MessageWaiters
+from ppback.ppschema import MessageSchema
+
+
+def message(msg_id):
+    return MessageSchema(id=msg_id, content="x", sender=1, ts=1.0)
+
+
+@pytest.mark.asyncio
+async def test_waiters_wake_on_a_message_for_their_conversation():
+    waiters = MessageWaiters(max_wait=5)
+    woken = waiters.register(1)
+    other = waiters.register(2)
+    task = asyncio.create_task(waiters.wait(1, woken, 5))
+    await asyncio.sleep(0)
+
+    waiters.on_message(1, message(7))
+
+    assert await task is True
+    assert await waiters.wait(2, other, 0.01) is False
+    assert waiters.waiting == {}
@@ -0,0 +1,50 @@
+from ppback.msgcache import HotTail
+from ppback.ppschema import MessageSchema
+
+
+def msg(msg_id, content="x"):
+    return MessageSchema(id=msg_id, content=content, sender=1, ts=float(msg_id))
+
+
+def test_hot_tail_serves_newest_and_after_reads_once_seeded():
+    tail = HotTail(size=3, budget_bytes=10_000)
+    assert tail.read(1, 2) is None
+
+    assert tail.begin_seed(1)
+    assert not tail.begin_seed(1)
+    tail.append(1, msg(5))
+    tail.finish_seed(1, [msg(2), msg(4)], complete=True)
+    tail.append(1, msg(5))
+    tail.append(1, msg(6))
+
+    assert [m.id for m in tail.read(1, 2)] == [5, 6]
+    assert [m.id for m in tail.read(1, 10, after=4)] == [5, 6]
+    # 2 was trimmed, so neither a full read nor an older cursor is served.
+    assert tail.read(1, 10) is None
+    assert tail.read(1, 10, after=1) is None
+
+
+def test_hot_tail_pages_with_before_and_after_cursors():
+    tail = HotTail(size=4, budget_bytes=10_000)
+    tail.begin_seed(1)
+    tail.finish_seed(1, [msg(i) for i in range(3, 7)], complete=False)
+
+    assert [m.id for m in tail.read(1, 2, before=6)] == [4, 5]
+    assert [m.id for m in tail.read(1, 2, after=3)] == [4, 5]
+    assert [m.id for m in tail.read(1, 5, after=2, before=6)] == [3, 4, 5]
+    # Rows below the floor are unknown, so a deeper page goes to the DB.
+    assert tail.read(1, 3, before=5) is None
+
+
+def test_hot_tail_evicts_cold_conversations_over_budget():
+    tail = HotTail(size=10, budget_bytes=700)
+    for conv_id in (1, 2, 3):
+        tail.begin_seed(conv_id)
+        tail.finish_seed(conv_id, [msg(conv_id)], complete=True)
+    tail.read(1, 1)
+    tail.begin_seed(4)
+    tail.finish_seed(4, [msg(4, "y" * 100)], complete=True)
+
+    assert tail.read(2, 1) is None
+    assert [m.id for m in tail.read(1, 1)] == [1]
+    assert tail.nbytes <= 700
@@ -0,0 +1,24 @@
+from ppback.rendered import RenderedResponses
+
+
+def test_rendered_body_is_only_served_for_its_etag():
+    bodies = RenderedResponses(budget_bytes=10_000)
+    bodies.put("conv", 1, '"c1.a.0.5"', b'{"conversations":[]}', [1, 2])
+
+    assert bodies.get("conv", 1, '"c1.a.0.5"') == b'{"conversations":[]}'
+    assert bodies.get("conv", 1, '"c1.a.0.6"') is None
+    assert bodies.get("users", 1, '"c1.a.0.5"') is None
+    assert bodies.conv_ids("conv", 1) == [1, 2]
+    assert bodies.conv_ids("conv", 2) is None
+
+
+def test_rendered_bodies_stay_within_budget():
+    bodies = RenderedResponses(budget_bytes=1000)
+    for user_id in range(5):
+        bodies.put("users", user_id, f'"u{user_id}"', b"x" * 100)
+    bodies.get("users", 2, '"u2"')
+    bodies.put("users", 5, '"u5"', b"x" * 100)
+
+    assert bodies.nbytes <= 1000
+    assert list(bodies.bodies) == [("users", 4), ("users", 2), ("users", 5)]
+    assert bodies.nbytes == sum(b.nbytes for b in bodies.bodies.values())
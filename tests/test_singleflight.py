@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from ppback.singleflight import SingleFlight, single_flight, singleflight
+
+
+def test_concurrent_calls_share_one_computation():
+    flights = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"members": [1, 2]}
+
+    async def run():
+        return await asyncio.gather(*(flights.do("membersof:1", compute) for _ in range(5)))
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert flights.flights == {}
+
+
+def test_failure_reaches_every_waiter_and_is_not_kept():
+    flights = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("db down")
+
+    async def run():
+        results = await asyncio.gather(
+            *(flights.do("allusers", compute) for _ in range(3)),
+            return_exceptions=True,
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+        with pytest.raises(RuntimeError):
+            await flights.do("allusers", compute)
+
+    asyncio.run(run())
+
+    assert len(calls) == 2
+
+
+def test_cancelled_leader_hands_over_to_a_waiter():
+    flights = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        return "fresh"
+
+    async def run():
+        leader = asyncio.create_task(flights.do("hook_user:1", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flights.do("hook_user:1", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await waiter == "fresh"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+    asyncio.run(run())
+
+
+def test_decorated_calls_coalesce_across_sessions_until_invalidated():
+    calls = []
+
+    @single_flight
+    async def membersof(session, convo_id):
+        calls.append(convo_id)
+        await asyncio.sleep(0.01)
+        return [convo_id]
+
+    async def run():
+        first = asyncio.create_task(membersof(object(), 1))
+        joined = asyncio.create_task(membersof(object(), 1))
+        other = asyncio.create_task(membersof(object(), 2))
+        await asyncio.sleep(0)
+        singleflight.invalidate()
+        fresh = asyncio.create_task(membersof(object(), 1))
+        return await asyncio.gather(first, joined, other, fresh)
+
+    first, joined, _other, fresh = asyncio.run(run())
+
+    assert calls == [1, 2, 1]
+    assert first is joined
+    assert fresh is not first
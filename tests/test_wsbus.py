@@ -0,0 +1,51 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from ppback.wsbus import NOTIFY_MAX_BYTES, PostgresBus, event_bytes
+
+# The test settings force SQLite, so the bus gets its own DSN.
+PG_DSN = os.getenv("PPBACK_TEST_PG_DSN", "")
+
+
+def test_events_are_measured_in_utf8_bytes():
+    assert event_bytes({"content": "a" * 10}) == len('{"content": ""}') + 10
+    # Three bytes per character, not a six-byte \uXXXX escape.
+    assert event_bytes({"content": "\u20ac" * 10}) == len('{"content": ""}') + 30
+    assert PostgresBus.max_event_bytes == NOTIFY_MAX_BYTES < 8000
+
+
+@pytest.mark.postgres
+@pytest.mark.skipif(not PG_DSN, reason="PPBACK_TEST_PG_DSN is not set")
+@pytest.mark.asyncio
+async def test_postgres_bus_delivers_each_publish_once_per_worker():
+    channel = f"pp_ws_test_{uuid.uuid4().hex[:8]}"
+    received = {"a": [], "b": []}
+    both = asyncio.Event()
+
+    def handler(name):
+        async def handle(event):
+            received[name].append(event)
+            if received["a"] and received["b"]:
+                both.set()
+
+        return handle
+
+    worker_a = PostgresBus(PG_DSN, handler("a"), channel=channel)
+    worker_b = PostgresBus(PG_DSN, handler("b"), channel=channel)
+    await worker_a.start()
+    await worker_b.start()
+    try:
+        await worker_a.publish({"kind": "users_changed", "user_ids": [1, 2]})
+        await asyncio.wait_for(both.wait(), timeout=5)
+        # Give a duplicate notification the time to show up.
+        await asyncio.sleep(0.2)
+    finally:
+        await worker_a.stop()
+        await worker_b.stop()
+
+    expected = [{"kind": "users_changed", "user_ids": [1, 2]}]
+    assert received == {"a": expected, "b": expected}
+    assert not worker_a._deliveries and not worker_b._deliveries
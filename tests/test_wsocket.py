@@ -0,0 +1,295 @@
+import asyncio
+import json
+
+import pytest
+
+from ppback.middleware.metrics import WS_SEND_FAILURES
+from ppback.ppschema import MessageSchema
+from ppback.wsbus import event_bytes
+from ppback.wsocket import InMemSockets, ReplayBuffer
+
+
+def message(msg_id, content="hello"):
+    return MessageSchema(id=msg_id, content=content, sender=1, ts=1.5)
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def send_text(self, payload):
+        self.sent.append(payload)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+class StalledSocket(RecordingSocket):
+    async def send_text(self, payload):
+        await asyncio.Event().wait()
+
+
+class RecordingBus:
+    def __init__(self, handler):
+        self.handler = handler
+        self.events = []
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    max_event_bytes = None
+
+    async def publish(self, event):
+        self.events.append(event)
+        await self.handler(event)
+
+
+class SmallBus(RecordingBus):
+    max_event_bytes = 200
+
+
+@pytest.mark.asyncio
+async def test_registry_add_lookup_and_drop():
+    registry = InMemSockets(limit=2)
+    first = registry.add_user(1, "ws-a")
+    second = registry.add_user(1, "ws-b")
+    registry.add_user(2, "ws-c")
+
+    assert registry.count_for_user(1) == 2
+    assert not registry.can_add_user(1)
+    assert registry.get_sockets_for(1) == ["ws-a", "ws-b"]
+    assert registry.get_sockets_for(2) == ["ws-c"]
+    assert registry.total == 3
+
+    registry.drop_user(1, first)
+    assert registry.get_sockets_for(1) == ["ws-b"]
+    assert registry.can_add_user(1)
+
+    registry.drop_user(1, second)
+    registry.drop_user(1, second)
+    assert registry.count_for_user(1) == 0
+    assert 1 not in registry.users
+    assert registry.total == 1
+
+
+@pytest.mark.asyncio
+async def test_broadcast_goes_through_the_bus():
+    registry = InMemSockets()
+    bus = RecordingBus(registry.deliver_local)
+    await registry.use_bus(bus)
+    alice, bob, charlie = RecordingSocket(), RecordingSocket(), RecordingSocket()
+    registry.add_user(1, alice)
+    registry.add_user(2, bob)
+    registry.add_user(3, charlie)
+    registry.subscribe(1, [7])
+    registry.subscribe(2, [7])
+
+    await registry.broadcast_message_to_conv(7, message(42))
+    await asyncio.sleep(0)
+
+    assert len(bus.events) == 1
+    assert bus.events[0]["conv_id"] == 7
+    assert bus.events[0]["message"]["content"] == "hello"
+    assert alice.sent == bob.sent
+    assert json.loads(alice.sent[0])["message_id"] == 42
+    assert charlie.sent == []
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_is_evicted_without_blocking_broadcast():
+    registry = InMemSockets(queue_size=2)
+    fast, slow = RecordingSocket(), StalledSocket()
+    registry.add_user(1, fast)
+    registry.add_user(2, slow)
+    registry.subscribe(1, [7])
+    registry.subscribe(2, [7])
+
+    for msg_id in range(5):
+        await registry.broadcast_message_to_conv(7, message(msg_id))
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+    assert len(fast.sent) == 5
+    assert registry.count_for_user(2) == 0
+    assert slow.closed_with == 1013
+    assert registry.count_for_user(1) == 1
+
+
+@pytest.mark.asyncio
+async def test_stalled_peer_on_a_quiet_socket_is_evicted_after_send_timeout():
+    registry = InMemSockets(send_timeout=0.01)
+    stalled = StalledSocket()
+    idx = registry.add_user(1, stalled)
+    before = WS_SEND_FAILURES.labels(reason="timeout")._value.get()
+
+    registry.send_to(1, idx, "one frame")
+    await asyncio.sleep(0.05)
+
+    assert registry.count_for_user(1) == 0
+    assert stalled.closed_with == 1013
+    assert WS_SEND_FAILURES.labels(reason="timeout")._value.get() == before + 1
+
+
+@pytest.mark.asyncio
+async def test_conv_broadcast_only_reaches_subscribed_sockets():
+    registry = InMemSockets()
+    alice, bob, charlie = RecordingSocket(), RecordingSocket(), RecordingSocket()
+    alice_idx = registry.add_user(1, alice)
+    registry.add_user(2, bob)
+    registry.add_user(3, charlie)
+    registry.subscribe(1, [7])
+    await registry.join_conversation(7, [2, 4])
+
+    await registry.broadcast_message_to_conv(7, message(42))
+    await asyncio.sleep(0)
+
+    assert len(alice.sent) == len(bob.sent) == 1
+    assert charlie.sent == []
+
+    registry.drop_user(1, alice_idx)
+    assert [conn.user_id for conn in registry.get_connections_for_conv(7)] == [2]
+
+
+@pytest.mark.asyncio
+async def test_inline_sockets_get_the_message_body():
+    registry = InMemSockets()
+    plain, inline = RecordingSocket(), RecordingSocket()
+    registry.add_user(1, plain)
+    registry.add_user(2, inline, inline=True)
+    registry.subscribe(1, [7])
+    registry.subscribe(2, [7])
+
+    await registry.broadcast_message_to_conv(7, message(42, "hi there"))
+    await asyncio.sleep(0)
+
+    assert "hi there" not in plain.sent[0]
+    assert json.loads(inline.sent[0])["message"]["content"] == "hi there"
+
+
+@pytest.mark.asyncio
+async def test_message_too_big_for_the_bus_goes_by_id_and_is_loaded_back():
+    registry = InMemSockets()
+    bus = SmallBus(registry.deliver_local)
+    await registry.use_bus(bus)
+    big = message(42, "x" * 500)
+    loaded = []
+
+    async def loader(message_ids):
+        loaded.append(message_ids)
+        return {42: big}
+
+    registry.set_message_loader(loader)
+    inline = RecordingSocket()
+    registry.add_user(1, inline, inline=True)
+    registry.subscribe(1, [7])
+
+    await registry.broadcast_message_to_conv(7, message(41, "small"))
+    await registry.broadcast_message_to_conv(7, big)
+    await asyncio.sleep(0)
+
+    assert "message" in bus.events[0]
+    assert bus.events[1] == {"kind": "conv", "conv_id": 7, "message_id": 42}
+    assert loaded == [[42]]
+    assert json.loads(inline.sent[1])["message"]["content"] == "x" * 500
+    assert [e[0] for e in registry.replay.since(7, 0)] == [41, 42]
+
+
+@pytest.mark.asyncio
+async def test_batch_too_big_for_the_bus_is_split_into_several_events():
+    registry = InMemSockets()
+    bus = SmallBus(registry.deliver_local)
+    bus.max_event_bytes = 400
+    await registry.use_bus(bus)
+    huge = message(9, "x" * 1000)
+
+    async def loader(message_ids):
+        return {9: huge}
+
+    registry.set_message_loader(loader)
+    sock = RecordingSocket()
+    registry.add_user(1, sock)
+    registry.subscribe(1, [7])
+
+    batch = [(7, message(i)) for i in range(1, 9)] + [(7, huge)]
+    await registry.broadcast_messages_to_convs(batch)
+    await asyncio.sleep(0)
+
+    assert len(bus.events) > 1
+    assert all(event_bytes(event) <= 400 for event in bus.events)
+    assert bus.events[-1]["messages"][-1] == {"conv_id": 7, "message_id": 9}
+    frames = [json.loads(frame) for frame in sock.sent]
+    assert len(frames) == len(bus.events)
+    delivered = [e["message_id"] for frame in frames for e in frame["events"]]
+    assert delivered == list(range(1, 10))
+
+
+@pytest.mark.asyncio
+async def test_lost_bus_events_reset_local_state():
+    class FailingBus(RecordingBus):
+        async def publish(self, event):
+            raise ConnectionError("bus down")
+
+    registry = InMemSockets()
+    resets = []
+    registry.add_reset_listener(lambda: resets.append("sync"))
+
+    async def async_listener():
+        resets.append("async")
+
+    registry.add_reset_listener(async_listener)
+    await registry.broadcast_message_to_conv(7, message(41))
+    assert registry.replay.covers(7, 40)
+
+    # A failed publish after the commit is logged, not raised.
+    await registry.use_bus(FailingBus(registry.deliver_local))
+    await registry.broadcast_message_to_conv(7, message(42))
+    assert not registry.replay.covers(7, 40)
+    assert resets == ["sync", "async"]
+
+    # A reconnecting bus announces its gap with a local reset event.
+    await registry.deliver_local({"kind": "reset"})
+    assert resets == ["sync", "async"] * 2
+
+
+def test_replay_buffer_tracks_what_it_still_covers():
+    buffer = ReplayBuffer(size=2, max_convs=1)
+    buffer.record(7, 10, "p10", "i10")
+    assert buffer.covers(7, 9)
+    assert not buffer.covers(7, 8)
+
+    buffer.record(7, 12, "p12", "i12")
+    buffer.record(7, 15, "p15", "i15")
+    assert not buffer.covers(7, 9)
+    assert buffer.covers(7, 10)
+    assert [e[0] for e in buffer.since(7, 10)] == [12, 15]
+
+    buffer.record(8, 20, "p20", "i20")
+    assert not buffer.covers(7, 15)
+    assert buffer.covers(8, 19)
+
+
+@pytest.mark.asyncio
+async def test_batch_broadcast_coalesces_frames_per_socket():
+    registry = InMemSockets()
+    both, only_seven = RecordingSocket(), RecordingSocket()
+    registry.add_user(1, both)
+    registry.add_user(2, only_seven)
+    registry.subscribe(1, [7, 8])
+    registry.subscribe(2, [7])
+    seen = []
+    registry.add_message_listener(lambda conv_id, m: seen.append((conv_id, m.id)))
+
+    await registry.broadcast_messages_to_convs(
+        [(7, message(1)), (8, message(2)), (7, message(3))]
+    )
+    await asyncio.sleep(0)
+
+    assert len(both.sent) == len(only_seven.sent) == 1
+    assert [e["message_id"] for e in json.loads(both.sent[0])["events"]] == [1, 2, 3]
+    assert [e["message_id"] for e in json.loads(only_seven.sent[0])["events"]] == [1, 3]
+    assert seen == [(7, 1), (8, 2), (7, 3)]
+    assert registry.replay.covers(8, 1)